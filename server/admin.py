@@ -1,11 +1,15 @@
 from django.contrib import admin
 
 # Register your models here.
-from .models import (Backup, Origin)
+from .models import (Backup, Origin, ReplicationPolicy, RetentionPolicy)
 from .models.destination.LocalDestination import LocalDestination
 from .models.destination.SFTPDestination import SFTPDestination
+from .models.destination.DedupDestination import DedupDestination
 
 admin.site.register(Backup)
 admin.site.register(Origin)
+admin.site.register(ReplicationPolicy)
+admin.site.register(RetentionPolicy)
 admin.site.register(LocalDestination)
-admin.site.register(SFTPDestination)
\ No newline at end of file
+admin.site.register(SFTPDestination)
+admin.site.register(DedupDestination)
\ No newline at end of file
@@ -0,0 +1,223 @@
+#-*- coding: utf-8 -*-
+
+import hmac
+import time
+import logging
+import hashlib
+import tempfile
+import threading
+from collections import OrderedDict
+
+from django.conf import settings
+from django.core.cache import get_cache
+from django.core.cache.backends.locmem import LocMemCache
+from django.contrib.auth.models import User
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
+from django.http import HttpResponse
+
+from rest_framework import exceptions
+from rest_framework.authentication import ( BaseAuthentication
+                                          , BasicAuthentication
+                                          , TokenAuthentication
+                                          , get_authorization_header
+                                          )
+from rest_framework.authtoken.models import Token
+
+from .models import Origin
+
+class AuthCache(object):
+    '''
+        In-process LRU of authenticated credentials, each kept for ttl
+        seconds. Entries of a user are dropped when the user, its token or
+        its origins change in this process; other processes see the change
+        when their entries expire.
+    '''
+
+    def __init__(self, max_size=1024, ttl=60):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.pop(key, None)
+            if entry is None:
+                return None
+            if entry[0] < time.time():
+                return None
+            #re-inserted as the most recently used
+            self.entries[key] = entry
+            return entry[1]
+
+    def set(self, key, user, value):
+        with self.lock:
+            self.entries.pop(key, None)
+            self.entries[key] = (time.time() + self.ttl, value, user.pk)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+
+    def invalidate(self, user_id):
+        with self.lock:
+            for key in [key for key, entry in self.entries.iteritems() if entry[2] == user_id]:
+                del self.entries[key]
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+cache = AuthCache(getattr(settings, 'AUTH_CACHE_SIZE', 1024),
+                  getattr(settings, 'AUTH_CACHE_TTL', 60))
+
+@receiver(post_save, sender=User)
+@receiver(post_delete, sender=User)
+def invalidate_user(sender, instance, **kwargs):
+    cache.invalidate(instance.pk)
+
+@receiver(post_save, sender=Token)
+@receiver(post_delete, sender=Token)
+@receiver(post_save, sender=Origin)
+@receiver(post_delete, sender=Origin)
+def invalidate_credential(sender, instance, **kwargs):
+    cache.invalidate(instance.user_id)
+
+def password_digest(userid, password):
+    '''Cache key of a password: the password itself is never kept'''
+    return hmac.new(settings.SECRET_KEY, '%s:%s' % (userid, password),
+                    hashlib.sha256).hexdigest()
+
+class CachedBasicAuthentication(BasicAuthentication):
+    '''BasicAuthentication running the password hasher once per ttl'''
+
+    def authenticate_credentials(self, userid, password):
+        key = ('basic', password_digest(userid, password))
+        result = cache.get(key)
+        if result is None:
+            result = super(CachedBasicAuthentication, self).authenticate_credentials(userid, password)
+            cache.set(key, result[0], result)
+        return result
+
+class CachedTokenAuthentication(TokenAuthentication):
+    '''TokenAuthentication querying each token once per ttl'''
+
+    def authenticate_credentials(self, key):
+        cache_key = ('token', key)
+        result = cache.get(cache_key)
+        if result is None:
+            result = super(CachedTokenAuthentication, self).authenticate_credentials(key)
+            cache.set(cache_key, result[0], result)
+        return result
+
+EMPTY_BODY_SHA256 = hashlib.sha256('').hexdigest()
+
+def sign_request(apikey, method, path, timestamp, body_sha256=EMPTY_BODY_SHA256):
+    '''Signature expected by OriginAuthentication; body_sha256 is the hex SHA-256 of the body'''
+    message = '%s\n%s\n%s\n%s' % (method.upper(), path, timestamp, body_sha256)
+    return hmac.new(str(apikey), message, hashlib.sha256).hexdigest()
+
+class BodyDigestMiddleware(object):
+    '''
+        Hashes the body of HMAC signed requests before anything parses it,
+        into request.body_sha256. The body is spooled (to disk past
+        AUTH_HMAC_SPOOL_SIZE bytes) and read from the spool afterwards, so
+        streamed uploads are checked before any of it is stored. That costs
+        a second pass over the body, on disk for large ones: agents sending
+        big backups should prefer chunked uploads, each chunk signed on its
+        own. Bodies over AUTH_HMAC_MAX_BODY bytes are refused with 413.
+    '''
+
+    def __init__(self):
+        #a per-process cache only stops replays sent to the same process
+        name = getattr(settings, 'AUTH_HMAC_REPLAY_CACHE', 'default')
+        if isinstance(get_cache(name), LocMemCache):
+            logging.warning('AUTH_HMAC_REPLAY_CACHE (%s) is a local memory cache: '
+                            'HMAC signatures can be replayed to other processes', name)
+
+    def process_request(self, request):
+        if not request.META.get('HTTP_AUTHORIZATION', '').lower().startswith('hmac '):
+            return
+        max_body = getattr(settings, 'AUTH_HMAC_MAX_BODY', 1024 * 1024 * 1024)
+        try:
+            length = int(request.META.get('CONTENT_LENGTH') or 0)
+        except ValueError:
+            length = 0
+        if length > max_body:
+            return HttpResponse(status=413)
+        digest = hashlib.sha256()
+        spool = tempfile.SpooledTemporaryFile(getattr(settings, 'AUTH_HMAC_SPOOL_SIZE', 1024 * 1024))
+        for data in iter(lambda: request.read(64 * 1024), ''):
+            digest.update(data)
+            spool.write(data)
+            if spool.tell() > max_body:
+                spool.close()
+                return HttpResponse(status=413)
+        spool.seek(0)
+        request._stream = spool
+        request._read_started = False
+        request.body_sha256 = digest.hexdigest()
+
+class OriginAuthentication(BaseAuthentication):
+    '''
+        Authenticates backup agents by their origin's API key, without
+        sending it:
+
+            Authorization: HMAC <origin id>:<unix timestamp>:<signature>
+
+        where signature is sign_request(apikey, method, full path,
+        timestamp, SHA-256 of the body). Requests older or newer than
+        AUTH_HMAC_MAX_SKEW seconds are refused, and so is a signature seen
+        before: the signatures are kept in AUTH_HMAC_REPLAY_CACHE until
+        they expire, across processes when that cache is shared. Needs
+        BodyDigestMiddleware. Authenticates as the origin's user.
+    '''
+
+    def authenticate(self, request):
+        auth = get_authorization_header(request).split()
+        if not auth or auth[0].lower() != b'hmac':
+            return None
+        if len(auth) != 2 or auth[1].count(':') != 2:
+            raise exceptions.AuthenticationFailed('Invalid HMAC header.')
+
+        origin_id, timestamp, signature = auth[1].split(':')
+        max_skew = getattr(settings, 'AUTH_HMAC_MAX_SKEW', 300)
+        try:
+            skew = abs(time.time() - int(timestamp))
+        except ValueError:
+            raise exceptions.AuthenticationFailed('Invalid HMAC timestamp.')
+        if skew > max_skew:
+            raise exceptions.AuthenticationFailed('HMAC timestamp expired.')
+        body_sha256 = getattr(request._request, 'body_sha256', None)
+        if body_sha256 is None:
+            raise exceptions.AuthenticationFailed('HMAC request body was not hashed.')
+
+        user, origin = self.authenticate_credentials(origin_id)
+        expected = sign_request(origin.apikey, request.method,
+                                request.get_full_path(), timestamp, body_sha256)
+        if not hmac.compare_digest(expected, str(signature)):
+            raise exceptions.AuthenticationFailed('Invalid HMAC signature.')
+
+        #add() only stores keys that are not there, so one use each
+        seen = get_cache(getattr(settings, 'AUTH_HMAC_REPLAY_CACHE', 'default'))
+        expires = int(timestamp) + max_skew - time.time() + 1
+        if not seen.add('hmac:%s:%s:%s' % (origin_id, timestamp, signature), 1, max(1, int(expires))):
+            raise exceptions.AuthenticationFailed('HMAC signature already used.')
+        return (user, origin)
+
+    def authenticate_credentials(self, origin_id):
+        key = ('origin', origin_id)
+        result = cache.get(key)
+        if result is not None:
+            return result
+        try:
+            origin = Origin.objects.select_related('user').get(id=origin_id)
+        except (Origin.DoesNotExist, ValueError):
+            raise exceptions.AuthenticationFailed('Invalid origin.')
+        if origin.user is None or not origin.user.is_active:
+            raise exceptions.AuthenticationFailed('Origin without an active user.')
+        result = (origin.user, origin)
+        cache.set(key, origin.user, result)
+        return result
+
+    def authenticate_header(self, request):
+        return 'HMAC'
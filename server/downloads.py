@@ -0,0 +1,95 @@
+#-*- coding: utf-8 -*-
+
+import os
+
+from django.conf import settings
+from django.http import HttpResponse, StreamingHttpResponse
+from django.utils.http import urlquote
+
+from .models.destination.streams import ClosingFile
+
+BLOCK_SIZE = 64 * 1024
+
+class FileStreamResponse(StreamingHttpResponse):
+    '''
+        Streams a local file. Under wsgi_file_wrapper the file is handed to
+        the server's wsgi.file_wrapper, which can use sendfile(2).
+    '''
+
+    def __init__(self, f, *args, **kwargs):
+        super(FileStreamResponse, self).__init__(
+            iter(lambda: f.read(BLOCK_SIZE), ''), *args, **kwargs)
+        self.file_to_stream = f
+        self._closable_objects.append(f)
+
+def sendfile_response(path, content_type='application/zip'):
+    '''
+        Builds a download response that does not copy the file through
+        Python, according to settings.DOWNLOAD_SENDFILE:
+            'x-sendfile'       - X-Sendfile header (Apache mod_xsendfile, lighttpd)
+            'x-accel-redirect' - X-Accel-Redirect header (nginx), the path is
+                                 prefixed with DOWNLOAD_ACCEL_PREFIX
+            'wsgi'             - file passed to wsgi.file_wrapper
+        Returns None when no mode is configured.
+    '''
+    mode = getattr(settings, 'DOWNLOAD_SENDFILE', None)
+    if mode == 'x-sendfile':
+        response = HttpResponse(content_type=content_type)
+        response['X-Sendfile'] = path
+    elif mode == 'x-accel-redirect':
+        prefix = getattr(settings, 'DOWNLOAD_ACCEL_PREFIX', '/protected')
+        response = HttpResponse(content_type=content_type)
+        response['X-Accel-Redirect'] = urlquote(prefix.rstrip('/') + path)
+    elif mode == 'wsgi':
+        response = FileStreamResponse(open(path, 'rb'), content_type=content_type)
+        response['Content-Length'] = str(os.path.getsize(path))
+    else:
+        return None
+    return response
+
+def wsgi_file_wrapper(application):
+    '''
+        WSGI middleware returning FileStreamResponse files through the
+        server's wsgi.file_wrapper
+    '''
+    def wrapped(environ, start_response):
+        response = application(environ, start_response)
+        f = getattr(response, 'file_to_stream', None)
+        file_wrapper = environ.get('wsgi.file_wrapper', None)
+        if f is None or file_wrapper is None:
+            return response
+        #closing the file must still close the response (request_finished)
+        return file_wrapper(ClosingFile(f, response.close), BLOCK_SIZE)
+    return wrapped
+
+def sendfile_handles_ranges():
+    '''Whether the front web server answers Range requests itself'''
+    return getattr(settings, 'DOWNLOAD_SENDFILE', None) in ('x-sendfile', 'x-accel-redirect')
+
+class RangeNotSatisfiable(Exception):
+    pass
+
+def parse_range(header, size):
+    '''
+        Parses a single "bytes=" Range header against a file of size bytes.
+        Returns the inclusive (start, end) pair, None when the header must
+        be ignored (other units, multiple ranges, bad syntax) and raises
+        RangeNotSatisfiable when no byte of the file is selected.
+    '''
+    units, _, ranges = header.partition('=')
+    if units.strip() != 'bytes' or ',' in ranges:
+        return None
+    start, sep, end = [part.strip() for part in ranges.partition('-')]
+    if not sep or not (start or end) or not (start + end).isdigit():
+        return None
+    if not start:
+        #suffix range: last N bytes
+        if int(end) == 0 or size == 0:
+            raise RangeNotSatisfiable(header)
+        return (max(size - int(end), 0), size - 1)
+    start = int(start)
+    if end and int(end) < start:
+        return None
+    if start >= size:
+        raise RangeNotSatisfiable(header)
+    return (start, min(int(end), size - 1) if end else size - 1)
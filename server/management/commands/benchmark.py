@@ -0,0 +1,329 @@
+#-*- coding: utf-8 -*-
+
+import os
+import json
+import math
+import shutil
+import socket
+import tempfile
+import platform
+import subprocess
+from timeit import default_timer
+from io import BytesIO
+from optparse import make_option
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from django.test.utils import override_settings
+from django.utils import timezone
+from rest_framework.test import APIClient
+
+import paramiko
+
+from server.models import Backup, BaseDestination, LocalDestination, SFTPDestination
+from server.models.destination.buffers import chunks
+from server.models.destination.sftppool import pool as sftppool
+from server.sftpstandin import SFTPStandIn
+
+UNITS = {'': 1, 'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3}
+
+#fewer runs than this and the 99th percentile is just the slowest one
+P99_MIN_REPEAT = 100
+
+class Rollback(Exception):
+    '''Raised at the end of a run to undo its rows'''
+
+def parse_size(text):
+    '''"64K", "1M", "2G" or a plain number of bytes'''
+    text = text.strip().upper().rstrip('B')
+    unit = text[-1:] if text[-1:] in UNITS else ''
+    try:
+        return int(float(text[:len(text) - len(unit)]) * UNITS[unit])
+    except ValueError:
+        raise CommandError('Invalid size %r' % text)
+
+def format_size(size):
+    for unit in ('G', 'M', 'K'):
+        if size >= UNITS[unit] and not size % UNITS[unit]:
+            return '%d%s' % (size / UNITS[unit], unit)
+    return str(size)
+
+def percentile(timings, p):
+    '''Nearest rank percentile of timings'''
+    ordered = sorted(timings)
+    return ordered[max(0, int(math.ceil(p / 100.0 * len(ordered))) - 1)]
+
+class PatternFile(object):
+    '''
+        size bytes of a repeated random block, read without ever holding
+        more than the block, so multi-GB sources cost no memory
+    '''
+
+    block = os.urandom(1024 * 1024)
+
+    def __init__(self, size):
+        self.size = size
+        self.position = 0
+
+    def read(self, size=-1):
+        remaining = self.size - self.position
+        if size < 0 or size > remaining:
+            size = remaining
+        start = self.position % len(self.block)
+        data = self.block[start:start + size]
+        while len(data) < size:
+            data += self.block[:size - len(data)]
+        self.position += len(data)
+        return data
+
+    def readinto(self, b):
+        data = self.read(len(b))
+        b[:len(data)] = data
+        return len(data)
+
+class Command(BaseCommand):
+    help = ('Measures backup and restore throughput (MB/s) and latency (p50/p99/max) of '
+            'destinations and of the HTTP upload and raw download paths, over a range '
+            'of file sizes. Results are written as JSON lines, one per target, '
+            'operation and size, to be compared between commits with --baseline. '
+            'p99 is only reported with --repeat %d or more. The rows it needs '
+            '(a destination, a user, backups) are created in the configured database '
+            'inside a transaction that is rolled back at the end.' % P99_MIN_REPEAT)
+    option_list = BaseCommand.option_list + (
+        make_option('--sizes', dest='sizes', default='1K,64K,1M,16M,128M',
+                    help='Comma separated file sizes (K, M and G suffixes)'),
+        make_option('--repeat', type='int', dest='repeat', default=5,
+                    help='Runs of each operation and size (%d or more for a p99)' % P99_MIN_REPEAT),
+        make_option('--destination', action='append', dest='destinations', default=[],
+                    help='Also benchmark this configured destination, e.g. an SFTP one (repeatable)'),
+        make_option('--no-local', action='store_false', dest='local', default=True,
+                    help='Skip the temporary local destination'),
+        make_option('--no-http', action='store_false', dest='http', default=True,
+                    help='Skip POST /backups/ and GET ?fileformat=raw'),
+        make_option('--http-max-size', dest='http_max_size', default='128M',
+                    help='Larger sizes are not sent over HTTP, the test client builds '
+                         'whole request bodies in memory (and its time is measured too)'),
+        make_option('--sftp-standin', action='store_true', dest='sftp_standin', default=False,
+                    help='Also benchmark an SFTP destination against an in-process stand-in server'),
+        make_option('--latency', type='float', dest='latency', default=0,
+                    help='Milliseconds the stand-in delays each direction by'),
+        make_option('--bandwidth', dest='bandwidth', default=None,
+                    help='Bytes per second the stand-in allows each way (K, M and G suffixes)'),
+        make_option('--sftp-streams', type='int', dest='sftp_streams', default=1,
+                    help='Parallel sessions of the stand-in destination'),
+        make_option('--output', dest='output', default=None,
+                    help='Write the results as JSON lines to this file, - for stdout'),
+        make_option('--baseline', dest='baseline', default=None,
+                    help='JSON lines of an earlier run to compare throughput against'),
+    )
+
+    def handle(self, *args, **options):
+        self.options = options
+        self.sizes = [parse_size(size) for size in options['sizes'].split(',') if size.strip()]
+        self.repeat = max(1, options['repeat'])
+        self.run_info = self.environment()
+        self.results = []
+
+        destinations = []
+        for name in options['destinations']:
+            try:
+                destinations.append(BaseDestination.objects.get(name=name).destination_impl)
+            except BaseDestination.DoesNotExist:
+                raise CommandError('Destination %s does not exist' % name)
+
+        tmp = tempfile.mkdtemp(prefix='tbackup-benchmark-')
+        try:
+            #nothing the run creates in the database outlives it
+            with transaction.atomic():
+                self.run(tmp, destinations)
+                raise Rollback()
+        except Rollback:
+            pass
+        finally:
+            shutil.rmtree(tmp, ignore_errors=True)
+
+        self.write_results()
+
+    def run(self, tmp, destinations):
+        options = self.options
+        local = None
+        if options['local'] or options['http']:
+            #usernames are at most 30 characters
+            local = LocalDestination.objects.create(name='benchmark-%d' % os.getpid(),
+                                                    directory=tmp)
+        if options['local']:
+            #named after what it is, so runs can be compared
+            self.bench_destination(local, 'LocalDestination:tmp')
+        for destination in destinations:
+            self.bench_destination(destination)
+        if options['sftp_standin']:
+            self.bench_sftp_standin(tmp)
+        if options['http']:
+            self.bench_http(User.objects.create(username=local.name), local)
+
+    def environment(self):
+        try:
+            commit = subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'],
+                                             cwd=settings.BASE_DIR, stderr=open(os.devnull, 'w')).strip()
+        except Exception:
+            commit = None
+        return {
+            'commit': commit,
+            'date': timezone.now().isoformat(),
+            'host': socket.gethostname(),
+            'python': platform.python_version(),
+        }
+
+    def measure(self, target, op, size, run):
+        '''Times run() repeat times and records the result; run returns the bytes it moved'''
+        timings = []
+        for i in range(self.repeat):
+            start = default_timer()
+            moved = run(i)
+            timings.append(default_timer() - start)
+            if moved != size:
+                raise CommandError('%s %s of %d bytes moved %d' % (target, op, size, moved))
+        total = sum(timings)
+        result = dict(self.run_info,
+                      target=target,
+                      op=op,
+                      size=size,
+                      repeat=self.repeat,
+                      mb_s=round(size * self.repeat / total / UNITS['M'], 3) if total else None,
+                      p50_ms=round(percentile(timings, 50) * 1000, 3),
+                      p99_ms=round(percentile(timings, 99) * 1000, 3)
+                             if self.repeat >= P99_MIN_REPEAT else None,
+                      max_ms=round(max(timings) * 1000, 3))
+        self.results.append(result)
+        if self.options['output'] != '-':
+            self.stdout.write('%-24s %-8s %8s %10s MB/s  p50 %10.3f ms  p99 %10s ms  max %10.3f ms\n' % (
+                target, op, format_size(size), result['mb_s'], result['p50_ms'],
+                '%.3f' % result['p99_ms'] if result['p99_ms'] is not None else '-',
+                result['max_ms']))
+        return result
+
+    def consume(self, f, block_size):
+        size = 0
+        try:
+            for data in chunks(f, block_size):
+                size += len(data)
+        finally:
+            f.close()
+        return size
+
+    def bench_destination(self, destination, target=None):
+        target = target or '%s:%s' % (destination.__class__.__name__, destination.name)
+        subdir = 'benchmark'
+        for size in self.sizes:
+            names = ['%s_%d' % (format_size(size), i) for i in range(self.repeat)]
+
+            def backup(i):
+                source = PatternFile(size)
+                if not destination.backup(source, subdir, names[i]):
+                    raise CommandError('%s backup of %s failed' % (target, names[i]))
+                return source.position
+
+            def restore(i):
+                contents, success = destination.restore(subdir, names[i])
+                if not success:
+                    raise CommandError('%s restore of %s failed' % (target, names[i]))
+                return self.consume(contents, destination.block_size)
+
+            try:
+                self.measure(target, 'backup', size, backup)
+                self.measure(target, 'restore', size, restore)
+            finally:
+                destination.remove(subdir, names)
+
+    def bench_sftp_standin(self, tmp):
+        '''SFTPDestination against a stand-in on this machine, behind the given link'''
+        options = self.options
+        bandwidth = parse_size(options['bandwidth']) if options['bandwidth'] else None
+        key_filename = os.path.join(tmp, 'benchmark_rsa.key')
+        paramiko.RSAKey.generate(1024).write_private_key_file(key_filename)
+        with SFTPStandIn(os.path.join(tmp, 'sftp'), latency=options['latency'] / 1000.0,
+                         bandwidth=bandwidth) as server:
+            #never saved, the stand-in is gone with the run
+            destination = SFTPDestination(name='benchmark', hostname=server.host,
+                                          port=str(server.port), username='benchmark',
+                                          key_filename=key_filename,
+                                          streams=max(1, options['sftp_streams']))
+            try:
+                self.bench_destination(destination, 'SFTPStandIn:%gms,%s,x%d' % (
+                    options['latency'], format_size(bandwidth) if bandwidth else '-',
+                    destination.streams))
+            finally:
+                sftppool.clear()
+        if options['output'] != '-':
+            self.stdout.write('stand-in: %s\n' % ', '.join(
+                '%s %d' % item for item in sorted(server.stats.items())))
+
+    def bench_http(self, user, destination):
+        client = APIClient()
+        client.force_authenticate(user=user)
+        max_size = parse_size(self.options['http_max_size'])
+        #the test client's host name, whatever the deployment allows
+        with override_settings(ALLOWED_HOSTS=['testserver']):
+            for size in self.sizes:
+                if size > max_size:
+                    continue
+                names = ['%s_%d' % (format_size(size), i) for i in range(self.repeat)]
+                body = PatternFile(size).read()
+                ids = []
+
+                def upload(i):
+                    f = BytesIO(body)
+                    f.name = names[i]
+                    response = client.post('/backups/?upload=stream&name=%s&destination=%s' % (
+                                           names[i], destination.name), {'file': f}, format='multipart')
+                    if response.status_code != 201:
+                        raise CommandError('POST /backups/ returned %d' % response.status_code)
+                    ids.append(response.data['id'])
+                    return size
+
+                def download(i):
+                    response = client.get('/backups/%d/?fileformat=raw' % ids[i])
+                    if response.status_code != 200:
+                        raise CommandError('GET ?fileformat=raw returned %d' % response.status_code)
+                    try:
+                        return sum(len(data) for data in response.streaming_content)
+                    finally:
+                        response.close()
+
+                self.measure('http', 'upload', size, upload)
+                self.measure('http', 'download', size, download)
+                destination.remove(user.username, names)
+                Backup.objects.filter(id__in=ids).delete()
+
+    def write_results(self):
+        if self.options['output']:
+            out = self.stdout if self.options['output'] == '-' else open(self.options['output'], 'w')
+            try:
+                for result in self.results:
+                    out.write(json.dumps(result, sort_keys=True) + '\n')
+            finally:
+                if out is not self.stdout:
+                    out.close()
+        if self.options['baseline']:
+            self.compare(self.options['baseline'])
+
+    def compare(self, fn):
+        key = lambda result: (result['target'], result['op'], result['size'])
+        with open(fn) as f:
+            baseline = dict((key(result), result) for result in
+                            (json.loads(line) for line in f if line.strip()))
+        self.stdout.write('\nagainst %s (%s)\n' % (fn, ', '.join(sorted(set(
+            str(result.get('commit')) for result in baseline.values())))))
+        for result in self.results:
+            before = baseline.get(key(result))
+            if not before or not before['mb_s'] or not result['mb_s']:
+                continue
+            #the tail compared is p99 when both runs have one, the slowest run otherwise
+            tail = 'p99' if result['p99_ms'] and before.get('p99_ms') else 'max'
+            self.stdout.write('%-24s %-8s %8s %+8.1f%% MB/s  %s %+8.1f%%\n' % (
+                result['target'], result['op'], format_size(result['size']),
+                (result['mb_s'] / before['mb_s'] - 1) * 100, tail,
+                (result[tail + '_ms'] / before[tail + '_ms'] - 1) * 100
+                if before.get(tail + '_ms') else 0))
@@ -0,0 +1,28 @@
+#-*- coding: utf-8 -*-
+
+from optparse import make_option
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from server.models import DedupDestination
+
+class Command(BaseCommand):
+    help = ('Removes the chunks of dedup destinations that no manifest lists any more, '
+            'e.g. after manage.py prune, and the files of interrupted writes')
+    option_list = BaseCommand.option_list + (
+        make_option('--destination', action='append', dest='destinations', default=[],
+                    help='Only collect this destination (repeatable)'),
+        make_option('--grace', type='int', dest='grace',
+                    default=getattr(settings, 'DEDUP_GC_GRACE', 3600),
+                    help='Seconds files are kept after they were written, for writes under way'),
+    )
+
+    def handle(self, *args, **options):
+        destinations = DedupDestination.objects.order_by('id')
+        if options['destinations']:
+            destinations = destinations.filter(name__in=options['destinations'])
+        for destination in destinations:
+            removed, freed = destination.collect_garbage(options['grace'])
+            self.stdout.write('%s: %d files removed, %d bytes freed\n' % (
+                destination.name, removed, freed))
@@ -0,0 +1,37 @@
+#-*- coding: utf-8 -*-
+
+from optparse import make_option
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand
+
+from server.models import Backup, RetentionPolicy
+
+class Command(BaseCommand):
+    help = 'Deletes the backups no retention policy keeps, from their destinations and the database'
+    option_list = BaseCommand.option_list + (
+        make_option('--user', action='append', dest='users', default=[],
+                    help='Only prune the backups of this username (repeatable)'),
+        make_option('--batch-size', type='int', dest='batch_size',
+                    default=getattr(settings, 'PRUNE_BATCH_SIZE', 500),
+                    help='Backups removed and deleted at a time'),
+        make_option('--dry-run', action='store_true', dest='dry_run', default=False,
+                    help='Only list the backups that would be pruned'),
+    )
+
+    def handle(self, *args, **options):
+        users = User.objects.filter(id__in=Backup.objects.values('user'))
+        if options['users']:
+            users = users.filter(username__in=options['users'])
+        total = 0
+        for user in users.order_by('id'):
+            pruned = RetentionPolicy.prune(user, options['batch_size'], options['dry_run'])
+            if options['dry_run']:
+                for backup_id in pruned:
+                    self.stdout.write('backup %d\n' % backup_id)
+            if pruned:
+                self.stdout.write('%s: %d backups %s\n' % (
+                    user.username, len(pruned), 'to prune' if options['dry_run'] else 'pruned'))
+            total += len(pruned)
+        self.stdout.write('%d backups %s\n' % (total, 'to prune' if options['dry_run'] else 'pruned'))
@@ -0,0 +1,69 @@
+#-*- coding: utf-8 -*-
+
+import time
+import logging
+import threading
+from optparse import make_option
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import connection, close_old_connections
+
+from server.models import TransferJob
+
+class Command(BaseCommand):
+    help = 'Runs deferred backup transfers with a bounded pool of worker threads'
+    option_list = BaseCommand.option_list + (
+        make_option('--workers', type='int', dest='workers',
+                    default=getattr(settings, 'TRANSFER_WORKERS', 4),
+                    help='Number of concurrent transfers'),
+        make_option('--poll', type='float', dest='poll', default=2.0,
+                    help='Seconds to wait when the queue is empty'),
+        make_option('--once', action='store_true', dest='once', default=False,
+                    help='Exit once the queue is empty'),
+    )
+
+    def handle(self, *args, **options):
+        self.poll = options['poll']
+        self.once = options['once']
+        self.stopping = threading.Event()
+
+        self.requeue()
+        workers = [threading.Thread(target=self.work, name='transfer-%d' % i)
+                   for i in range(options['workers'])]
+        for worker in workers:
+            worker.daemon = True
+            worker.start()
+        requeued = time.time()
+        try:
+            while any(worker.is_alive() for worker in workers):
+                time.sleep(0.5)
+                #jobs of workers that died elsewhere, while this one runs
+                if time.time() - requeued >= self.poll:
+                    self.requeue()
+                    requeued = time.time()
+        except KeyboardInterrupt:
+            self.stopping.set()
+            for worker in workers:
+                worker.join()
+
+    def requeue(self):
+        close_old_connections()
+        try:
+            TransferJob.requeue_stale()
+        except Exception, e:
+            logging.exception(e)
+
+    def work(self):
+        while not self.stopping.is_set():
+            close_old_connections()
+            job = TransferJob.claim()
+            if job is None:
+                if self.once:
+                    break
+                self.stopping.wait(self.poll)
+                continue
+            logging.info('transfer job %d: backup %d', job.id, job.backup_id)
+            job.run()
+            self.stdout.write('job %d %s\n' % (job.id, job.status))
+        connection.close()
@@ -0,0 +1,99 @@
+#-*- coding: utf-8 -*-
+
+import time
+import logging
+import threading
+from datetime import timedelta
+from optparse import make_option
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import connection, close_old_connections
+from django.utils import timezone
+
+from server.models import Backup, BaseDestination, Replica
+from server.models.destination.streams import RateLimiter
+
+class Command(BaseCommand):
+    help = ('Verifies stored backups against their checksums, least recently '
+            'verified first, at a bounded rate per destination, and retries '
+            'the failed replicas, dropping those failing for longer than --replica-max-age')
+    option_list = BaseCommand.option_list + (
+        make_option('--rate', type='int', dest='rate',
+                    default=getattr(settings, 'SCRUB_RATE', 10 * 1024 * 1024),
+                    help='Bytes per second read from each destination (0 for no limit)'),
+        make_option('--concurrency', type='int', dest='concurrency',
+                    default=getattr(settings, 'SCRUB_CONCURRENCY', 1),
+                    help='Backups verified at once on each destination'),
+        make_option('--interval', type='int', dest='interval',
+                    default=getattr(settings, 'SCRUB_INTERVAL', 7 * 24 * 3600),
+                    help='Seconds before a verified backup is due again'),
+        make_option('--replica-max-age', type='int', dest='replica_max_age',
+                    default=getattr(settings, 'REPLICA_RETRY_MAX_AGE', 7 * 24 * 3600),
+                    help='Seconds a failed replica is retried before its row is deleted'),
+        make_option('--destination', action='append', dest='destinations', default=[],
+                    help='Only scrub this destination (repeatable)'),
+        make_option('--loop', action='store_true', dest='loop', default=False,
+                    help='Keep running, checking for due backups every --poll seconds'),
+        make_option('--poll', type='float', dest='poll', default=600.0,
+                    help='Seconds between passes with --loop'),
+    )
+
+    def handle(self, *args, **options):
+        self.options = options
+        self.stopping = threading.Event()
+        try:
+            while True:
+                self.retry_replicas()
+                self.scrub()
+                if not options['loop'] or self.stopping.wait(options['poll']):
+                    break
+        except KeyboardInterrupt:
+            self.stopping.set()
+
+    def retry_replicas(self):
+        retried, copied, deleted = Replica.retry_failed(self.options['replica_max_age'])
+        if retried or deleted:
+            self.stdout.write('replicas: %d retried, %d copied, %d given up\n' % (
+                retried, copied, deleted))
+
+    def scrub(self):
+        destinations = BaseDestination.objects.all()
+        if self.options['destinations']:
+            destinations = destinations.filter(name__in=self.options['destinations'])
+        verified_before = timezone.now() - timedelta(seconds=self.options['interval'])
+
+        workers = []
+        for destination in destinations:
+            queue = iter(Backup.scrub_queue(destination, verified_before))
+            #the workers of a destination share its queue and its budget
+            lock = threading.Lock()
+            limiter = RateLimiter(self.options['rate']) if self.options['rate'] else None
+            for i in range(self.options['concurrency']):
+                workers.append(threading.Thread(target=self.work, args=(queue, lock, limiter),
+                                                name='scrub-%s-%d' % (destination.name, i)))
+        for worker in workers:
+            worker.daemon = True
+            worker.start()
+        #polled rather than joined, so KeyboardInterrupt gets through
+        while any(worker.is_alive() for worker in workers):
+            time.sleep(0.5)
+
+    def work(self, queue, lock, limiter):
+        while not self.stopping.is_set():
+            with lock:
+                backup_id = next(queue, None)
+            if backup_id is None:
+                break
+            close_old_connections()
+            try:
+                backup = Backup.objects.select_related('user', 'destination').get(id=backup_id)
+            except Backup.DoesNotExist:
+                continue
+            error = backup.verify(limiter)
+            if error is None:
+                self.stdout.write('backup %d ok\n' % backup.id)
+            else:
+                logging.error('backup %d failed verification: %s', backup.id, error)
+                self.stdout.write('backup %d FAILED: %s\n' % (backup.id, error))
+        connection.close()
@@ -0,0 +1,321 @@
+#-*- coding: utf-8 -*-
+
+import time
+import bisect
+import threading
+
+#seconds, from a small file on a local disk to hours over a slow link
+DURATION_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10,
+                    30, 60, 120, 300, 600, 1800, 3600, 7200)
+#bytes, 1KB to 16GB in powers of 4
+SIZE_BUCKETS = tuple(1024 * 4 ** i for i in range(13))
+QUERY_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100, 200, 500)
+
+def _escape(value):
+    return unicode(value).replace('\\', r'\\').replace('\n', r'\n').replace('"', r'\"')
+
+def _labels(names, values, extra=()):
+    pairs = zip(names, values) + list(extra)
+    if not pairs:
+        return ''
+    return '{%s}' % ','.join('%s="%s"' % (name, _escape(value)) for name, value in pairs)
+
+def _number(value):
+    if value == float('inf'):
+        return '+Inf'
+    if isinstance(value, (int, long)):
+        return str(value)
+    return repr(float(value))
+
+class Metric(object):
+    '''
+        Values of one metric by label values, kept in process. Label
+        values are given as keyword arguments, all of them every time.
+    '''
+
+    kind = None
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.lock = threading.Lock()
+        self.values = {}
+
+    def key(self, labels):
+        try:
+            return tuple(labels.pop(name) for name in self.labels)
+        except KeyError, e:
+            raise ValueError('%s needs the label %s' % (self.name, e))
+
+    def samples(self):
+        '''(suffix, label values, extra labels, value) to expose'''
+        with self.lock:
+            return [('', key, (), value) for key, value in sorted(self.values.items())]
+
+    def clear(self):
+        with self.lock:
+            self.values = {}
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self.key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def get(self, **labels):
+        return self.values.get(self.key(labels), 0)
+
+class Gauge(Counter):
+    kind = 'gauge'
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+    def set(self, value, **labels):
+        key = self.key(labels)
+        with self.lock:
+            self.values[key] = value
+
+class Histogram(Metric):
+    '''Counts observations in cumulative buckets, Prometheus style, with their sum'''
+
+    kind = 'histogram'
+
+    def __init__(self, name, help, labels=(), buckets=DURATION_BUCKETS):
+        super(Histogram, self).__init__(name, help, labels)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, **labels):
+        key = self.key(labels)
+        i = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            counts = self.values.get(key)
+            if counts is None:
+                #one count per bucket, +Inf, then the sum
+                counts = self.values[key] = [0] * (len(self.buckets) + 1) + [0]
+            counts[i] += 1
+            counts[-1] += value
+
+    def get(self, **labels):
+        '''(count, sum) of the observations'''
+        counts = self.values.get(self.key(labels))
+        return (sum(counts[:-1]), counts[-1]) if counts else (0, 0)
+
+    def samples(self):
+        samples = []
+        with self.lock:
+            items = sorted((key, list(counts)) for key, counts in self.values.items())
+        for key, counts in items:
+            total = 0
+            for le, count in zip(self.buckets + (float('inf'),), counts):
+                total += count
+                samples.append(('_bucket', key, (('le', _number(le)),), total))
+            samples.append(('_sum', key, (), counts[-1]))
+            samples.append(('_count', key, (), total))
+        return samples
+
+class Registry(object):
+    '''
+        Metrics of this process, rendered in the Prometheus text format.
+        Collectors are called on every render, for values that are read
+        rather than counted (pool sizes, etc.); they return
+        [(name, kind, help, [({label: value}, value), ...]), ...].
+    '''
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.metrics = []
+        self.collectors = []
+
+    def register(self, metric):
+        with self.lock:
+            self.metrics.append(metric)
+        return metric
+
+    def counter(self, *args, **kwargs):
+        return self.register(Counter(*args, **kwargs))
+
+    def gauge(self, *args, **kwargs):
+        return self.register(Gauge(*args, **kwargs))
+
+    def histogram(self, *args, **kwargs):
+        return self.register(Histogram(*args, **kwargs))
+
+    def collector(self, function):
+        with self.lock:
+            self.collectors.append(function)
+        return function
+
+    def clear(self):
+        for metric in self.metrics:
+            metric.clear()
+
+    def render(self):
+        lines = []
+        for metric in self.metrics:
+            lines.append('# HELP %s %s' % (metric.name, metric.help))
+            lines.append('# TYPE %s %s' % (metric.name, metric.kind))
+            for suffix, key, extra, value in metric.samples():
+                lines.append('%s%s%s %s' % (metric.name, suffix,
+                                            _labels(metric.labels, key, extra), _number(value)))
+        for collector in self.collectors:
+            for name, kind, help, samples in collector():
+                lines.append('# HELP %s %s' % (name, help))
+                lines.append('# TYPE %s %s' % (name, kind))
+                for labels, value in samples:
+                    names = sorted(labels)
+                    lines.append('%s%s %s' % (name, _labels(names, [labels[n] for n in names]),
+                                              _number(value)))
+        return (u'\n'.join(lines) + u'\n').encode('utf-8')
+
+registry = Registry()
+
+TRANSFER_LABELS = ('operation', 'destination', 'type')
+
+transfer_seconds = registry.histogram(
+    'tbackup_transfer_seconds',
+    'Duration of backups (the whole upload) and restores (until the file is closed)',
+    TRANSFER_LABELS)
+transfer_bytes = registry.histogram(
+    'tbackup_transfer_bytes',
+    'Bytes of successful backups and restores',
+    TRANSFER_LABELS, SIZE_BUCKETS)
+transfers = registry.counter(
+    'tbackup_transfers_total',
+    'Finished backups and restores, by outcome (success or failure)',
+    TRANSFER_LABELS + ('outcome',))
+transfers_in_flight = registry.gauge(
+    'tbackup_transfers_in_flight',
+    'Backups and restores under way',
+    TRANSFER_LABELS)
+sftp_connect_seconds = registry.histogram(
+    'tbackup_sftp_connect_seconds',
+    'SSH connection and authentication time of SFTP destinations',
+    ('destination',))
+sftp_connect_failures = registry.counter(
+    'tbackup_sftp_connect_failures_total',
+    'SSH connections of SFTP destinations that failed',
+    ('destination',))
+request_seconds = registry.histogram(
+    'tbackup_http_request_seconds',
+    'Time to the response of API requests, by URL name; streamed bodies are not included',
+    ('endpoint', 'method'))
+requests = registry.counter(
+    'tbackup_http_requests_total',
+    'API requests by URL name and status',
+    ('endpoint', 'method', 'status'))
+request_queries = registry.histogram(
+    'tbackup_http_db_queries',
+    'Database queries per API request, by URL name',
+    ('endpoint', 'method'), QUERY_BUCKETS)
+
+class Transfer(object):
+    '''
+        A backup or restore of destination under way: counted in flight
+        until done() records its outcome, duration and size
+    '''
+
+    def __init__(self, operation, destination):
+        self.labels = {'operation': operation,
+                       'destination': destination.name,
+                       'type': destination.type}
+        self.start = time.time()
+        self.finished = False
+        transfers_in_flight.inc(**self.labels)
+
+    def done(self, size, success):
+        if self.finished:
+            return
+        self.finished = True
+        transfers_in_flight.dec(**self.labels)
+        transfers.inc(outcome='success' if success else 'failure', **self.labels)
+        if success:
+            transfer_seconds.observe(time.time() - self.start, **self.labels)
+            transfer_bytes.observe(size, **self.labels)
+
+class MeteredFile(object):
+    '''
+        Restored file that records its Transfer when it is closed: a
+        failure if reading it raised, a success otherwise. Models import
+        this module, so it does not build on their ClosingFile.
+    '''
+
+    chunk_size = 64 * 1024
+
+    def __init__(self, f, transfer):
+        self.f = f
+        self.transfer = transfer
+        self.size = 0
+        self.failed = False
+        self.closed = False
+
+    def __getattr__(self, attr):
+        return getattr(self.f, attr)
+
+    def __iter__(self):
+        return iter(lambda: self.read(self.chunk_size), '')
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def read(self, *args):
+        try:
+            data = self.f.read(*args)
+        except:
+            self.failed = True
+            raise
+        self.size += len(data)
+        return data
+
+    def readinto(self, b):
+        if not hasattr(self.f, 'readinto'):
+            data = self.read(len(b))
+            b[:len(data)] = data
+            return len(data)
+        try:
+            n = self.f.readinto(b)
+        except:
+            self.failed = True
+            raise
+        self.size += n
+        return n
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        try:
+            self.f.close()
+        except:
+            self.failed = True
+            raise
+        finally:
+            self.transfer.done(self.size, not self.failed)
+
+@registry.collector
+def pools():
+    from .models.destination.buffers import pool as buffers
+    from .models.destination.sftppool import pool as sftp
+    from .models.destination.httppool import pool as http
+    stats = buffers.stats()
+    return [
+        ('tbackup_buffers', 'gauge', 'Pooled copy buffers, by state',
+         [({'state': 'in_use'}, stats['in_use']), ({'state': 'idle'}, stats['idle'])]),
+        ('tbackup_buffers_allocated_bytes_total', 'counter', 'Bytes of copy buffers ever allocated',
+         [({}, stats['allocated_bytes'])]),
+        ('tbackup_buffers_reused_total', 'counter', 'Copy buffers taken from the pool',
+         [({}, stats['reused'])]),
+        ('tbackup_copied_bytes_total', 'counter', 'Bytes copied through pooled buffers',
+         [({}, stats['copied_bytes'])]),
+        ('tbackup_sftp_sessions', 'gauge', 'Open SFTP sessions, by state',
+         [({'state': 'in_use'}, len(sftp.in_use)),
+          ({'state': 'idle'}, sum(len(sessions) for sessions in sftp.idle.values()))]),
+        ('tbackup_http_pool_connections', 'gauge', 'Idle keep-alive connections to HTTP object stores',
+         [({}, sum(len(conns) for conns in http.idle.values()))]),
+    ]
@@ -0,0 +1,135 @@
+#-*- coding: utf-8 -*-
+
+import time
+
+from django.conf import settings
+from django.db import connections, DEFAULT_DB_ALIAS
+
+from . import metrics, tracing
+
+class CountingCursor(object):
+    '''Cursor that counts its executions on its connection, and nothing else'''
+
+    def __init__(self, cursor, db):
+        self.cursor = cursor
+        self.db = db
+
+    def __getattr__(self, attr):
+        return getattr(self.cursor, attr)
+
+    def __iter__(self):
+        return iter(self.cursor)
+
+    def execute(self, *args, **kwargs):
+        self.db.queries_executed += 1
+        return self.cursor.execute(*args, **kwargs)
+
+    def executemany(self, *args, **kwargs):
+        self.db.queries_executed += 1
+        return self.cursor.executemany(*args, **kwargs)
+
+def counted(db):
+    '''
+        db (a connection of this thread) with its cursors counting their
+        queries in db.queries_executed; unlike the debug cursor, the SQL
+        is neither formatted, logged nor kept
+    '''
+    if not hasattr(db, 'queries_executed'):
+        cursor = db.cursor
+        db.queries_executed = 0
+        db.cursor = lambda: CountingCursor(cursor(), db)
+    return db
+
+class MetricsMiddleware(object):
+    '''
+        Times requests and counts their database queries, by the URL name
+        they resolved to (e.g. backup-detail), so the metrics have a label
+        per endpoint rather than per path. Queries are counted while the
+        view runs; queries made while a streamed body is sent are not.
+    '''
+
+    def process_request(self, request):
+        db = counted(connections[DEFAULT_DB_ALIAS])
+        request._metrics = (time.time(), db, db.queries_executed)
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        match = getattr(request, 'resolver_match', None)
+        request._metrics_endpoint = (match and match.url_name) or view_func.__name__
+
+    def process_response(self, request, response):
+        start = getattr(request, '_metrics', None)
+        if start is None:
+            return response
+        del request._metrics
+        started, db, queries = start
+        labels = {'endpoint': getattr(request, '_metrics_endpoint', 'unresolved'),
+                  'method': request.method}
+        metrics.request_seconds.observe(time.time() - started, **labels)
+        metrics.request_queries.observe(db.queries_executed - queries, **labels)
+        metrics.requests.inc(status=response.status_code, **labels)
+        return response
+
+class TraceCloser(object):
+    '''Ends the send span and the trace of a streamed response when it is closed'''
+
+    def __init__(self, trace, send):
+        self.trace = trace
+        self.send = send
+        self.closed = False
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        if self.send is not None:
+            self.trace.pop(self.send)
+        TracingMiddleware.finish(self.trace)
+
+class TracingMiddleware(object):
+    '''
+        Traces requests as a tree of spans (see tracing.py): all of them
+        when TRACING is set, otherwise those sent with an X-Trace: 1
+        header. The tree is logged when the request takes
+        TRACE_SLOW_REQUEST seconds or more, or was forced by the header;
+        forced ones also get X-Trace-Id and Server-Timing headers. A
+        streamed body is traced, as a send span, until it is closed.
+    '''
+
+    def process_request(self, request):
+        forced = request.META.get('HTTP_X_TRACE', '').lower() in ('1', 'true', 'yes')
+        if forced or getattr(settings, 'TRACING', False):
+            tracing.start('%s %s' % (request.method, request.path), forced,
+                          getattr(settings, 'TRACE_MAX_SPANS', 1000))
+        else:
+            tracing.stop()
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        trace = tracing.current()
+        if trace is not None:
+            match = getattr(request, 'resolver_match', None)
+            trace.root.tags['view'] = (match and match.url_name) or view_func.__name__
+
+    def process_response(self, request, response):
+        trace = tracing.current()
+        if trace is None:
+            return response
+        trace.root.tags['status'] = response.status_code
+        if trace.forced:
+            response['X-Trace-Id'] = trace.id
+            timing = trace.server_timing()
+            if timing:
+                response['Server-Timing'] = timing
+        if response.streaming:
+            #the body is read, and the trace goes on, after this returns
+            response._closable_objects.append(TraceCloser(trace, trace.push('send', {})))
+        else:
+            self.finish(trace)
+        return response
+
+    @staticmethod
+    def finish(trace):
+        if tracing.current() is trace:
+            tracing.stop()
+        else:
+            trace.finish()
+        tracing.log(trace, getattr(settings, 'TRACE_SLOW_REQUEST', 10.0))
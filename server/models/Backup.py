@@ -1,15 +1,27 @@
 #-*- coding: utf-8 -*-
 
 import os
+import uuid
+import logging
 from datetime import datetime
 
 from django.db import models
 from django.conf import settings
 from django.utils import timezone
 from django.contrib.auth.models import User
+from django.core.files import File
 
 from .Origin import Origin
+from .Replica import ReplicationPolicy, Replica
 from .destination.BaseDestination import BaseDestination
+from .destination.LocalDestination import LocalDestination
+from .destination.streams import TeeWriter, NullWriter
+from .destination.compression import CompressingWriter, decompressing
+from .destination.checksums import HashingWriter, VerifyingFile, verifier
+from .destination.delta import DeltaWriter, SignatureCache, signature, patched
+from .destination.buffers import copy, chunks
+from ..metrics import Transfer, MeteredFile
+from ..tracing import span, traced
 
 from .mixins import (
     NameableMixin,
@@ -25,6 +37,43 @@ class Backup(NameableMixin, LoggableMixin, models.Model):
     obs         = models.TextField(null=True,
                                    blank=True)
     file = models.FileField(upload_to='./test_backup/', null=True)
+    #codec the stored file was compressed with ('' when stored as sent)
+    #and the uncompressed size
+    codec       = models.CharField(verbose_name=u'compressão',
+                                   max_length=10,
+                                   blank=True,
+                                   default=u'')
+    size        = models.BigIntegerField(verbose_name=u'tamanho',
+                                         null=True,
+                                         blank=True)
+    #checksums of the uncompressed contents, blake2b when a module has it
+    sha256      = models.CharField(max_length=64,
+                                   blank=True,
+                                   default=u'')
+    blake2b     = models.CharField(max_length=128,
+                                   blank=True,
+                                   default=u'')
+    #last check of the stored file against its checksum (manage.py scrub)
+    verified_at     = models.DateTimeField(verbose_name=u'última verificação',
+                                           null=True,
+                                           blank=True,
+                                           db_index=True)
+    verify_failures = models.PositiveIntegerField(verbose_name=u'falhas de verificação',
+                                                  default=0)
+    verify_error    = models.TextField(null=True,
+                                       blank=True)
+    #incremental backups: name of the stored file when it is not the
+    #backup's, and the previous version the stored file is a delta
+    #against, chain deltas away from a full copy
+    filename    = models.CharField(verbose_name=u'arquivo',
+                                   max_length=1100,
+                                   blank=True,
+                                   default=u'')
+    parent      = models.ForeignKey('Backup',
+                                    related_name='deltas',
+                                    null=True,
+                                    blank=True)
+    chain       = models.PositiveSmallIntegerField(default=0)
     
     '''Restore data and consequences:
             (date,
@@ -42,6 +91,19 @@ class Backup(NameableMixin, LoggableMixin, models.Model):
     class Meta:
         app_label = 'server'
         #unique_together = ('name', 'origin', 'destination', 'date')
+        index_together = [
+            ('user', 'date'),
+            ('user', 'name'),
+        ]
+    
+    def save(self, *args, **kwargs):
+        with span('backup.save', created=self.pk is None):
+            if self.file and not self.file._committed:
+                #what the field would do while saving, done first so the
+                #staging write is timed apart from the query
+                with span('stage'):
+                    self.file.save(self.file.name, self.file, save=False)
+            return super(Backup, self).save(*args, **kwargs)
     
     def backup(self, contents, before_restore=False, after_restore=False):
         #shortcut
@@ -55,12 +117,7 @@ class Backup(NameableMixin, LoggableMixin, models.Model):
             self.save()
             return True
         
-        success = self.destination.backup(
-            #subdir = self.origin.name,
-            subdir = self.user.username,
-            filename = self.name,
-            contents = contents
-        )
+        success = self.write(contents)
         if success:
             self.success = True
             if before_restore:
@@ -70,30 +127,314 @@ class Backup(NameableMixin, LoggableMixin, models.Model):
             self.save()
         return success
     
-    def restore(self):
+    @traced('backup.transfer')
+    def transfer(self):
+        '''
+            Sends the staged upload to the destination and removes it once
+            it is there; after a failure it is kept for another attempt
+        '''
+        success = self.backup(File(self.file))
+        if success:
+            self.discard_staged()
+        return success
+    
+    def discard_staged(self):
+        '''Removes the staged upload'''
+        if not self.file:
+            return
+        if os.path.isfile(self.file.path):
+            os.remove(self.file.path)
+        self.file = None
+        self.save()
+    
+    @property
+    def stored_name(self):
+        return self.filename or self.name
+    
+    def delta_base(self):
+        '''
+            Latest stored version of this backup to write a delta against,
+            None when the destination is not incremental or the chain is
+            as long as it allows
+        '''
+        limit = self.destination.delta_chain
+        if not limit:
+            return None
+        previous = (Backup.objects
+                    .filter(user=self.user_id, name=self.name, destination=self.destination_id,
+                            success=True)
+                    .exclude(filename=u'')
+                    .exclude(id=self.id)
+                    .order_by('-date', '-id')
+                    .first())
+        if previous is None or previous.chain >= limit:
+            return None
+        return previous
+    
+    def replica_destinations(self):
+        return list(ReplicationPolicy.replicas_for(self.user, self.destination))
+    
+    #error of the last failed write(), for the caller to report
+    write_error = None
+    
+    def write(self, contents, replicas=None, stored=False):
+        transfer = Transfer('backup', self.destination)
+        self.write_error = None
+        try:
+            with span('backup.write'):
+                with self.writer(replicas, stored) as f:
+                    with span('copy') as s:
+                        size = copy(contents, f, self.destination.block_size)
+                        if s is not None:
+                            s.tags['bytes'] = size
+        except Exception, e:
+            logging.exception('backup of %s to %s failed', self.name, self.destination.name)
+            self.write_error = e
+            transfer.done(0, False)
+            return False
+        transfer.done(size, True)
+        return True
+    
+    def writer(self, replicas=None, stored=False):
+        '''
+            Opens the backup file on the destination. When replication
+            policies apply, the returned writer tees the stream to every
+            replica concurrently; their outcome is saved with the backup.
+            Destinations with compression get the stream compressed, the
+            codec actually used is set on the backup when it is closed,
+            along with the size and checksums of what was written.
+            On incremental destinations every version gets a file of its
+            own, holding the delta against the previous one when there is
+            one to build on.
+            With stored, the contents are already on the destination as
+            they are (e.g. a chunked upload's file): only their size and
+            checksums are taken and the replicas written.
+        '''
+        table = None
+        if self.destination.delta_chain and not stored:
+            #bases of deltas must never be overwritten
+            self.filename = u'%s.%s' % (self.name, uuid.uuid4().hex)
+            self.parent = self.delta_base()
+            block_size = getattr(settings, 'DELTA_BLOCK_SIZE', 8 * 1024)
+            try:
+                if self.parent is not None:
+                    with span('delta.signature'):
+                        table = self.delta_signature(self.parent, block_size)
+            except Exception, e:
+                #a base that does not verify gets a full copy after it
+                logging.error('backup %d can not be a delta base: %s', self.parent.id, e)
+            if table is None:
+                self.parent = None
+            self.chain = self.parent.chain + 1 if self.parent is not None else 0
+        
+        destination_writer = lambda destination: destination.writer(
+            #subdir = self.origin.name,
+            subdir = self.user.username,
+            filename = self.stored_name
+        )
+        f = NullWriter() if stored else destination_writer(self.destination)
+        if replicas is None:
+            replicas = self.replica_destinations()
+        if replicas:
+            writers, opened, failed = [f], [], []
+            for destination in replicas:
+                try:
+                    writers.append(destination_writer(destination))
+                    opened.append(destination)
+                except Exception, e:
+                    failed.append((destination, e))
+            f = TeeWriter(writers, getattr(settings, 'REPLICATION_BUFFER_CHUNKS', 8))
+            self.replication = (f, opened, failed)
+        
+        #compressed once, before the stream is teed
+        if self.destination.compression and not stored:
+            f = CompressingWriter(f,
+                                  self.destination.compression,
+                                  self.destination.compression_level,
+                                  getattr(settings, 'COMPRESSION_SKIP_ENTROPY', None),
+                                  on_close=self.compressed)
+        if table is not None:
+            f = DeltaWriter(f, table, block_size)
+        return HashingWriter(f, on_close=self.hashed)
+    
+    @staticmethod
+    def delta_signature(base, block_size):
+        '''
+            signature() of base, from DELTA_SIGNATURE_CACHE when it was
+            computed before. A cached table skips reading the base, and so
+            verifying it; scrub still does.
+        '''
+        directory = getattr(settings, 'DELTA_SIGNATURE_CACHE', None)
+        if not directory or not base.sha256:
+            f = base.open()
+            if f is None:
+                return None
+            try:
+                return signature(f, block_size)
+            finally:
+                f.close()
+        cache = SignatureCache(directory, getattr(settings, 'DELTA_SIGNATURE_CACHE_AGE', 7 * 24 * 3600))
+        return cache.get(base.sha256, block_size, base.open)
+    
+    def compressed(self, writer):
+        self.codec = writer.codec
+    
+    def hashed(self, writer):
+        self.size = writer.size
+        for name, digest in writer.digests.items():
+            setattr(self, name, digest)
+    
+    def replication_results(self):
+        '''(destination, error or None) for each replica of the last write'''
+        tee, opened, failed = self.replication
+        return [(destination, tee.errors[i + 1])
+                for i, destination in enumerate(opened)] + failed
+    
+    def restore(self, offset=0):
+        '''open(), metered until the returned file is closed'''
+        transfer = Transfer('restore', self.destination)
+        try:
+            contents = self.open(offset)
+        except:
+            transfer.done(0, False)
+            raise
+        if contents is None:
+            transfer.done(0, False)
+            return None
+        #resumed and parallel ranged downloads are not new restores
+        if not offset:
+            self.restored()
+        return MeteredFile(contents, transfer)
+    
+    @traced('backup.open')
+    def open(self, offset=0, seekable=False):
+        '''
+            Stored contents from offset, decompressed, patched onto their
+            base when stored as a delta and verified, or None. With
+            seekable, a stored file that is whole and uncompressed comes
+            seekable when its destination can (not verified then, as it
+            is not read through): deltas read their base where they point.
+        '''
+        #compressed streams are decompressed and deltas applied from their start
+        stored_offset = 0 if self.codec or self.parent_id else offset
         contents, success = self.destination.restore(
             #subdir = self.origin.name,
             subdir = self.user.username,
-            filename = self.name
+            filename = self.stored_name,
+            offset = stored_offset,
+            seekable = seekable and not (self.codec or self.parent_id)
         )
-        if success:
-            self.restore_dt = timezone.now()
-            self.obs = u'Tentativa de restauro na data %s' % (
-                self.restore_dt.strftime(settings.DT_FORMAT_VERBOSE))
-            self.save()
-            return contents
-        return None
+        if success and self.codec:
+            contents = decompressing(contents, self.codec, 0 if self.parent_id else offset)
+        if success and self.parent_id:
+            try:
+                base = self.parent.open(seekable=True)
+                if base is None:
+                    raise IOError('Base of the delta could not be opened')
+            except:
+                contents.close()
+                raise
+            contents = patched(base, contents, offset)
+        #only whole restores can be checked, as they stream out
+        if (success and not offset and verifier(self) and
+            not (seekable and getattr(contents, 'seekable', lambda: False)())):
+            contents = VerifyingFile(contents, self.size, *verifier(self))
+        return contents if success else None
+    
+    def verify(self, limiter=None, chunk_size=None):
+        '''
+            Reads the stored file back through its checksum, at the pace of
+            limiter, and records when and with what outcome on the row.
+            Consecutive failures are counted. Returns the error or None.
+        '''
+        error = None
+        try:
+            contents = self.open()
+            if contents is None:
+                raise IOError('Stored file could not be opened')
+            try:
+                for data in chunks(contents, chunk_size or self.destination.block_size):
+                    if limiter is not None:
+                        limiter.consume(len(data))
+            finally:
+                contents.close()
+        except Exception, e:
+            error = unicode(e) or e.__class__.__name__
+        
+        #only these columns, the row may be changing meanwhile
+        Backup.objects.filter(id=self.id).update(
+            verified_at=timezone.now(),
+            verify_error=error,
+            verify_failures=0 if error is None else models.F('verify_failures') + 1)
+        return error
+    
+    @classmethod
+    def scrub_queue(cls, destination, verified_before):
+        '''
+            Ids of the checksummed backups on destination that are due for
+            verification, never verified first, then least recently verified.
+            Verifying stamps verified_at, so an interrupted scrub resumes
+            where it stopped.
+        '''
+        backups = cls.objects.filter(destination=destination, success=True).exclude(sha256='')
+        never = backups.filter(verified_at__isnull=True).order_by('id')
+        stale = backups.filter(verified_at__lt=verified_before).order_by('verified_at', 'id')
+        return (list(never.values_list('id', flat=True)) +
+                list(stale.values_list('id', flat=True)))
+    
+    def stat(self):
+        '''(size, mtime) of the stored file, or None'''
+        if self.file:
+            return (self.file.size, int(os.path.getmtime(self.file.path)))
+        stat = self.destination.stat(
+            #subdir = self.origin.name,
+            subdir = self.user.username,
+            filename = self.stored_name
+        )
+        if stat and (self.codec or self.parent_id):
+            return (self.size, stat[1])
+        return stat
+    
+    def restored(self):
+        self.restore_dt = timezone.now()
+        self.obs = u'Tentativa de restauro na data %s' % (
+            self.restore_dt.strftime(settings.DT_FORMAT_VERBOSE))
+        self.save()
+    
+    def local_path(self):
+        '''Path of the stored file when it lives, whole and uncompressed, on a LocalDestination'''
+        destination = self.destination.destination_impl
+        if self.codec or self.parent_id or not isinstance(destination, LocalDestination):
+            return None
+        fn = destination.path(
+            #subdir = self.origin.name,
+            subdir = self.user.username,
+            filename = self.stored_name
+        )
+        return fn if os.path.isfile(fn) else None
 
 from django.db.models.signals import post_save
 from django.dispatch import receiver
-from django.core.files import File
 
 @receiver(post_save, sender=Backup)
 def backup_to_destination(sender, instance=None, created=False, **kwargs):
-    if created and instance.file:
-        instance.backup(File(instance.file))
-        if os.path.isfile(instance.file.path):
-            os.remove(instance.file.path)
-            instance.file = None
-            instance.save()
+    #deferred transfers are run later by a TransferJob
+    if created and instance.file and not getattr(instance, 'defer_transfer', False):
+        #nothing retries it
+        if not instance.transfer():
+            instance.discard_staged()
 
+@receiver(post_save, sender=Backup)
+def record_replicas(sender, instance=None, **kwargs):
+    replication = getattr(instance, 'replication', None)
+    if replication is None or not replication[0].closed:
+        return
+    results = instance.replication_results()
+    del instance.replication
+    Replica.objects.bulk_create([
+        Replica(backup=instance,
+                destination=destination,
+                success=error is None,
+                obs=unicode(error) if error is not None else None)
+        for destination, error in results
+    ])
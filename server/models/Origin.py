@@ -9,6 +9,7 @@ except ImportError:
     sha1 = sha.sha
     
 from django.db import models
+from django.contrib.auth.models import User
 
 from .mixins import (
     NameableMixin,
@@ -18,6 +19,11 @@ from .mixins import (
 class Origin(NameableMixin, LoggableMixin, models.Model):
     plan   = models.TextField(verbose_name=u"plano")
     apikey = models.CharField(max_length=256)
+    user   = models.ForeignKey(User,
+                               verbose_name=u"usuário",
+                               related_name='origins',
+                               null=True,
+                               blank=True)
     
     class Meta:
         verbose_name        = u"cliente"
@@ -0,0 +1,101 @@
+#-*- coding: utf-8 -*-
+
+import logging
+from datetime import timedelta
+
+from django.db import models
+from django.db.models import Q
+from django.conf import settings
+from django.utils import timezone
+from django.contrib.auth.models import User
+
+from .destination.BaseDestination import BaseDestination
+from .destination.buffers import copy
+
+from .mixins import (
+    NameableMixin,
+    LoggableMixin
+)
+
+class ReplicationPolicy(NameableMixin, LoggableMixin, models.Model):
+    '''
+        Backups sent to destination (by user, or by anyone when user is
+        empty) are also copied to the replicas, from the same upload stream
+    '''
+    user        = models.ForeignKey(User,
+                                    null=True,
+                                    blank=True)
+    destination = models.ForeignKey(BaseDestination,
+                                    related_name='replication_policies')
+    replicas    = models.ManyToManyField(BaseDestination,
+                                         related_name='replica_of_policies')
+
+    class Meta:
+        verbose_name = u'política de replicação'
+        verbose_name_plural = u'políticas de replicação'
+        app_label = 'server'
+
+    @classmethod
+    def replicas_for(cls, user, destination):
+        policies = cls.objects.filter(destination=destination).filter(
+            Q(user=user) | Q(user__isnull=True))
+        return (BaseDestination.objects
+                .filter(replica_of_policies__in=policies)
+                .exclude(id=destination.id)
+                .distinct())
+
+class Replica(LoggableMixin, models.Model):
+    '''Outcome of copying a backup to one of its replica destinations'''
+    backup      = models.ForeignKey('Backup', related_name='replicas')
+    destination = models.ForeignKey(BaseDestination)
+    success     = models.BooleanField(default=False)
+    obs         = models.TextField(null=True,
+                                   blank=True)
+
+    class Meta:
+        verbose_name = u'réplica'
+        app_label = 'server'
+
+    def retry(self):
+        '''Copies the stored file of the backup to this replica again'''
+        backup = self.backup
+        try:
+            contents, success = backup.destination.restore(subdir=backup.user.username,
+                                                           filename=backup.stored_name)
+            if not success:
+                raise IOError(u'Backup %d não pôde ser lido do destino' % backup.id)
+            try:
+                with self.destination.writer(subdir=backup.user.username,
+                                             filename=backup.stored_name) as f:
+                    copy(contents, f, self.destination.block_size)
+            finally:
+                contents.close()
+        except Exception, e:
+            logging.error('replica of backup %d to %s failed again: %s',
+                          backup.id, self.destination.name, e)
+            self.obs = unicode(e)
+        else:
+            self.success, self.obs = True, None
+        self.save()
+        return self.success
+
+    @classmethod
+    def retry_failed(cls, max_age=None):
+        '''
+            Retries the failed replicas, oldest first. Those that failed
+            for longer than max_age seconds (REPLICA_RETRY_MAX_AGE) are
+            given up and deleted instead. Returns the numbers of replicas
+            retried, copied and deleted.
+        '''
+        if max_age is None:
+            max_age = getattr(settings, 'REPLICA_RETRY_MAX_AGE', 7 * 24 * 3600)
+        failed = cls.objects.filter(success=False)
+        expired = failed.filter(date_created__lt=timezone.now() - timedelta(seconds=max_age))
+        deleted = expired.count()
+        expired.delete()
+        retried = copied = 0
+        for replica in (failed.select_related('backup__user', 'backup__destination', 'destination')
+                              .order_by('date_created', 'id')):
+            retried += 1
+            copied += replica.retry()
+        return retried, copied, deleted
@@ -0,0 +1,162 @@
+#-*- coding: utf-8 -*-
+
+import logging
+from itertools import groupby
+from operator import itemgetter
+from collections import defaultdict
+
+from django.db import models
+from django.db.models import Q
+from django.utils import timezone
+from django.contrib.auth.models import User
+
+from .Backup import Backup
+from .Replica import Replica
+from .destination.BaseDestination import BaseDestination
+
+from .mixins import (
+    NameableMixin,
+    LoggableMixin
+)
+
+#bucket of a backup date for each retention period
+PERIODS = (
+    ('keep_daily',   lambda date: date.date()),
+    ('keep_weekly',  lambda date: date.isocalendar()[:2]),
+    ('keep_monthly', lambda date: (date.year, date.month)),
+)
+
+class RetentionPolicy(NameableMixin, LoggableMixin, models.Model):
+    '''
+        Grandfather-father-son retention of the backups of user (anyone
+        when empty) on destination (any when empty): the newest backup of
+        each of the last keep_daily days, keep_weekly weeks and keep_monthly
+        months is kept, the others are pruned by manage.py prune. When
+        several policies apply, one naming the destination wins, then one
+        naming the user.
+    '''
+    user         = models.ForeignKey(User,
+                                     null=True,
+                                     blank=True)
+    destination  = models.ForeignKey(BaseDestination,
+                                     related_name='retention_policies',
+                                     null=True,
+                                     blank=True)
+    keep_daily   = models.PositiveIntegerField(verbose_name=u'diários',
+                                               default=7)
+    keep_weekly  = models.PositiveIntegerField(verbose_name=u'semanais',
+                                               default=4)
+    keep_monthly = models.PositiveIntegerField(verbose_name=u'mensais',
+                                               default=12)
+
+    class Meta:
+        verbose_name = u'política de retenção'
+        verbose_name_plural = u'políticas de retenção'
+        app_label = 'server'
+
+    @staticmethod
+    def choose(policies, destination_id):
+        candidates = [policy for policy in policies
+                      if policy.destination_id in (None, destination_id)]
+        if not candidates:
+            return None
+        return max(candidates, key=lambda policy: (policy.destination_id is not None,
+                                                   policy.user_id is not None,
+                                                   policy.id))
+
+    def expired(self, rows):
+        '''
+            Ids of the rows not kept; rows are (id, date, ...) tuples of one
+            destination, newest first. The newest one is always kept.
+        '''
+        kept = set(rows[:1])
+        for field, bucket in PERIODS:
+            keep, seen = getattr(self, field), set()
+            for row in rows:
+                if len(seen) >= keep:
+                    break
+                key = bucket(timezone.localtime(row[1]) if timezone.is_aware(row[1]) else row[1])
+                if key not in seen:
+                    seen.add(key)
+                    kept.add(row)
+        return [row[0] for row in rows if row not in kept]
+
+    @classmethod
+    def prune(cls, user, batch_size=500, dry_run=False):
+        '''
+            Deletes the backups of user that no policy keeps, returns their
+            ids. The delete set comes from one ordered query. Files, and
+            their successful replicas, are then removed in batches with one
+            remove() call per destination, and the rows of each batch with
+            one bulk delete; rows whose file could not be removed are kept
+            for the next run. Files still named by a kept backup, and
+            backups other backups refer to, are left alone, as are the
+            bases of every kept incremental backup.
+        '''
+        policies = list(cls.objects.filter(Q(user=user) | Q(user__isnull=True)))
+        if not policies:
+            return []
+
+        rows = (Backup.objects
+                .filter(user=user, success=True)
+                .order_by('destination', '-date', '-id')
+                .values_list('id', 'date', 'destination', 'name', 'filename', 'parent'))
+        referenced = set(Backup.objects.filter(user=user, related_to__isnull=False)
+                                       .values_list('related_to', flat=True))
+        expired, kept_files = [], set()
+        for destination_id, group in groupby(rows.iterator(), key=itemgetter(2)):
+            group = list(group)
+            policy = cls.choose(policies, destination_id)
+            dead = set(policy.expired(group)) - referenced if policy else set()
+            #a delta chain lives on one destination, kept down to its full copy
+            parents = dict((row[0], row[5]) for row in group)
+            for row in group:
+                parent = row[5] if row[0] not in dead else None
+                while parent in dead:
+                    dead.discard(parent)
+                    parent = parents.get(parent)
+            for row in group:
+                if row[0] in dead:
+                    expired.append(row)
+                else:
+                    kept_files.add((destination_id, row[4] or row[3]))
+        kept_names = set(name for destination_id, name in kept_files)
+
+        pruned = []
+        for start in xrange(0, len(expired), batch_size):
+            batch = expired[start:start + batch_size]
+            ids = [row[0] for row in batch]
+            if dry_run:
+                pruned += ids
+                continue
+
+            #destination id: [(backup id, file name)]
+            files = defaultdict(list)
+            for backup_id, date, destination_id, name, filename, parent in batch:
+                name = filename or name
+                if (destination_id, name) not in kept_files:
+                    files[destination_id].append((backup_id, name))
+            for backup_id, destination_id, name, filename in (Replica.objects
+                    .filter(backup__in=ids, success=True)
+                    .values_list('backup', 'destination', 'backup__name', 'backup__filename')):
+                name = filename or name
+                if name not in kept_names:
+                    files[destination_id].append((backup_id, name))
+
+            destinations = (BaseDestination.objects
+                            .select_related(*BaseDestination.IMPLEMENTATIONS)
+                            .in_bulk(files.keys()))
+            failed_ids = set()
+            for destination_id, entries in files.items():
+                names = sorted(set(name for backup_id, name in entries))
+                try:
+                    failed = set(destinations[destination_id].remove(user.username, names))
+                except Exception, e:
+                    logging.error(e)
+                    failed = set(names)
+                failed_ids.update(backup_id for backup_id, name in entries if name in failed)
+
+            ids = [backup_id for backup_id in ids if backup_id not in failed_ids]
+            Backup.objects.filter(id__in=ids).delete()
+            pruned += ids
+        return pruned
@@ -0,0 +1,135 @@
+#-*- coding: utf-8 -*-
+
+import os
+import socket
+import logging
+import threading
+from datetime import timedelta
+
+from django.db import models
+from django.conf import settings
+from django.utils import timezone
+
+from .Backup import Backup
+
+from .mixins import LoggableMixin
+
+class TransferJob(LoggableMixin, models.Model):
+    '''
+        Deferred transfer of a staged upload to its destination, run by
+        the workers of the runtransfers management command
+    '''
+    PENDING = 'pending'
+    RUNNING = 'running'
+    DONE    = 'done'
+    FAILED  = 'failed'
+    STATUS_CHOICES = (
+        (PENDING, u'pendente'),
+        (RUNNING, u'em execução'),
+        (DONE,    u'concluído'),
+        (FAILED,  u'falhou'),
+    )
+
+    backup   = models.ForeignKey(Backup, related_name='transfer_jobs')
+    status   = models.CharField(max_length=10,
+                                choices=STATUS_CHOICES,
+                                default=PENDING,
+                                db_index=True)
+    attempts = models.PositiveIntegerField(default=0)
+    #a failed job waits until then before it is retried
+    not_before = models.DateTimeField(null=True, blank=True, db_index=True)
+    worker   = models.CharField(max_length=255, blank=True)
+    error    = models.TextField(null=True, blank=True)
+    started  = models.DateTimeField(null=True, blank=True)
+    finished = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        verbose_name = u'transferência'
+        verbose_name_plural = u'transferências'
+        app_label = 'server'
+        ordering = ['id']
+
+    @property
+    def user(self):
+        return self.backup.user
+
+    @classmethod
+    def claim(cls, worker=None):
+        '''
+            Atomically takes the oldest pending job that is not waiting
+            for a retry, or returns None. The conditional UPDATE makes it
+            safe across worker processes.
+        '''
+        worker = worker or '%s:%d:%s' % (socket.gethostname(), os.getpid(),
+                                         threading.current_thread().name)
+        ready = cls.objects.filter(models.Q(not_before__isnull=True) |
+                                   models.Q(not_before__lte=timezone.now()),
+                                   status=cls.PENDING)
+        for job_id in ready.values_list('id', flat=True)[:10]:
+            claimed = cls.objects.filter(id=job_id, status=cls.PENDING).update(
+                status=cls.RUNNING,
+                worker=worker,
+                started=timezone.now(),
+                attempts=models.F('attempts') + 1)
+            if claimed:
+                return cls.objects.select_related('backup').get(id=job_id)
+        return None
+
+    @classmethod
+    def requeue_stale(cls, timeout=None):
+        '''
+            Gives back jobs whose worker died while running them, or fails
+            them once they have used up their attempts
+        '''
+        timeout = timeout or getattr(settings, 'TRANSFER_JOB_TIMEOUT', 6 * 3600)
+        max_attempts = getattr(settings, 'TRANSFER_MAX_ATTEMPTS', 3)
+        stale = cls.objects.filter(status=cls.RUNNING,
+                                   started__lt=timezone.now() - timedelta(seconds=timeout))
+        for job in stale.filter(attempts__gte=max_attempts).select_related('backup'):
+            if cls.objects.filter(id=job.id, status=cls.RUNNING).update(status=cls.FAILED):
+                job.finished = timezone.now()
+                job.give_up(u'Transferência interrompida %d vezes' % job.attempts)
+                job.save()
+        return stale.filter(attempts__lt=max_attempts).update(
+            status=cls.PENDING, worker='', not_before=None)
+
+    @staticmethod
+    def retry_delay(attempts):
+        '''Seconds before retry number attempts, doubling up to TRANSFER_RETRY_MAX_BACKOFF'''
+        backoff = getattr(settings, 'TRANSFER_RETRY_BACKOFF', 60)
+        return min(backoff * 2 ** max(0, attempts - 1),
+                   getattr(settings, 'TRANSFER_RETRY_MAX_BACKOFF', 3600))
+
+    def give_up(self, error):
+        '''Marks the job and its backup failed and drops the staged file'''
+        self.status = self.FAILED
+        self.error = error
+        backup = self.backup
+        backup.success = False
+        backup.obs = error
+        backup.save()
+        #kept for the retries until now
+        backup.discard_staged()
+
+    def run(self):
+        backup = self.backup
+        try:
+            success = backup.transfer()
+            error = None if success else (unicode(backup.write_error or '') or
+                                          u'Falha na transferência para o destino')
+        except Exception, e:
+            logging.exception(e)
+            success, error = False, unicode(e)
+
+        self.finished = timezone.now()
+        if success:
+            self.status = self.DONE
+            self.error = None
+        elif self.attempts < getattr(settings, 'TRANSFER_MAX_ATTEMPTS', 3):
+            self.status = self.PENDING
+            self.error = error
+            self.not_before = self.finished + timedelta(seconds=self.retry_delay(self.attempts))
+        else:
+            self.give_up(error)
+        self.save()
+        return success
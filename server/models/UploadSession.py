@@ -0,0 +1,149 @@
+#-*- coding: utf-8 -*-
+
+from django.db import models, transaction, IntegrityError
+from django.contrib.auth.models import User
+
+from .Backup import Backup
+from .destination.BaseDestination import BaseDestination
+from .destination.buffers import copy
+
+from .mixins import (
+    NameableMixin,
+    LoggableMixin
+)
+
+class UploadError(ValueError):
+    '''The received chunks do not make the upload's file'''
+
+class UploadSession(NameableMixin, LoggableMixin, models.Model):
+    '''
+        Resumable upload of a backup sent as numbered chunks. Chunks are
+        written at their offsets straight into a file of the session on
+        the destination, which must take writes at offsets, and the
+        Backup row is only created on finalize.
+    '''
+    user        = models.ForeignKey(User)
+    destination = models.ForeignKey(BaseDestination)
+    date        = models.DateTimeField(verbose_name=u'data do backup')
+    size        = models.BigIntegerField(verbose_name=u'tamanho',
+                                         null=True,
+                                         blank=True)
+    backup      = models.OneToOneField(Backup,
+                                       null=True,
+                                       blank=True,
+                                       related_name='upload_session')
+
+    class Meta:
+        verbose_name = u'envio em partes'
+        verbose_name_plural = u'envios em partes'
+        app_label = 'server'
+
+    @property
+    def finished(self):
+        return self.backup_id is not None
+
+    @property
+    def filename(self):
+        '''File the chunks are written into, apart from any stored backup's'''
+        return u'%s.upload-%d' % (self.name, self.id)
+
+    def writer(self, offset):
+        return self.destination.writer(
+            subdir = self.user.username,
+            filename = self.filename,
+            offset = offset
+        )
+
+    def write_chunk(self, number, offset, stream, chunk_size=None):
+        '''Appends stream to the destination file at offset and records it'''
+        with self.writer(offset) as f:
+            length = copy(stream, f, chunk_size or self.destination.block_size)
+        #one row per chunk, so parallel chunks never overwrite each other's state
+        chunks = UploadChunk.objects.filter(session=self, number=number)
+        with transaction.atomic():
+            chunks.delete()
+            try:
+                with transaction.atomic():
+                    return UploadChunk.objects.create(session=self,
+                                                      number=number,
+                                                      offset=offset,
+                                                      length=length)
+            except IntegrityError:
+                #a retry of the same chunk recorded it meanwhile
+                chunks.update(offset=offset, length=length)
+                return chunks.get()
+
+    def received(self):
+        '''Merged [start, end) byte ranges received so far'''
+        ranges = []
+        for offset, length in self.chunks.order_by('offset').values_list('offset', 'length'):
+            if ranges and offset <= ranges[-1][1]:
+                ranges[-1][1] = max(ranges[-1][1], offset + length)
+            elif length:
+                ranges.append([offset, offset + length])
+        return ranges
+
+    def missing(self):
+        '''Byte ranges still missing, when the total size is known'''
+        missing, position = [], 0
+        for start, end in self.received():
+            if start > position:
+                missing.append([position, start])
+            position = max(position, end)
+        if self.size is not None and position < self.size:
+            missing.append([position, self.size])
+        return missing
+
+    def finalize(self):
+        '''
+            Creates the backup from the received chunks, once the file on
+            the destination has the size they make. The file is read back
+            once, through the backup's pipeline: its checksums are taken
+            and the replicas written from it, and on destinations that
+            compress or store deltas it is rewritten into a stored file of
+            its own, then removed. Raises UploadError when the sizes do not
+            match; returns the backup, unsuccessful when the pipeline failed.
+        '''
+        received = self.received()
+        size = self.size if self.size is not None else (received[-1][1] if received else 0)
+        stat = self.destination.stat(self.user.username, self.filename)
+        if stat is None or stat[0] != size:
+            raise UploadError('Stored file has %s bytes, %d expected'
+                              % (stat[0] if stat else 'no', size))
+        
+        #files stored as sent are the chunks' one, nothing is rewritten
+        as_sent = not (self.destination.compression or self.destination.delta_chain)
+        backup = Backup(user=self.user,
+                        name=self.name,
+                        destination=self.destination,
+                        date=self.date,
+                        filename=self.filename if as_sent else u'')
+        contents, success = self.destination.restore(self.user.username, self.filename)
+        if success:
+            try:
+                success = backup.write(contents, stored=as_sent)
+            finally:
+                contents.close()
+        if success and not as_sent:
+            self.destination.remove(self.user.username, [self.filename])
+        backup.success = success
+        if not success:
+            backup.obs = u'Envio em partes não pôde ser gravado'
+            if backup.write_error is not None:
+                backup.obs += u': %s' % backup.write_error
+        backup.save(force_insert=True)
+        if success:
+            self.backup = backup
+            self.save()
+            self.chunks.all().delete()
+        return backup
+
+class UploadChunk(models.Model):
+    session = models.ForeignKey(UploadSession, related_name='chunks')
+    number  = models.PositiveIntegerField()
+    offset  = models.BigIntegerField()
+    length  = models.BigIntegerField()
+
+    class Meta:
+        app_label = 'server'
+        unique_together = ('session', 'number')
@@ -1,11 +1,16 @@
 
 from .Backup import Backup
 from .Origin import Origin
+from .UploadSession import UploadSession, UploadChunk, UploadError
+from .TransferJob import TransferJob
+from .Replica import ReplicationPolicy, Replica
+from .RetentionPolicy import RetentionPolicy
 
 from .destination.BaseDestination  import BaseDestination
 from .destination.LocalDestination import LocalDestination
 from .destination.SFTPDestination  import SFTPDestination
 from .destination.APIDestination   import APIDestination
+from .destination.DedupDestination import DedupDestination
 
 
 from django.contrib.auth.models import User, Permission
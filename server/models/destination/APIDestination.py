@@ -1,18 +1,370 @@
 #-*- coding: utf-8 -*-
 
+import json
+import time
+import Queue
+import socket
+import urllib
+import httplib
+import logging
+import threading
+from urlparse import urlparse
+from email.utils import parsedate_tz, mktime_tz
+
+from django.db import models
+from django.conf import settings
+
 from .BaseDestination import BaseDestination
+from .streams         import ClosingFile
+from .buffers         import copy
+from .httppool        import pool
 from ..mixins     import APIMixin
 
+class APIError(IOError):
+    def __init__(self, status, reason):
+        super(APIError, self).__init__('HTTP %d %s' % (status, reason))
+        self.status = status
+
+#errors worth another attempt: network failures, stale keep-alive
+#connections and, for APIError, 5xx statuses
+RETRY_ERRORS = (APIError, socket.error, httplib.HTTPException)
+
+class ResponseFile(ClosingFile):
+    '''
+        Streamed response body. Its connection goes back to the pool when
+        it is closed, if the body was read through, or is dropped.
+    '''
+
+    def __init__(self, conn, response):
+        super(ResponseFile, self).__init__(response)
+        self.conn = conn
+
+    def read(self, size=-1):
+        #HTTPResponse only reads to the end of the body with None, -1
+        #would wait for the keep-alive connection to close
+        return self.f.read(None if size is None or size < 0 else size)
+
+    def close(self):
+        if self.closed:
+            return
+        reuse = self.f.isclosed() and not self.f.will_close
+        super(ResponseFile, self).close()
+        pool.release(self.conn, reuse)
+
+class ChunkedWriter(object):
+    '''
+        Streams writes as the body of a single PUT with chunked transfer
+        encoding, nothing is buffered. Only opening the request is retried,
+        the stream itself can not be replayed.
+    '''
+
+    def __init__(self, destination, path):
+        self.destination = destination
+        self.conn = destination.retrying(lambda: destination.open_request('PUT', path, {
+            'Transfer-Encoding': 'chunked',
+            'Content-Type': 'application/octet-stream',
+        }))
+        self.closed = False
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, *exc_info):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+    def write(self, data):
+        if data:
+            self.conn.send('%x\r\n%s\r\n' % (len(data), data))
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        try:
+            self.conn.send('0\r\n\r\n')
+            self.destination.response(self.conn)
+        except:
+            pool.release(self.conn, False)
+            raise
+
+    def abort(self):
+        '''Drops the connection, so the server never sees a complete body'''
+        if not self.closed:
+            self.closed = True
+            pool.release(self.conn, False)
+
+class MultipartWriter(object):
+    '''
+        Buffers writes into parts of part_size bytes. An object smaller
+        than a part is sent with a single PUT; larger ones become a
+        multipart upload whose parts are sent, and retried, by parallel
+        threads, at most parallel parts being in memory at once.
+    '''
+
+    def __init__(self, destination, path, part_size, parallel):
+        self.destination = destination
+        self.path = path
+        self.part_size = part_size
+        self.parallel = parallel
+        self.buf = []
+        self.buffered = 0
+        self.upload_id = None
+        self.parts = 0
+        self.errors = []
+        self.queue = None
+        self.threads = []
+        self.closed = False
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, *exc_info):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+    def write(self, data):
+        if self.errors:
+            raise self.errors[0]
+        self.buf.append(str(data))
+        self.buffered += len(data)
+        while self.buffered >= self.part_size:
+            data = ''.join(self.buf)
+            self._send_part(data[:self.part_size])
+            rest = data[self.part_size:]
+            self.buf = [rest] if rest else []
+            self.buffered = len(rest)
+
+    def _start(self):
+        self.upload_id = self.destination.call('POST', self.path + '?uploads')['upload_id']
+        self.queue = Queue.Queue(self.parallel)
+        self.threads = [threading.Thread(target=self._run) for i in range(self.parallel)]
+        for thread in self.threads:
+            thread.daemon = True
+            thread.start()
+
+    def _run(self):
+        for number, data in iter(self.queue.get, None):
+            if self.errors:
+                continue
+            try:
+                self.destination.call('PUT', '%s?%s' % (self.path, urllib.urlencode(
+                    {'upload_id': self.upload_id, 'part': number})), data)
+            except Exception, e:
+                self.errors.append(e)
+
+    def _send_part(self, data):
+        if self.upload_id is None:
+            self._start()
+        self.parts += 1
+        self.queue.put((self.parts, data))
+
+    def _join(self):
+        for thread in self.threads:
+            self.queue.put(None)
+        for thread in self.threads:
+            thread.join()
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        data = ''.join(self.buf)
+        self.buf = []
+        if self.upload_id is None:
+            self.destination.call('PUT', self.path, data)
+            return
+        if data:
+            self._send_part(data)
+        self._join()
+        if self.errors:
+            self._cancel()
+            raise self.errors[0]
+        self.destination.call('POST', '%s?%s' % (self.path, urllib.urlencode(
+            {'upload_id': self.upload_id, 'complete': 1})), json.dumps({'parts': self.parts}))
+
+    def abort(self):
+        if self.closed:
+            return
+        self.closed = True
+        if self.upload_id is not None:
+            self._join()
+            self._cancel()
+
+    def _cancel(self):
+        try:
+            self.destination.call('DELETE', '%s?%s' % (self.path, urllib.urlencode(
+                {'upload_id': self.upload_id})))
+        except Exception, e:
+            logging.warning(e)
+
 class APIDestination(APIMixin, BaseDestination):
-    
-    def backup(self, *args, **kwargs):
-        print "Hello! This is %s's backup method" % self.__class__.__name__
-        #raise NotImplementedError
-    def restore(self, filename):
+    '''
+        HTTP object store. Objects live at <base_uri path>/<set_uri>/<subdir>/<name>
+        for PUT and DELETE and at <get_uri>/... for GET and HEAD; pubkey is
+        sent as a bearer token. Large objects are uploaded in parts:
+        POST ?uploads returns {"upload_id": ...}, PUT ?upload_id=&part=N
+        sends each part and POST ?upload_id=&complete=1 assembles them.
+    '''
+    #parts of a multipart upload sent at once, 1 streams every upload
+    #as a single chunked PUT instead
+    parallel_parts = models.PositiveSmallIntegerField(verbose_name=u'partes paralelas',
+                                                      default=4)
+    offset_writes = False
+
+    @property
+    def endpoint(self):
+        uri = urlparse(self.base_uri)
+        port = uri.port or (443 if uri.scheme == 'https' else 80)
+        return uri.scheme, uri.hostname, port, uri.path.rstrip('/')
+
+    def object_path(self, uri, subdir, filename):
+        return '%s/%s/%s/%s' % (self.endpoint[3], uri.strip('/'),
+                                urllib.quote(subdir.encode('utf-8')),
+                                urllib.quote(filename.encode('utf-8')))
+
+    def open_request(self, method, path, headers=None, body=None):
+        '''Sends the request line and headers (and body, if given) on a pooled connection'''
+        scheme, host, port, prefix = self.endpoint
+        conn = pool.acquire(scheme, host, port)
+        try:
+            conn.putrequest(method, path, skip_accept_encoding=True)
+            conn.putheader('Authorization', 'Bearer %s' % self.pubkey)
+            for header, value in (headers or {}).items():
+                conn.putheader(header, value)
+            if body is not None:
+                conn.putheader('Content-Length', str(len(body)))
+            conn.endheaders(body)
+        except:
+            pool.release(conn, False)
+            raise
+        return conn
+
+    def response(self, conn, stream=False):
+        '''
+            Response to the request sent on conn; errors raise APIError. The
+            body is read and conn released, unless stream is set.
+        '''
+        try:
+            response = conn.getresponse()
+        except:
+            pool.release(conn, False)
+            raise
+        if stream and response.status < 300:
+            return response
+        body = response.read()
+        pool.release(conn, not response.will_close)
+        if response.status >= 300:
+            raise APIError(response.status, response.reason)
+        return body
+
+    def retrying(self, attempt):
+        '''
+            Runs attempt, again after a growing pause when it fails with a
+            network or 5xx error, up to API_RETRIES times
+        '''
+        retries = getattr(settings, 'API_RETRIES', 3)
+        backoff = getattr(settings, 'API_RETRY_BACKOFF', 0.5)
+        for i in range(retries + 1):
+            try:
+                return attempt()
+            except RETRY_ERRORS, e:
+                if i == retries or (isinstance(e, APIError) and e.status < 500):
+                    raise
+                logging.warning('%s, retrying', e)
+                time.sleep(backoff * 2 ** i)
+
+    def call(self, method, path, body=None, headers=None):
+        '''Request with a buffered body and response, retried; returns JSON or the body'''
+        def attempt():
+            return self.response(self.open_request(method, path, headers, body))
+        result = self.retrying(attempt)
+        try:
+            return json.loads(result) if result else None
+        except ValueError:
+            return result
+
+    def writer(self, subdir, filename, offset=None, *args, **kwargs):
+        if offset is not None:
+            raise NotImplementedError('%s does not support writes at offsets' % self.__class__.__name__)
+        path = self.object_path(self.set_uri, subdir, filename)
+        if self.parallel_parts > 1:
+            return MultipartWriter(self, path, getattr(settings, 'API_PART_SIZE', 8 * 1024 * 1024),
+                                   self.parallel_parts)
+        return ChunkedWriter(self, path)
+
+    def backup(self, contents, subdir, filename, *args, **kwargs):
+        #print "Hello! This is %s's backup method" % self.__class__.__name__
+        try:
+            with self.writer(subdir, filename) as f:
+                copy(contents, f, self.block_size)
+        except Exception, e:
+            logging.exception('%s: backup of %s/%s failed', self.name, subdir, filename)
+            return False
+        return True
+
+    def stat(self, subdir, filename, *args, **kwargs):
+        path = self.object_path(self.get_uri, subdir, filename)
+        def attempt():
+            conn = self.open_request('HEAD', path)
+            response = self.response(conn, stream=True)
+            response.read()
+            pool.release(conn, not response.will_close)
+            return response
+        try:
+            response = self.retrying(attempt)
+        except Exception, e:
+            logging.error('%s: stat of %s failed: %s', self.name, path, e)
+            return None
+        modified = parsedate_tz(response.getheader('Last-Modified', ''))
+        return (int(response.getheader('Content-Length', 0)),
+                mktime_tz(modified) if modified else 0)
+
+    def restore(self, subdir, filename, offset=0, *args, **kwargs):
+        '''Streamed download from offset, the connection is released when it is closed'''
         #print "Hello! This is %s's restore method" % self.__class__.__name__
-        raise NotImplementedError
-    
+        path = self.object_path(self.get_uri, subdir, filename)
+        headers = {'Range': 'bytes=%d-' % offset} if offset else {}
+        try:
+            conn = self.retrying(lambda: self._get(path, headers))
+        except Exception, e:
+            logging.error('%s: restore of %s failed: %s', self.name, path, e)
+            return None, False
+        f = ResponseFile(*conn)
+        if offset and f.status != httplib.PARTIAL_CONTENT:
+            #the server ignored the range
+            skip = offset
+            while skip:
+                skipped = len(f.read(min(skip, 64 * 1024)))
+                if not skipped:
+                    break
+                skip -= skipped
+        return (f, True)
+
+    def _get(self, path, headers):
+        conn = self.open_request('GET', path, headers)
+        return conn, self.response(conn, stream=True)
+
+    def remove(self, subdir, filenames, *args, **kwargs):
+        '''Deletes filenames over pooled keep-alive connections, returns the ones that failed'''
+        failed = []
+        for filename in filenames:
+            try:
+                self.call('DELETE', self.object_path(self.set_uri, subdir, filename))
+            except APIError, e:
+                if e.status != httplib.NOT_FOUND:
+                    logging.error(e)
+                    failed.append(filename)
+            except Exception, e:
+                logging.error(e)
+                failed.append(filename)
+        return failed
+
     class Meta:
         verbose_name = u'destino API'
         verbose_name_plural = u'destinos API'
-        app_label = 'server'
\ No newline at end of file
+        app_label = 'server'
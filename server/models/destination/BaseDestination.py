@@ -1,6 +1,11 @@
 #-*- coding: utf-8 -*-
 from django.db import models
 from django.contrib.auth.models import User
+from django.core.validators import MinValueValidator, MaxValueValidator
+
+from .compression import CODECS
+from .buffers import block_size
+from ...tracing import span
 
 from ..mixins import (
     NameableMixin,
@@ -14,22 +19,87 @@ class BaseDestination(NameableMixin, LoggableMixin, models.Model):
                                  max_length=1024,
                                  blank=True,
                                  default=u'~')
+    #name of the concrete subclass relation, e.g. 'localdestination'
+    kind      = models.CharField(verbose_name=u'tipo',
+                                 max_length=30,
+                                 blank=True,
+                                 editable=False)
+    #backups are compressed on their way in, see compression.py
+    compression       = models.CharField(verbose_name=u'compressão',
+                                         max_length=10,
+                                         blank=True,
+                                         default=u'',
+                                         choices=[(u'', u'nenhuma')] +
+                                                 [(codec, codec) for codec in CODECS])
+    #0-9 for every codec (bz2 takes 0 as 1)
+    compression_level = models.PositiveSmallIntegerField(verbose_name=u'nível de compressão',
+                                                         default=6,
+                                                         validators=[MinValueValidator(0),
+                                                                     MaxValueValidator(9)])
+    #incremental backups: versions stored as deltas against the previous
+    #one, at most delta_chain in a row before a full copy (0 disables)
+    delta_chain       = models.PositiveSmallIntegerField(verbose_name=u'incrementos seguidos',
+                                                         default=0)
+    
+    #writer() takes an offset, as chunked uploads need
+    offset_writes = True
+    
+    IMPLEMENTATIONS = ('localdestination',
+                       'sftpdestination',
+                       'apidestination',
+                       'dedupdestination')
+    
+    def save(self, *args, **kwargs):
+        model = self._meta.concrete_model
+        if not self.kind and model is not BaseDestination:
+            self.kind = model.__name__.lower()
+        return super(BaseDestination, self).save(*args, **kwargs)
     
     @property
     def destination_impl(self):
-        return (self._getattr('localdestination',
-                self._getattr('sftpdestination',
-                self._getattr('apidestination',
-                None))))
+        '''
+            Concrete destination, resolved with at most one query (none
+            when the relation was select_related) and cached
+        '''
+        if self._meta.concrete_model is not BaseDestination:
+            return self
+        if not hasattr(self, '_destination_impl'):
+            if self.kind:
+                self._destination_impl = self._getattr(self.kind, None)
+            else:
+                #rows saved before kind existed
+                self._destination_impl = None
+                for kind in self.IMPLEMENTATIONS:
+                    self._destination_impl = self._getattr(kind, None)
+                    if self._destination_impl is not None:
+                        break
+        return self._destination_impl
+    
+    @property
+    def block_size(self):
+        '''Bytes per read and write when copying to or from it, see IO_BLOCK_SIZES'''
+        return block_size(self.kind or self._meta.concrete_model.__name__.lower())
     
     @property
     def type(self):
         return self.destination_impl.__class__.__name__
     
+    #calls through here are spans of the request's trace, if any
+    def _call(self, method, *args, **kwargs):
+        with span('destination.' + method, destination=self.name):
+            return getattr(self.destination_impl, method)(*args, **kwargs)
+    
     def backup(self, *args, **kwargs):
-        return self.destination_impl.backup(*args,**kwargs)
+        return self._call('backup', *args, **kwargs)
     def restore(self, *args, **kwargs):
-        return self.destination_impl.restore(*args,**kwargs)
+        return self._call('restore', *args, **kwargs)
+    def writer(self, *args, **kwargs):
+        return self._call('writer', *args, **kwargs)
+    def stat(self, *args, **kwargs):
+        return self._call('stat', *args, **kwargs)
+    #not delete(), which removes the destination's row
+    def remove(self, *args, **kwargs):
+        return self._call('remove', *args, **kwargs)
     
     def _getattr(self, attr, otherwise):
         try:
@@ -0,0 +1,218 @@
+#-*- coding: utf-8 -*-
+
+import os
+import time
+import errno
+import hashlib
+import logging
+import tempfile
+
+from django.db import models
+from django.conf import settings
+
+from .BaseDestination import BaseDestination
+from .chunking        import ContentDefinedChunker
+from .streams         import IterFile
+from .buffers         import copy
+
+class DedupWriter(object):
+    '''
+        Splits the written stream into content defined chunks, stores the
+        unseen ones in the chunk store and writes the manifest on close
+    '''
+
+    def __init__(self, destination, manifest):
+        self.destination = destination
+        self.manifest = manifest
+        self.chunker = ContentDefinedChunker(destination.avg_chunk_size)
+        self.entries = []
+        self.closed = False
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, *exc_info):
+        if exc_type is None:
+            self.close()
+        else:
+            self.closed = True
+
+    def write(self, data):
+        for chunk in self.chunker.feed(data):
+            self._store(chunk)
+
+    def _store(self, chunk):
+        digest = hashlib.sha256(chunk).hexdigest()
+        self.destination.store_chunk(digest, chunk)
+        self.entries.append((digest, len(chunk)))
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        chunk = self.chunker.flush()
+        if chunk:
+            self._store(chunk)
+        self.destination.write_manifest(self.manifest, self.entries)
+
+class DedupDestination(BaseDestination):
+    '''
+        Local destination storing each distinct chunk once, under
+        <directory>/.chunks/, and a manifest per backup listing its chunks
+    '''
+    avg_chunk_size = models.PositiveIntegerField(verbose_name=u'tamanho médio dos blocos',
+                                                 default=64 * 1024)
+    offset_writes = False
+
+    @property
+    def root(self):
+        return os.path.expanduser(self.directory)
+
+    def chunk_path(self, digest):
+        return os.path.join(self.root, '.chunks', digest[:2], digest)
+
+    def manifest_path(self, subdir, filename):
+        return os.path.join(self.root, subdir, filename + '.manifest')
+
+    def store_chunk(self, digest, chunk):
+        fn = self.chunk_path(digest)
+        try:
+            #touched, so collect_garbage() leaves it to the manifest being written
+            os.utime(fn, None)
+            return False
+        except OSError, e:
+            if e.errno != errno.ENOENT:
+                raise
+        self._atomic_write(fn, chunk)
+        return True
+
+    def write_manifest(self, fn, entries):
+        self._atomic_write(fn, ''.join('%s %d\n' % entry for entry in entries))
+
+    def read_manifest(self, subdir, filename):
+        return self._read_manifest(self.manifest_path(subdir, filename))
+
+    def _read_manifest(self, fn):
+        with open(fn, 'rb') as f:
+            return [(digest, int(length)) for digest, length in
+                    (line.split() for line in f if line.strip())]
+
+    def _atomic_write(self, fn, data):
+        fd = os.path.dirname(fn)
+        try:
+            os.makedirs(fd)
+        except OSError, e:
+            if e.errno != errno.EEXIST:
+                raise
+        tmp_fd, tmp = tempfile.mkstemp(dir=fd, prefix='.tmp')
+        try:
+            with os.fdopen(tmp_fd, 'wb') as f:
+                f.write(data)
+            os.rename(tmp, fn)
+        except:
+            os.remove(tmp)
+            raise
+
+    def writer(self, subdir, filename, offset=None, *args, **kwargs):
+        if offset is not None:
+            raise NotImplementedError('%s does not support writes at offsets' % self.__class__.__name__)
+        return DedupWriter(self, self.manifest_path(subdir, filename))
+
+    def backup(self, contents, subdir, filename, *args, **kwargs):
+        try:
+            with self.writer(subdir, filename) as f:
+                copy(contents, f, self.block_size)
+        except Exception, e:
+            logging.exception('%s: backup of %s/%s failed', self.name, subdir, filename)
+            return False
+        return True
+
+    def stat(self, subdir, filename, *args, **kwargs):
+        try:
+            entries = self.read_manifest(subdir, filename)
+            mtime = os.path.getmtime(self.manifest_path(subdir, filename))
+        except (IOError, OSError), e:
+            logging.error('%s: %s', self.name, e)
+            return None
+        return (sum(length for digest, length in entries), int(mtime))
+
+    def restore(self, subdir, filename, offset=0, *args, **kwargs):
+        try:
+            entries = self.read_manifest(subdir, filename)
+        except IOError, e:
+            logging.error('%s: %s', self.name, e)
+            return None, False
+        return (IterFile(self._reassemble(entries, offset)), True)
+
+    def remove(self, subdir, filenames, *args, **kwargs):
+        '''
+            Removes the manifests of filenames, returns the ones that could
+            not be removed. Their chunks stay until collect_garbage() runs
+            (manage.py collectchunks), as a sweep reads every manifest.
+        '''
+        failed = []
+        for filename in filenames:
+            try:
+                os.remove(self.manifest_path(subdir, filename))
+            except OSError, e:
+                if e.errno != errno.ENOENT:
+                    logging.error('%s: %s', self.name, e)
+                    failed.append(filename)
+        return failed
+
+    def collect_garbage(self, grace=None):
+        '''
+            Mark and sweep of the chunk store: removes the chunks no
+            manifest lists, those of removed backups as well as those left
+            by aborted writes, and temporary files of interrupted writes.
+            Files modified in the last grace (DEDUP_GC_GRACE) seconds are
+            kept: a write under way lists its chunks only when it closes.
+            Returns (files removed, bytes freed).
+        '''
+        if grace is None:
+            grace = getattr(settings, 'DEDUP_GC_GRACE', 3600)
+        limit = time.time() - grace
+        store = os.path.join(self.root, '.chunks')
+        live, garbage = set(), []
+        for d, dirs, files in os.walk(self.root):
+            if d == self.root and '.chunks' in dirs:
+                dirs.remove('.chunks')
+            for fn in files:
+                if fn.endswith('.manifest'):
+                    live.update(digest for digest, length in self._read_manifest(os.path.join(d, fn)))
+                elif fn.startswith('.tmp'):
+                    garbage.append(os.path.join(d, fn))
+        for d, dirs, files in os.walk(store):
+            garbage.extend(os.path.join(d, fn) for fn in files if fn not in live)
+
+        removed = freed = 0
+        for fn in garbage:
+            try:
+                st = os.stat(fn)
+                if st.st_mtime > limit:
+                    continue
+                os.remove(fn)
+            except OSError, e:
+                if e.errno != errno.ENOENT:
+                    raise
+                continue
+            removed += 1
+            freed += st.st_size
+        return removed, freed
+    
+    def _reassemble(self, entries, offset):
+        for digest, length in entries:
+            #chunks before offset are skipped without being read
+            if offset >= length:
+                offset -= length
+                continue
+            with open(self.chunk_path(digest), 'rb') as f:
+                f.seek(offset)
+                offset = 0
+                for data in iter(lambda: f.read(64 * 1024), ''):
+                    yield data
+
+    class Meta:
+        verbose_name = u'destino com deduplicação'
+        verbose_name_plural = u'destinos com deduplicação'
+        app_label = 'server'
@@ -3,40 +3,85 @@
 from django.db import models
 
 import os
+import errno
+import logging
 
 from .BaseDestination import BaseDestination
+from .streams         import ClosingFile
+from .buffers         import copy
 
 class LocalDestination(BaseDestination):
     
-    def backup(self, contents, subdir, filename, *args, **kwargs):
-        #print "Hello! This is %s's backup method" % self.__class__.__name__
+    def writer(self, subdir, filename, offset=None, *args, **kwargs):
+        '''
+            Opens the file for writing, truncating it, or when offset is
+            given, keeping its contents and writing from offset on
+        '''
         fd = os.path.join(os.path.expanduser(self.directory), subdir)
         if not os.path.exists(fd):
-            os.makedirs(fd)
+            try:
+                os.makedirs(fd)
+            except OSError:
+                #created meanwhile by a parallel writer
+                if not os.path.isdir(fd):
+                    raise
             #print 'caminho ' + fd + ' criado'
             
-        fn = os.path.join(fd,filename)
+        fn = os.path.join(fd, filename)
+        if offset is None:
+            return open(fn, 'wb+')
+        #created if missing, never truncated: parallel writers may have written it
+        f = os.fdopen(os.open(fn, os.O_RDWR | os.O_CREAT, 0666), 'r+b')
+        f.seek(offset)
+        return f
+    
+    def backup(self, contents, subdir, filename, *args, **kwargs):
+        #print "Hello! This is %s's backup method" % self.__class__.__name__
         try:
-            with open(fn, 'wb+') as f:
-                for data in iter(lambda: contents.read(64 * 1024), ''):
-                    f.write(data)
+            with self.writer(subdir, filename) as f:
+                copy(contents, f, self.block_size)
         except Exception, e:
-            print e
+            logging.exception('%s: backup of %s/%s failed', self.name, subdir, filename)
             return False
         return True
         
-    def restore(self, subdir, filename, *args, **kwargs):
+    def path(self, subdir, filename):
+        return os.path.abspath(os.path.join(os.path.expanduser(self.directory),
+                                            subdir,
+                                            filename))
+    
+    def stat(self, subdir, filename, *args, **kwargs):
+        try:
+            st = os.stat(self.path(subdir, filename))
+        except OSError, e:
+            logging.error('%s: %s', self.name, e)
+            return None
+        return (st.st_size, int(st.st_mtime))
+    
+    def restore(self, subdir, filename, offset=0, *args, **kwargs):
         #print "Hello! This is %s's restore method" % self.__class__.__name__
-        fn = os.path.join(os.path.expanduser(self.directory),
-                          subdir,
-                          filename)
+        fn = self.path(subdir, filename)
         try:
-            with open(fn, 'rb') as f:
-                return ([data for data in iter(lambda: f.read(64 * 1024), '')], True)
+            f = open(fn, 'rb')
+            if offset:
+                f.seek(offset)
+            return (ClosingFile(f), True)
         except Exception, e:
-            print e
+            logging.error('%s: %s', self.name, e)
             return None, False
     
+    def remove(self, subdir, filenames, *args, **kwargs):
+        '''Removes filenames, returns the ones that could not be removed'''
+        failed = []
+        for filename in filenames:
+            try:
+                os.remove(self.path(subdir, filename))
+            except OSError, e:
+                if e.errno != errno.ENOENT:
+                    logging.error('%s: %s', self.name, e)
+                    failed.append(filename)
+        return failed
+    
     class Meta:
         verbose_name = u'destino local'
         verbose_name_plural = u'destinos locais'
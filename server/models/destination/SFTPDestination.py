@@ -1,83 +1,240 @@
 #-*- coding: utf-8 -*-
 
 import os
+import time
 import errno
 import logging
 import paramiko
 
 from django.db import models
+from django.conf import settings
 
 from .BaseDestination import BaseDestination
+from .streams         import ClosingFile, IterFile, StripedWriter, striped_read
+from .sftppool        import pool, load_private_key
+from .buffers         import copy
 from ..mixins     import AccessableMixin
+from ...metrics   import sftp_connect_seconds, sftp_connect_failures
+from ...tracing   import traced
 
 class SFTPDestination(AccessableMixin, BaseDestination):
+    #bytes per SFTP read/write request; 32KB is the size every server
+    #must accept, OpenSSH takes up to 255KB
+    chunk_size = models.PositiveIntegerField(verbose_name=u'tamanho dos pacotes',
+                                             default=32 * 1024)
+    #SFTP sessions a file is transferred through in parallel
+    streams    = models.PositiveSmallIntegerField(verbose_name=u'conexões paralelas',
+                                                  default=1)
     
-    client = None
+    @traced('sftp.connect')
+    def _client(self):
+        client = paramiko.SSHClient()
+        client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+        client.load_system_host_keys()
+        
+        start = time.time()
+        try:
+            client.connect(hostname=self.hostname,
+                           port=int(self.port),
+                           username=self.username,
+                           pkey=load_private_key(self.key_filename),
+                           timeout=5.0)
+        except:
+            sftp_connect_failures.inc(destination=self.name)
+            raise
+        sftp_connect_seconds.observe(time.time() - start, destination=self.name)
+        return client
+    
+    @property
+    def pool_key(self):
+        return (self.hostname, self.port, self.username, self.key_filename)
     
     def connect(self):
-        self.client = paramiko.SSHClient()
-        self.client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-        self.client.load_system_host_keys()
-        pvtkey = paramiko.RSAKey.from_private_key_file(os.path.expanduser(self.key_filename))
-        
-        self.client.connect(hostname=self.hostname,
-                       port=int(self.port),
-                       username=self.username,
-                       pkey=pvtkey,
-                       timeout=5.0)
-        return self.client.open_sftp()
+        return pool.acquire(self.pool_key, self._client)
     
-    def backup(self, contents, subdir, filename, *args, **kwargs):
-        #print "Hello! This is %s's backup method" % self.__class__.__name__
-
-        fd = os.path.join(self.directory, subdir)
-        
-        sftp = None
-        
+    def disconnect(self, sftp, discard=False):
+        if sftp:
+            pool.release(sftp, discard)
+    
+    @property
+    def stripe_size(self):
+        return getattr(settings, 'SFTP_STRIPE_SIZE', 1024 * 1024)
+    
+    def _sessions(self, count):
+        '''
+            Up to count pooled sessions: waits for the first one, the
+            others are only taken if they are free right away
+        '''
+        sessions = [self.connect()]
+        try:
+            sessions += self._extra_sessions(count - 1)
+        except:
+            self._release(sessions)
+            raise
+        return sessions
+    
+    def _extra_sessions(self, count):
+        '''
+            Up to count more sessions for a transfer that holds some, or
+            none: never waits for one, so transfers holding sessions can
+            not block each other; they go on with fewer streams instead
+        '''
+        sessions = []
+        try:
+            for i in range(min(count, pool.max_size - 1)):
+                sftp = pool.acquire(self.pool_key, self._client, block=False)
+                if sftp is None:
+                    break
+                sessions.append(sftp)
+        except:
+            self._release(sessions)
+            raise
+        return sessions
+    
+    def _release(self, sessions):
+        for sftp in sessions:
+            self.disconnect(sftp)
+    
+    def _open(self, sftp, path, mode):
+        '''
+            Opens path with pipelined writes: paramiko stops waiting for
+            each write's reply, errors come up on close instead
+        '''
+        f = sftp.open(path, mode, self.chunk_size)
+        f.MAX_REQUEST_SIZE = self.chunk_size
+        f.set_pipelined(True)
+        return f
+    
+    def writer(self, subdir, filename, offset=None, *args, **kwargs):
+        '''
+            Opens filename for writing. With several streams, whole
+            uploads are striped across that many sessions writing at
+            their offsets; writes at an offset use a single session.
+        '''
+        sessions = self._sessions(self.streams if offset is None else 1)
+        sftp = sessions[0]
+        files = []
         try:
-            sftp = self.connect()
             if not self._rexists(sftp,subdir):
-                sftp.mkdir(subdir)
-                logging.warning('caminho criado')
-            
+                try:
+                    sftp.mkdir(subdir)
+                    logging.warning('caminho criado')
+                except IOError:
+                    #created meanwhile by a parallel writer
+                    if not self._rexists(sftp, subdir):
+                        raise
             
-            sftp.chdir(subdir)
+            path = '%s/%s' % (subdir, filename)
+            if offset is None:
+                files.append(self._open(sftp, path, 'wb+'))
+            else:
+                #created exclusively, never truncated: parallel writers may have written it
+                try:
+                    files.append(self._open(sftp, path, 'r+x'))
+                except IOError:
+                    files.append(self._open(sftp, path, 'r+'))
+                files[0].seek(offset)
+            for other in sessions[1:]:
+                files.append(self._open(other, path, 'r+'))
+        except:
+            for f in files:
+                f.close()
+            self._release(sessions)
+            raise
+        if len(files) == 1:
+            return ClosingFile(files[0], lambda: self._release(sessions))
+        return StripedWriter(files, self.stripe_size, lambda: self._release(sessions))
+    
+    def backup(self, contents, subdir, filename, *args, **kwargs):
+        #print "Hello! This is %s's backup method" % self.__class__.__name__
+        
+        with self.writer(subdir, filename) as f:
             try:
-                with sftp.open(filename, 'wb+') as f:
-                    for data in contents.chunks():
-                        f.write(data)
+                copy(contents, f, self.block_size)
             except Exception, e:
-                print e
-                logging.error(e, errno)
+                logging.error('%s', e)
                 raise
-            sftp.close()
-            if self.client:
-                self.client.close()
-            return True
-        except:
-            if sftp:
-                sftp.close()
-            if self.client:
-                self.client.close()
-            raise
+        return True
 
     
-    def restore(self, subdir, filename, *args, **kwargs):
+    def stat(self, subdir, filename, *args, **kwargs):
+        sftp = None
+        try:
+            sftp = self.connect()
+            st = sftp.stat('%s/%s' % (subdir, filename))
+        except Exception, e:
+            logging.error('%s', e)
+            return None
+        finally:
+            self.disconnect(sftp)
+        return (st.st_size, st.st_mtime)
+    
+    def restore(self, subdir, filename, offset=0, seekable=False, *args, **kwargs):
+        '''
+            Lazy download from offset. Stripes are read ahead with
+            pipelined requests, through several sessions at once when
+            the destination has more than one stream. With seekable, the
+            file of a single session is returned instead, to be read
+            where the caller seeks.
+        '''
         #print "Hello! This is %s's restore method" % self.__class__.__name__
         
+        sessions, files = [], []
         try:
-            sftp = self.connect()
-            sftp.chdir(subdir)
-                
-            with sftp.open(filename, 'rb') as f:
-                data = [chunks for chunks in iter(lambda: f.read(64 * 1024), '')]
-                sftp.close()
-                return (data, True)
+            path = '%s/%s' % (subdir, filename)
+            sessions = self._sessions(1)
+            if seekable:
+                f = sessions[0].open(path, 'rb')
+                files.append(f)
+                f.MAX_REQUEST_SIZE = self.chunk_size
+                f.seek(offset)
+                return (ClosingFile(f, lambda: self._release(sessions)), True)
+            size = sessions[0].stat(path).st_size
+            #files of a single stripe are not worth more sessions
+            if self.streams > 1 and size - offset > self.stripe_size:
+                sessions += self._extra_sessions(self.streams - 1)
+            for sftp in sessions:
+                f = sftp.open(path, 'rb')
+                f.MAX_REQUEST_SIZE = self.chunk_size
+                files.append(f)
         except Exception, e:
-            print e
-            logging.error(e, errno)
-            sftp.close()
+            logging.error('%s', e)
+            for f in files:
+                f.close()
+            self._release(sessions)
             return (None, False)
+        
+        def close():
+            for f in files:
+                f.close()
+            self._release(sessions)
+        
+        readers = [self._reader(f) for f in files]
+        #the sessions go back to the pool when the download is closed
+        return (IterFile(striped_read(readers, offset, size, self.stripe_size), close), True)
+    
+    def remove(self, subdir, filenames, *args, **kwargs):
+        '''
+            Removes filenames through a single session, returns the ones
+            that could not be removed
+        '''
+        failed = []
+        sftp = self.connect()
+        try:
+            for filename in filenames:
+                try:
+                    sftp.remove('%s/%s' % (subdir, filename))
+                except IOError, e:
+                    if e.errno != errno.ENOENT:
+                        logging.error('%s', e)
+                        failed.append(filename)
+        finally:
+            self.disconnect(sftp)
+        return failed
+    
+    def _reader(self, f):
+        #readv sends all the requests of a stripe before waiting for replies
+        return lambda start, length: ''.join(f.readv([(start, length)]))
     
     def _rexists(self, sftp, path):
         """
@@ -88,7 +245,6 @@ class SFTPDestination(AccessableMixin, BaseDestination):
             sftp.stat(path)
         except IOError, e:
             if e.errno == errno.ENOENT:
-                print e, errno
                 return False
             raise
         else:
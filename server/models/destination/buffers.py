@@ -0,0 +1,112 @@
+#-*- coding: utf-8 -*-
+
+import threading
+from contextlib import contextmanager
+
+from django.conf import settings
+
+class BufferPool(object):
+    '''
+        Per process free list of preallocated bytearrays, by size, so
+        copy loops reuse their read buffers instead of allocating a new
+        string per chunk. At most max_free idle buffers of each size are
+        kept. The counters are cumulative, see stats().
+    '''
+
+    def __init__(self, max_free=16):
+        self.max_free = max_free
+        self.lock = threading.Lock()
+        self.free = {}     #size -> [bytearray, ...]
+        self.allocated = 0
+        self.allocated_bytes = 0
+        self.reused = 0
+        self.in_use = 0
+        self.copied_bytes = 0
+
+    def acquire(self, size):
+        with self.lock:
+            self.in_use += 1
+            buffers = self.free.get(size)
+            if buffers:
+                self.reused += 1
+                return buffers.pop()
+            self.allocated += 1
+            self.allocated_bytes += size
+        return bytearray(size)
+
+    def release(self, buf):
+        with self.lock:
+            self.in_use -= 1
+            buffers = self.free.setdefault(len(buf), [])
+            if len(buffers) < self.max_free:
+                buffers.append(buf)
+
+    @contextmanager
+    def buffer(self, size):
+        buf = self.acquire(size)
+        try:
+            yield buf
+        finally:
+            self.release(buf)
+
+    def clear(self):
+        with self.lock:
+            self.free = {}
+
+    def stats(self):
+        with self.lock:
+            return {
+                'allocated': self.allocated,
+                'allocated_bytes': self.allocated_bytes,
+                'reused': self.reused,
+                'in_use': self.in_use,
+                'idle': sum(len(buffers) for buffers in self.free.values()),
+                'copied_bytes': self.copied_bytes,
+            }
+
+pool = BufferPool(getattr(settings, 'IO_POOL_MAX_FREE', 16))
+
+def block_size(kind):
+    '''Bytes per read and write for destinations of kind (e.g. 'sftpdestination')'''
+    return getattr(settings, 'IO_BLOCK_SIZES', {}).get(kind, getattr(settings, 'IO_BLOCK_SIZE', 64 * 1024))
+
+def _readinto(f):
+    #django Files proxy read() but not readinto() to the file they wrap
+    readinto = getattr(f, 'readinto', None)
+    if readinto is None and hasattr(f, 'file'):
+        readinto = getattr(f.file, 'readinto', None)
+    return readinto
+
+def chunks(f, size):
+    '''
+        Yields the contents of f in chunks of up to size bytes. Files with
+        readinto() are read into a pooled buffer and the chunks are
+        read-only buffer() views of it, only valid until the next one is
+        asked for: whoever keeps data beyond a write() copies it (str()).
+        Others are read() as usual.
+    '''
+    readinto = _readinto(f)
+    if readinto is None:
+        for data in iter(lambda: f.read(size), ''):
+            yield data
+        return
+    copied = 0
+    with pool.buffer(size) as buf:
+        try:
+            while True:
+                n = readinto(buf)
+                if not n:
+                    break
+                copied += n
+                yield buffer(buf, 0, n)
+        finally:
+            with pool.lock:
+                pool.copied_bytes += copied
+
+def copy(src, dst, size):
+    '''Writes the contents of src to dst, through a pooled buffer when it can; returns the bytes copied'''
+    copied = 0
+    for data in chunks(src, size):
+        dst.write(data)
+        copied += len(data)
+    return copied
@@ -0,0 +1,117 @@
+#-*- coding: utf-8 -*-
+
+import hashlib
+import logging
+
+from .streams import ClosingFile
+
+def available_hashes():
+    '''[(name of the Backup field, hash constructor)], fastest available last'''
+    hashes = [('sha256', hashlib.sha256)]
+    try:
+        #stdlib from Python 3.6, pyblake2 before
+        try:
+            from hashlib import blake2b
+        except ImportError:
+            from pyblake2 import blake2b
+        hashes.append(('blake2b', blake2b))
+    except ImportError:
+        pass
+    return hashes
+
+HASHES = available_hashes()
+
+class ChecksumMismatch(IOError):
+    pass
+
+class HashingWriter(object):
+    '''
+        Hashes the written stream with every available hash while passing
+        it on to f. size and digests ({field: hexdigest}) are complete once
+        it is closed, then on_close is called with the writer.
+    '''
+
+    def __init__(self, f, on_close=None):
+        self.f = f
+        self.on_close = on_close
+        self.hashes = [(name, new()) for name, new in HASHES]
+        self.size = 0
+        self.closed = False
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        if exc_type is None:
+            self.close()
+        else:
+            self.closed = True
+            self.f.__exit__(exc_type, exc_value, tb)
+
+    @property
+    def digests(self):
+        return dict((name, h.hexdigest()) for name, h in self.hashes)
+
+    def write(self, data):
+        for name, h in self.hashes:
+            h.update(data)
+        self.size += len(data)
+        self.f.write(data)
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        self.f.close()
+        if self.on_close is not None:
+            self.on_close(self)
+
+class VerifyingFile(ClosingFile):
+    '''
+        Hashes f as it is read and checks it against digest when size
+        bytes were read, before handing out the last ones, so a corrupted
+        file never reaches the reader whole. Raises ChecksumMismatch.
+    '''
+
+    def __init__(self, f, size, name, digest, *callbacks):
+        super(VerifyingFile, self).__init__(f, *callbacks)
+        self.size = size
+        self.digest = digest
+        self.hash = dict(HASHES)[name]()
+        self.position = 0
+        self.verified = False
+
+    def read(self, size=-1):
+        data = self.f.read(size)
+        self._check(data)
+        return data
+
+    def readinto(self, b):
+        if not hasattr(self.f, 'readinto'):
+            return super(VerifyingFile, self).readinto(b)
+        n = self.f.readinto(b)
+        self._check(buffer(b, 0, n))
+        return n
+
+    def _check(self, data):
+        if self.verified:
+            return
+        self.hash.update(data)
+        self.position += len(data)
+        if self.position >= self.size or not data:
+            self.verify()
+
+    def verify(self):
+        self.verified = True
+        if self.position != self.size or self.hash.hexdigest() != self.digest:
+            logging.error('checksum mismatch: %d bytes, %s expected %s',
+                          self.position, self.hash.hexdigest(), self.digest)
+            raise ChecksumMismatch('Stored file does not match its checksum')
+
+def verifier(backup):
+    '''(hash field, digest) to verify backup with, the fastest one stored'''
+    for name, new in reversed(HASHES):
+        digest = getattr(backup, name, None)
+        if digest:
+            return name, digest
+    return None
@@ -0,0 +1,64 @@
+#-*- coding: utf-8 -*-
+
+import re
+import random
+
+#fixed seed, so chunk boundaries are stable across processes and releases
+_random = random.Random(0x7ba4)
+_bits = ['0'] * 128 + ['1'] * 128
+_random.shuffle(_bits)
+#one pseudo random bit per byte value, as a translate() table
+BITS = ''.join(_bits)
+
+class ContentDefinedChunker(object):
+    '''
+        Splits a byte stream at content defined boundaries, so an insertion
+        only changes the chunks around it. Bytes are mapped to one pseudo
+        random bit each and a boundary is cut after a run of bits bits
+        equal to 100...0, so it depends on the last bits bytes only and
+        comes every 2 ** bits bytes on average. The scan is done by
+        translate() and a regular expression, not byte by byte in Python.
+        Chunk sizes stay between avg_size / 4 and avg_size * 8.
+    '''
+
+    def __init__(self, avg_size=8192):
+        bits = max(avg_size.bit_length() - 1, 6)
+        self.bits = bits
+        #not overlapping itself, so matches are 2 ** bits bytes apart on average
+        self.boundary = re.compile('1' + '0' * (bits - 1))
+        self.min_size = (1 << bits) / 4
+        self.max_size = (1 << bits) * 8
+        self.buf = bytearray()
+        self.pos = 0
+
+    def feed(self, data):
+        '''Returns the chunks completed by data'''
+        self.buf.extend(data)
+        chunks = []
+        while True:
+            cut = self._find_cut()
+            if cut is None:
+                return chunks
+            chunks.append(str(self.buf[:cut]))
+            del self.buf[:cut]
+            self.pos = 0
+
+    def flush(self):
+        '''Returns the last, possibly short, chunk'''
+        chunk = str(self.buf)
+        self.buf = bytearray()
+        self.pos = 0
+        return chunk
+
+    def _find_cut(self):
+        end = min(len(self.buf), self.max_size)
+        #the first min_size bytes never end a boundary, and the bytes
+        #scanned before are only looked at again as the start of a run
+        start = max(self.pos, self.min_size) - self.bits + 1
+        found = self.boundary.search(self.buf[start:end].translate(BITS))
+        if found:
+            return start + found.end()
+        if end == self.max_size:
+            return end
+        self.pos = max(end, self.min_size)
+        return None
@@ -0,0 +1,127 @@
+#-*- coding: utf-8 -*-
+
+import bz2
+import math
+import zlib
+import logging
+from collections import Counter, OrderedDict
+
+from .streams import IterFile, skipped
+
+#codec name: (compressor factory taking a level, decompressor factory)
+CODECS = OrderedDict([
+    ('zlib', (lambda level: zlib.compressobj(level),
+              lambda: zlib.decompressobj())),
+    ('gzip', (lambda level: zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS),
+              lambda: zlib.decompressobj(16 + zlib.MAX_WBITS))),
+    ('bz2',  (lambda level: bz2.BZ2Compressor(max(level, 1)),
+              lambda: bz2.BZ2Decompressor())),
+])
+try:
+    #stdlib from Python 3.3, backports.lzma before
+    try:
+        import lzma
+    except ImportError:
+        from backports import lzma
+    CODECS['lzma'] = (lambda level: lzma.LZMACompressor(preset=level),
+                      lambda: lzma.LZMADecompressor())
+except ImportError:
+    pass
+
+def entropy(sample):
+    '''Shannon entropy of sample, in bits per byte (0 to 8)'''
+    if not sample:
+        return 0.0
+    total = float(len(sample))
+    return -sum(n / total * math.log(n / total, 2)
+                for n in Counter(sample).itervalues())
+
+class CompressingWriter(object):
+    '''
+        Compresses the written stream into f. The codec is settled on the
+        first write: when its entropy is above skip_entropy the data is
+        taken as already compressed (zip, jpeg, ...) and written verbatim,
+        and codec becomes ''. size counts the uncompressed bytes. on_close
+        is called with the writer once everything was written.
+    '''
+
+    def __init__(self, f, codec, level=6, skip_entropy=None, on_close=None,
+                 sample_size=64 * 1024):
+        self.f = f
+        self.on_close = on_close
+        self.codec = codec
+        self.level = level
+        self.skip_entropy = skip_entropy
+        self.sample_size = sample_size
+        self.compressor = None
+        self.decided = False
+        self.size = 0
+        self.closed = False
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, *exc_info):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+    def _decide(self, sample):
+        self.decided = True
+        if self.skip_entropy is not None and entropy(sample[:self.sample_size]) > self.skip_entropy:
+            self.codec = ''
+        else:
+            self.compressor = CODECS[self.codec][0](self.level)
+
+    def write(self, data):
+        if not self.decided:
+            self._decide(data)
+        self.size += len(data)
+        if self.compressor is None:
+            self.f.write(data)
+            return
+        data = self.compressor.compress(data)
+        if data:
+            self.f.write(data)
+
+    def close(self):
+        if self.closed:
+            return
+        if not self.decided:
+            self._decide('')
+        self.closed = True
+        if self.compressor is not None:
+            self.f.write(self.compressor.flush())
+        self.f.close()
+        if self.on_close is not None:
+            self.on_close(self)
+
+    def abort(self):
+        '''Closes f without the compressed stream's trailer'''
+        if self.closed:
+            return
+        self.closed = True
+        try:
+            self.f.close()
+        except Exception, e:
+            logging.error(e)
+
+def _decompressed(f, codec, chunk_size):
+    decompressor = CODECS[codec][1]()
+    for chunk in iter(lambda: f.read(chunk_size), ''):
+        data = decompressor.decompress(chunk)
+        if data:
+            yield data
+    #bz2 decompressors have no flush
+    data = getattr(decompressor, 'flush', lambda: '')()
+    if data:
+        yield data
+
+def decompressing(f, codec, offset=0, chunk_size=64 * 1024):
+    '''
+        Read only file with the decompressed contents of f, from offset
+        (the bytes before it still have to be decompressed). f is closed
+        with it.
+    '''
+    return IterFile(skipped(_decompressed(f, codec, chunk_size), offset), f.close)
@@ -0,0 +1,262 @@
+#-*- coding: utf-8 -*-
+
+import os
+import time
+import zlib
+import struct
+import marshal
+import hashlib
+import logging
+import tempfile
+
+from .streams import IterFile, skipped
+
+#rsync style delta of a stream against a base:
+#   MAGIC, block size, then operations until the end of the stream
+#   'L' length data     literal bytes
+#   'C' offset length   bytes copied from the base
+MAGIC = 'TBD1'
+HEADER = struct.Struct('>4sI')
+LITERAL = struct.Struct('>cI')
+COPY = struct.Struct('>cQQ')
+
+#adler32 modulus, the weak checksum is rolled with the same arithmetic
+MOD = 65521
+
+def signature(f, block_size, chunk_size=64 * 1024):
+    '''
+        {weak checksum: {md5 digest: block index}} of the whole blocks of
+        f, the first index of each block being kept
+    '''
+    table, index, buf = {}, 0, ''
+    for data in iter(lambda: f.read(chunk_size), ''):
+        buf += data
+        for start in xrange(0, len(buf) - block_size + 1, block_size):
+            block = buf[start:start + block_size]
+            strong = table.setdefault(zlib.adler32(block) & 0xffffffff, {})
+            strong.setdefault(hashlib.md5(block).digest(), index)
+            index += 1
+        buf = buf[len(buf) - len(buf) % block_size:]
+    return table
+
+class SignatureCache(object):
+    '''
+        signature() tables of delta bases kept in directory, one marshal
+        file each, so a new version does not reread and rehash its base.
+        Tables are keyed by the base's SHA-256 and block size, which is all
+        they depend on. Files not used for max_age seconds are removed
+        when a new one is stored.
+    '''
+
+    def __init__(self, directory, max_age=7 * 24 * 3600):
+        self.directory = directory
+        self.max_age = max_age
+
+    def path(self, sha256, block_size):
+        return os.path.join(self.directory, '%s-%d.sig' % (sha256, block_size))
+
+    def get(self, sha256, block_size, open_base):
+        '''The table of the base with sha256, from open_base() when not kept yet'''
+        fn = self.path(sha256, block_size)
+        try:
+            with open(fn, 'rb') as f:
+                table = marshal.load(f)
+            os.utime(fn, None)
+            return table
+        except (IOError, OSError, EOFError, ValueError, TypeError):
+            pass
+        base = open_base()
+        if base is None:
+            return None
+        try:
+            table = signature(base, block_size)
+        finally:
+            base.close()
+        try:
+            self.store(fn, table)
+        except (IOError, OSError), e:
+            logging.warning('delta signature not cached: %s', e)
+        return table
+
+    def store(self, fn, table):
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+        #written aside and renamed, so readers never see half a table
+        with tempfile.NamedTemporaryFile(dir=self.directory, suffix='.tmp', delete=False) as f:
+            f.write(marshal.dumps(table))
+        os.rename(f.name, fn)
+        limit = time.time() - self.max_age
+        for name in os.listdir(self.directory):
+            path = os.path.join(self.directory, name)
+            try:
+                if os.path.getmtime(path) < limit:
+                    os.remove(path)
+            except OSError:
+                pass
+
+class DeltaWriter(object):
+    '''
+        Writes to f the delta of the written stream against table, the
+        signature() of its base. Blocks found in the base at any
+        offset become copies, anything else is written as literals; bytes
+        are only rolled one at a time after a miss, so unchanged runs cost
+        one adler32 and one md5 per block. size counts the written bytes.
+    '''
+
+    def __init__(self, f, table, block_size=8 * 1024, max_literal=256 * 1024):
+        self.f = f
+        self.table = table
+        self.block_size = block_size
+        self.max_literal = max_literal
+        self.buf = ''
+        self.pos = 0            #start of the window in buf
+        self.literal = 0        #start of the pending literal in buf
+        self.weak = None        #weak checksum of the window, when known
+        self.copy = None        #pending (offset, length) copy
+        self.size = 0
+        self.started = False
+        self.closed = False
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        if exc_type is None:
+            self.close()
+        else:
+            self.closed = True
+            self.f.__exit__(exc_type, exc_value, tb)
+
+    def write(self, data):
+        self.size += len(data)
+        self.buf += str(data)
+        self._scan()
+
+    def _scan(self):
+        n, buf, table = self.block_size, self.buf, self.table
+        get, md5, mod = table.get, hashlib.md5, MOD
+        #ints by index for the roll, without an ord() per byte
+        octets = bytearray(buf)
+        pos, weak = self.pos, self.weak
+        end = len(buf) - n
+        while pos <= end:
+            if weak is None:
+                weak = zlib.adler32(buf[pos:pos + n]) & 0xffffffff
+            candidates = get(weak)
+            if candidates is not None:
+                index = candidates.get(md5(buf[pos:pos + n]).digest())
+                if index is not None:
+                    self._emit_literal(buf[self.literal:pos])
+                    self._emit_copy(index * n, n)
+                    pos += n
+                    self.literal, weak = pos, None
+                    continue
+            if pos == end:
+                #the next byte is not here yet
+                weak = None
+                pos += 1
+                break
+            #rolls through the misses up to the next candidate, the end
+            #of the data or the longest literal, whichever comes first
+            stop = min(end, self.literal + self.max_literal)
+            a, b = weak & 0xffff, weak >> 16
+            while True:
+                out, new = octets[pos], octets[pos + n]
+                a = (a - out + new) % mod
+                b = (b - n * out + a - 1) % mod
+                pos += 1
+                weak = (b << 16) | a
+                if pos >= stop or weak in table:
+                    break
+            if pos - self.literal >= self.max_literal:
+                self._emit_literal(buf[self.literal:pos])
+                self.literal = pos
+        #keeps the pending literal and the window
+        start = min(self.literal, pos)
+        self.buf = buf[start:]
+        self.pos, self.literal, self.weak = pos - start, self.literal - start, weak
+
+    def _write(self, data):
+        #operations go out whole, so writers below (compression deciding
+        #on entropy) see data rather than headers
+        if not self.started:
+            self.started = True
+            data = HEADER.pack(MAGIC, self.block_size) + data
+        self.f.write(data)
+
+    def _emit_literal(self, data):
+        if not data:
+            return
+        self._flush_copy()
+        self._write(LITERAL.pack('L', len(data)) + data)
+
+    def _emit_copy(self, offset, length):
+        if self.copy is not None and sum(self.copy) == offset:
+            self.copy = (self.copy[0], self.copy[1] + length)
+            return
+        self._flush_copy()
+        self.copy = (offset, length)
+
+    def _flush_copy(self):
+        if self.copy is not None:
+            self._write(COPY.pack('C', *self.copy))
+            self.copy = None
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        self._emit_literal(self.buf[self.literal:])
+        self._flush_copy()
+        if not self.started:
+            self._write('')
+        self.f.close()
+
+def _read(f, size):
+    data = f.read(size)
+    if len(data) != size:
+        raise IOError('Truncated delta')
+    return data
+
+def _patched(base, delta, chunk_size):
+    magic, block_size = HEADER.unpack(_read(delta, HEADER.size))
+    if magic != MAGIC:
+        raise IOError('Not a delta')
+    for op in iter(lambda: delta.read(1), ''):
+        if op == 'L':
+            length = LITERAL.unpack(op + _read(delta, LITERAL.size - 1))[1]
+            while length:
+                data = _read(delta, min(length, chunk_size))
+                length -= len(data)
+                yield data
+        elif op == 'C':
+            offset, length = COPY.unpack(op + _read(delta, COPY.size - 1))[1:]
+            base.seek(offset)
+            while length:
+                data = base.read(min(length, chunk_size))
+                if not data:
+                    raise IOError('Delta copies past the end of its base')
+                length -= len(data)
+                yield data
+        else:
+            raise IOError('Unknown delta operation %r' % op)
+
+def patched(base, delta, offset=0, chunk_size=64 * 1024):
+    '''
+        Read only file with base patched by delta, from offset. Copies may
+        point anywhere in base: it is read where they point when it is
+        seekable (a whole file of a local or SFTP destination), otherwise
+        spooled to a temporary file first. Both files are closed with it.
+    '''
+    if getattr(base, 'seekable', lambda: False)():
+        return IterFile(skipped(_patched(base, delta, chunk_size), offset), base.close, delta.close)
+    spool = tempfile.TemporaryFile()
+    try:
+        for data in iter(lambda: base.read(chunk_size), ''):
+            spool.write(data)
+    except:
+        spool.close()
+        raise
+    finally:
+        base.close()
+    return IterFile(skipped(_patched(spool, delta, chunk_size), offset), spool.close, delta.close)
@@ -0,0 +1,93 @@
+#-*- coding: utf-8 -*-
+
+import os
+import time
+import logging
+import select
+import httplib
+import threading
+
+from django.conf import settings
+
+class HTTPConnectionPool(object):
+    '''
+        Per process pool of keep-alive httplib connections, keyed by
+        (scheme, host, port). At most max_per_host idle connections are
+        kept per key, each for max_idle seconds; connections in use are
+        not counted.
+    '''
+
+    def __init__(self, max_per_host=8, max_idle=60, timeout=30.0):
+        self.max_per_host = max_per_host
+        self.max_idle = max_idle
+        self.timeout = timeout
+        self.lock = threading.Lock()
+        self._reset()
+
+    def _reset(self):
+        self.pid = os.getpid()
+        self.idle = {}     #key -> [(connection, released_at), ...]
+
+    def acquire(self, scheme, host, port):
+        key = (scheme, host, port)
+        limit = time.time() - self.max_idle
+        with self.lock:
+            #sockets are not shared with forked workers
+            if self.pid != os.getpid():
+                self._reset()
+            connections = self.idle.get(key, [])
+            while connections:
+                conn, released_at = connections.pop()
+                if released_at >= limit and not self._dropped(conn):
+                    conn.key = key
+                    return conn
+                self._close(conn)
+        cls = httplib.HTTPSConnection if scheme == 'https' else httplib.HTTPConnection
+        conn = cls(host, port, timeout=self.timeout)
+        conn.key = key
+        return conn
+
+    def release(self, conn, reuse=True):
+        '''
+            Gives conn back once its last response was read, or closes it
+            when reuse is False (errors, unread bodies, Connection: close)
+        '''
+        if not reuse or conn.sock is None:
+            self._close(conn)
+            return
+        with self.lock:
+            connections = self.idle.setdefault(conn.key, [])
+            if len(connections) >= self.max_per_host:
+                self._close(conn)
+            else:
+                connections.append((conn, time.time()))
+
+    def clear(self):
+        '''Closes every idle connection'''
+        with self.lock:
+            for connections in self.idle.values():
+                for conn, released_at in connections:
+                    self._close(conn)
+            self.idle = {}
+
+    def _dropped(self, conn):
+        '''
+            An idle keep-alive socket is only readable when the server
+            closed it, a request on it would fail after being sent
+        '''
+        try:
+            return bool(select.select([conn.sock], [], [], 0)[0])
+        except (select.error, ValueError, TypeError):
+            return True
+
+    def _close(self, conn):
+        try:
+            conn.close()
+        except Exception, e:
+            logging.warning(e)
+
+pool = HTTPConnectionPool(
+    max_per_host = getattr(settings, 'API_POOL_SIZE', 8),
+    max_idle     = getattr(settings, 'API_POOL_MAX_IDLE', 60),
+    timeout      = getattr(settings, 'API_TIMEOUT', 30.0),
+)
@@ -0,0 +1,182 @@
+#-*- coding: utf-8 -*-
+
+import os
+import time
+import logging
+import threading
+
+import paramiko
+
+from django.conf import settings
+
+class SFTPConnectionPool(object):
+    '''
+        Per process pool of authenticated SSH transports and their SFTP
+        channels, keyed by (hostname, port, username, key_filename).
+
+        Idle sessions are reused after a health check, evicted after
+        max_idle seconds and the total number of open sessions (idle or in
+        use) never exceeds max_size.
+    '''
+
+    def __init__(self, max_size=8, max_idle=300, keepalive=30, timeout=30.0):
+        self.max_size = max_size
+        self.max_idle = max_idle
+        self.keepalive = keepalive
+        self.timeout = timeout
+        self.cond = threading.Condition(threading.Lock())
+        self._reset()
+
+    def _reset(self):
+        self.pid = os.getpid()
+        self.idle = {}     #key -> [(client, sftp, released_at), ...]
+        self.in_use = {}   #id(sftp) -> (key, client)
+        self.size = 0
+
+    def acquire(self, key, factory, block=True):
+        '''
+            Returns an SFTP session for key, reusing an idle one when
+            possible. factory() must return a connected SSHClient.
+            Without block, returns None rather than waiting for a session
+            to be released: callers already holding sessions must not
+            wait for more, or two of them can wait on each other.
+        '''
+        deadline = time.time() + self.timeout
+        while True:
+            session = None
+            with self.cond:
+                #sockets are not shared with forked workers
+                if self.pid != os.getpid():
+                    self._reset()
+                while True:
+                    self._evict_expired()
+                    if self.idle.get(key):
+                        #still counted in size while it is probed
+                        session = self.idle[key].pop()
+                        break
+                    if self.size < self.max_size or self._evict_oldest():
+                        self.size += 1
+                        break
+                    if not block:
+                        return None
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        raise IOError('SFTP connection pool exhausted (%d sessions)' % self.max_size)
+                    self.cond.wait(remaining)
+            if session is None:
+                break
+            #probed outside the lock, so a slow server does not hold up other keys
+            client, sftp, released_at = session
+            if self._healthy(client, sftp, released_at):
+                with self.cond:
+                    self.in_use[id(sftp)] = (key, client)
+                return sftp
+            self._close(client, sftp)
+            with self.cond:
+                self.size -= 1
+                self.cond.notify()
+
+        #handshake happens outside the lock, so other keys are not blocked
+        try:
+            client = factory()
+            if self.keepalive:
+                client.get_transport().set_keepalive(self.keepalive)
+            sftp = client.open_sftp()
+        except:
+            with self.cond:
+                self.size -= 1
+                self.cond.notify()
+            raise
+        with self.cond:
+            self.in_use[id(sftp)] = (key, client)
+        return sftp
+
+    def release(self, sftp, discard=False):
+        '''Returns sftp to the pool, or closes it when discard is set'''
+        with self.cond:
+            key, client = self.in_use.pop(id(sftp), (None, None))
+            if key is None:
+                #not pooled (e.g. opened before a fork or by a test double)
+                self._close(None, sftp)
+                return
+            if discard or not self._healthy(client, sftp, time.time()):
+                self._close(client, sftp)
+                self.size -= 1
+            else:
+                sftp.chdir(None)
+                self.idle.setdefault(key, []).append((client, sftp, time.time()))
+            self.cond.notify()
+
+    def clear(self):
+        '''Closes every idle session'''
+        with self.cond:
+            for sessions in self.idle.values():
+                for client, sftp, released_at in sessions:
+                    self._close(client, sftp)
+                    self.size -= 1
+            self.idle = {}
+            self.cond.notify_all()
+
+    def _healthy(self, client, sftp, released_at):
+        transport = client.get_transport()
+        if transport is None or not transport.is_active():
+            return False
+        #sessions idle longer than a keepalive period get a round trip probe
+        if self.keepalive and time.time() - released_at > self.keepalive:
+            try:
+                sftp.normalize('.')
+            except Exception, e:
+                logging.warning(e)
+                return False
+        return True
+
+    def _evict_expired(self):
+        limit = time.time() - self.max_idle
+        for key, sessions in self.idle.items():
+            for session in [s for s in sessions if s[2] < limit]:
+                sessions.remove(session)
+                self._close(session[0], session[1])
+                self.size -= 1
+            if not sessions:
+                del self.idle[key]
+
+    def _evict_oldest(self):
+        sessions = [(s[2], key, s) for key, l in self.idle.items() for s in l]
+        if not sessions:
+            return False
+        released_at, key, session = min(sessions)
+        self.idle[key].remove(session)
+        self._close(session[0], session[1])
+        self.size -= 1
+        return True
+
+    def _close(self, client, sftp):
+        try:
+            sftp.close()
+            if client:
+                client.close()
+        except Exception, e:
+            logging.warning(e)
+
+_keys = {}
+_keys_lock = threading.Lock()
+
+def load_private_key(filename):
+    '''Parses the RSA key file once per modification time'''
+    filename = os.path.expanduser(filename)
+    mtime = os.path.getmtime(filename)
+    with _keys_lock:
+        cached = _keys.get(filename)
+        if cached and cached[0] == mtime:
+            return cached[1]
+    pvtkey = paramiko.RSAKey.from_private_key_file(filename)
+    with _keys_lock:
+        _keys[filename] = (mtime, pvtkey)
+    return pvtkey
+
+pool = SFTPConnectionPool(
+    max_size  = getattr(settings, 'SFTP_POOL_SIZE', 8),
+    max_idle  = getattr(settings, 'SFTP_POOL_MAX_IDLE', 300),
+    keepalive = getattr(settings, 'SFTP_POOL_KEEPALIVE', 30),
+    timeout   = getattr(settings, 'SFTP_POOL_TIMEOUT', 30.0),
+)
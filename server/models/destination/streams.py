@@ -0,0 +1,327 @@
+#-*- coding: utf-8 -*-
+
+import time
+import Queue
+import threading
+
+class ClosingFile(object):
+    '''
+        Wraps a file opened on a destination and runs the cleanup callbacks
+        (closing the SFTP session, etc.) once the file is closed.
+        Iterating over it lazily yields chunks of chunk_size bytes.
+    '''
+    
+    chunk_size = 64 * 1024
+
+    def __init__(self, f, *callbacks):
+        self.f = f
+        self.callbacks = callbacks
+        self.closed = False
+
+    def __getattr__(self, attr):
+        return getattr(self.f, attr)
+
+    def __iter__(self):
+        return iter(lambda: self.read(self.chunk_size), '')
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def write(self, data):
+        return self.f.write(data)
+
+    def read(self, *args):
+        return self.f.read(*args)
+
+    def seekable(self):
+        #as readinto(), wrappers that change the bytes can not seek
+        return type(self).read == ClosingFile.read and hasattr(self.f, 'seek')
+
+    def readinto(self, b):
+        #straight into b only when read() is not overridden, wrappers
+        #that change the bytes must see them
+        if type(self).read == ClosingFile.read and hasattr(self.f, 'readinto'):
+            return self.f.readinto(b)
+        data = self.read(len(b))
+        b[:len(data)] = data
+        return len(data)
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        try:
+            #generators and other iterables may have nothing to close
+            getattr(self.f, 'close', lambda: None)()
+        finally:
+            for callback in self.callbacks:
+                callback()
+
+class NullWriter(object):
+    '''Writer that discards what is written to it'''
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def write(self, data):
+        pass
+
+    def close(self):
+        pass
+
+class LimitedFile(ClosingFile):
+    '''ClosingFile that reads at most length bytes, for ranged downloads'''
+
+    def __init__(self, f, length, *callbacks):
+        super(LimitedFile, self).__init__(f, *callbacks)
+        self.remaining = length
+
+    def read(self, size=-1):
+        if size < 0 or size > self.remaining:
+            size = self.remaining
+        data = self.f.read(size) if size else ''
+        self.remaining -= len(data)
+        return data
+
+class IterFile(ClosingFile):
+    '''Read only file over an iterator of strings'''
+
+    def __init__(self, iterable, *callbacks):
+        super(IterFile, self).__init__(iterable, *callbacks)
+        self.it = iter(iterable)
+        self.buf = ''
+
+    def read(self, size=-1):
+        while size < 0 or len(self.buf) < size:
+            data = next(self.it, None)
+            if data is None:
+                break
+            self.buf += data
+        if size < 0:
+            size = len(self.buf)
+        data, self.buf = self.buf[:size], self.buf[size:]
+        return data
+
+def skipped(chunks, skip):
+    '''chunks without their first skip bytes'''
+    for data in chunks:
+        if skip >= len(data):
+            skip -= len(data)
+            continue
+        yield data[skip:]
+        skip = 0
+
+class TeeWriter(object):
+    '''
+        Copies one written stream to several writers concurrently. Each
+        writer has its own thread fed through a bounded queue, so the
+        stream advances at the pace of the slowest writer and memory stays
+        at buffer_chunks chunks per writer. A failing writer is dropped
+        and its error kept in errors; close() raises the first writer's.
+    '''
+
+    def __init__(self, writers, buffer_chunks=8):
+        self.writers = writers
+        self.errors = [None] * len(writers)
+        self.queues = [Queue.Queue(buffer_chunks) for writer in writers]
+        self.threads = [threading.Thread(target=self._run, args=(i,))
+                        for i in range(len(writers))]
+        self.closed = False
+        for thread in self.threads:
+            thread.daemon = True
+            thread.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def _run(self, i):
+        writer, queue = self.writers[i], self.queues[i]
+        #keeps draining after an error, so write() never blocks on this writer
+        for data in iter(queue.get, None):
+            if self.errors[i] is None:
+                try:
+                    writer.write(data)
+                except Exception, e:
+                    self.errors[i] = e
+        try:
+            writer.close()
+        except Exception, e:
+            if self.errors[i] is None:
+                self.errors[i] = e
+
+    def write(self, data):
+        #queued past this call, so pooled buffers are copied
+        data = str(data)
+        for queue in self.queues:
+            queue.put(data)
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        for queue in self.queues:
+            queue.put(None)
+        for thread in self.threads:
+            thread.join()
+        if self.errors[0] is not None:
+            raise self.errors[0]
+
+class StripedWriter(object):
+    '''
+        Writes one stream through several handles of the same file at
+        once: stripe n, of stripe_size bytes, is written at its offset by
+        handle n % len(files) from that handle's thread. At most two
+        stripes per handle wait in memory. The first error is raised by
+        the next write() or by close(), which also closes the handles and
+        then runs the callbacks.
+    '''
+
+    def __init__(self, files, stripe_size, *callbacks):
+        self.files = files
+        self.stripe_size = stripe_size
+        self.callbacks = callbacks
+        self.buf = []
+        self.buffered = 0
+        self.offset = 0
+        self.stripe = 0
+        self.errors = []
+        self.queues = [Queue.Queue(2) for f in files]
+        self.threads = [threading.Thread(target=self._run, args=(i,))
+                        for i in range(len(files))]
+        self.closed = False
+        for thread in self.threads:
+            thread.daemon = True
+            thread.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def _run(self, i):
+        f, queue = self.files[i], self.queues[i]
+        #keeps draining after an error, so write() never blocks
+        for offset, data in iter(queue.get, None):
+            if not self.errors:
+                try:
+                    f.seek(offset)
+                    f.write(data)
+                except Exception, e:
+                    self.errors.append(e)
+
+    def _dispatch(self, data):
+        self.queues[self.stripe % len(self.queues)].put((self.offset, data))
+        self.stripe += 1
+        self.offset += len(data)
+
+    def write(self, data):
+        if self.errors:
+            raise self.errors[0]
+        self.buf.append(str(data))
+        self.buffered += len(data)
+        if self.buffered < self.stripe_size:
+            return
+        data = ''.join(self.buf)
+        for start in xrange(0, len(data) - self.stripe_size + 1, self.stripe_size):
+            self._dispatch(data[start:start + self.stripe_size])
+        rest = data[start + self.stripe_size:]
+        self.buf = [rest] if rest else []
+        self.buffered = len(rest)
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        try:
+            if self.buffered:
+                self._dispatch(''.join(self.buf))
+                self.buf = []
+            for queue in self.queues:
+                queue.put(None)
+            for thread in self.threads:
+                thread.join()
+            for f in self.files:
+                try:
+                    f.close()
+                except Exception, e:
+                    self.errors.append(e)
+        finally:
+            for callback in self.callbacks:
+                callback()
+        if self.errors:
+            raise self.errors[0]
+
+def striped_read(readers, offset, end, stripe_size):
+    '''
+        Yields, in order, bytes offset to end of a file read in stripes
+        by several readers at once, reader(start, length) returning the
+        bytes. Each reader has its own thread and runs at most two stripes
+        ahead, so a single reader is a bounded read-ahead.
+    '''
+    n = len(readers)
+    queues = [Queue.Queue(2) for reader in readers]
+    stop = threading.Event()
+
+    def run(i):
+        for start in xrange(offset + i * stripe_size, end, n * stripe_size):
+            try:
+                item = readers[i](start, min(stripe_size, end - start))
+            except Exception, e:
+                item = e
+            #gives up when the consumer went away
+            while not stop.is_set():
+                try:
+                    queues[i].put(item, timeout=0.1)
+                    break
+                except Queue.Full:
+                    pass
+            if stop.is_set() or isinstance(item, Exception):
+                return
+
+    threads = [threading.Thread(target=run, args=(i,)) for i in range(n)]
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+    try:
+        for k, start in enumerate(xrange(offset, end, stripe_size)):
+            item = queues[k % n].get()
+            if isinstance(item, Exception):
+                raise item
+            yield item
+    finally:
+        stop.set()
+        for thread in threads:
+            thread.join()
+
+class RateLimiter(object):
+    '''
+        Token bucket shared by threads: consume(n) returns once n more
+        bytes fit in rate bytes per second, allowing bursts of one second
+    '''
+
+    def __init__(self, rate):
+        self.rate = float(rate)
+        self.allowance = self.rate
+        self.last = time.time()
+        self.lock = threading.Lock()
+
+    def consume(self, n):
+        with self.lock:
+            now = time.time()
+            self.allowance = min(self.rate, self.allowance + (now - self.last) * self.rate)
+            self.last = now
+            #a debt makes the following callers wait too
+            self.allowance -= n
+            wait = -self.allowance / self.rate
+        if wait > 0:
+            time.sleep(wait)
@@ -0,0 +1,38 @@
+#-*- coding: utf-8 -*-
+
+import base64
+
+from django.db.models import Q
+from django.utils.dateparse import parse_datetime
+
+class InvalidCursor(Exception):
+    pass
+
+def encode_cursor(obj):
+    return base64.urlsafe_b64encode('%s|%d' % (obj.date.isoformat(), obj.id))
+
+def decode_cursor(cursor):
+    try:
+        date, pk = base64.urlsafe_b64decode(str(cursor)).rsplit('|', 1)
+        date, pk = parse_datetime(date), int(pk)
+    except (TypeError, ValueError):
+        raise InvalidCursor(cursor)
+    if date is None:
+        raise InvalidCursor(cursor)
+    return date, pk
+
+def paginate_keyset(queryset, cursor=None, page_size=100):
+    '''
+        Newest first page of queryset after cursor, ordered by (date, id).
+        Seeks through the (user, date) index instead of counting and
+        OFFSETing, so every page costs the same whatever the history size.
+        Returns the rows and the cursor of the next page (None at the end).
+    '''
+    queryset = queryset.order_by('-date', '-id')
+    if cursor:
+        date, pk = decode_cursor(cursor)
+        queryset = queryset.filter(Q(date__lt=date) | Q(date=date, id__lt=pk))
+    rows = list(queryset[:page_size + 1])
+    if len(rows) > page_size:
+        return rows[:page_size], encode_cursor(rows[page_size - 1])
+    return rows, None
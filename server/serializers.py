@@ -3,9 +3,12 @@ from rest_framework.authtoken.serializers import AuthTokenSerializer
 
 from django.contrib.auth.models import User, AnonymousUser
 from server.models import ( Backup
+                          , UploadSession
+                          , TransferJob
                           , BaseDestination
                           , LocalDestination
                           , SFTPDestination
+                          , DedupDestination
                           )
 
 # Serializers define the API representation.
@@ -52,17 +55,25 @@ class LocalDestinationSerializer(serializers.HyperlinkedModelSerializer):
 class SFTPDestinationSerializer(serializers.HyperlinkedModelSerializer):
     class Meta:
         model = SFTPDestination
-        fields = ('directory', 'hostname', 'port', 'username', 'key_filename')
+        fields = ('directory', 'hostname', 'port', 'username', 'key_filename', 'chunk_size', 'streams')
+
+class DedupDestinationSerializer(serializers.HyperlinkedModelSerializer):
+    class Meta:
+        model = DedupDestination
+        fields = ('directory', 'avg_chunk_size')
 
 class DestinationSerializer(serializers.HyperlinkedModelSerializer):
     type = fields.CharField(max_length=30)
     localdestination = LocalDestinationSerializer(required=False)
     sftpdestination = SFTPDestinationSerializer(required=False)
+    dedupdestination = DedupDestinationSerializer(required=False)
     
     class Meta:
         model = BaseDestination
         fields = ('id', 'url', 'name', 'type', 'localdestination'
-                 , 'sftpdestination', 'date_created', 'date_modified'
+                 , 'sftpdestination', 'dedupdestination'
+                 , 'compression', 'compression_level', 'delta_chain'
+                 , 'date_created', 'date_modified'
                  )
         read_only_fields = ('date_created', 'date_modified')
         
@@ -76,6 +87,10 @@ class DestinationSerializer(serializers.HyperlinkedModelSerializer):
             for field in ( 'type'
                          , 'localdestination'
                          , 'sftpdestination'
+                         , 'dedupdestination'
+                         , 'compression'
+                         , 'compression_level'
+                         , 'delta_chain'
                          , 'date_created'
                          , 'date_modified'):
                 fields.pop(field)
@@ -88,8 +103,15 @@ class DestinationSerializer(serializers.HyperlinkedModelSerializer):
         new_attrs = dict()
         new_attrs['name'] = attrs['name']
         
+        for field in ('compression', 'compression_level', 'delta_chain'):
+            if field in attrs:
+                new_attrs[field] = attrs[field]
+        
         if instance:
             instance.name = attrs.get('name', instance.name)
+            instance.compression = attrs.get('compression', instance.compression)
+            instance.compression_level = attrs.get('compression_level', instance.compression_level)
+            instance.delta_chain = attrs.get('delta_chain', instance.delta_chain)
             
             if instance.type == 'LocalDestination':
                 localdestination = attrs.get('localdestination')
@@ -102,6 +124,13 @@ class DestinationSerializer(serializers.HyperlinkedModelSerializer):
                 instance.port = sftpdestination.port if sftpdestination.port else instance.sftpdestination.port
                 instance.username = sftpdestination.username if sftpdestination.username else instance.sftpdestination.username
                 instance.key_filename = sftpdestination.key_filename if sftpdestination.key_filename else instance.sftpdestination.key_filename
+                instance.chunk_size = sftpdestination.chunk_size if sftpdestination.chunk_size else instance.sftpdestination.chunk_size
+                instance.streams = sftpdestination.streams if sftpdestination.streams else instance.sftpdestination.streams
+                
+            elif instance.type == 'DedupDestination':
+                dedupdestination = attrs.get('dedupdestination')
+                instance.directory = dedupdestination.directory if dedupdestination.directory else instance.dedupdestination.directory
+                instance.avg_chunk_size = dedupdestination.avg_chunk_size if dedupdestination.avg_chunk_size else instance.dedupdestination.avg_chunk_size
                 
             return instance
             
@@ -114,7 +143,13 @@ class DestinationSerializer(serializers.HyperlinkedModelSerializer):
             new_attrs['port'] = attrs['sftpdestination'].port
             new_attrs['username'] = attrs['sftpdestination'].username
             new_attrs['key_filename'] = attrs['sftpdestination'].key_filename
+            new_attrs['chunk_size'] = attrs['sftpdestination'].chunk_size
+            new_attrs['streams'] = attrs['sftpdestination'].streams
             return SFTPDestination(**new_attrs)
+        elif attrs['type'] == 'DedupDestination':
+            new_attrs['directory'] = attrs['dedupdestination'].directory
+            new_attrs['avg_chunk_size'] = attrs['dedupdestination'].avg_chunk_size
+            return DedupDestination(**new_attrs)
         else:
             raise Exception('destination type is not implemented')    
 
@@ -123,7 +158,8 @@ class BackupSerializer(serializers.HyperlinkedModelSerializer):
     
     class Meta:
         model = Backup
-        fields = ('id', 'url', 'name', 'file', 'destination', 'date')
+        fields = ('id', 'url', 'name', 'file', 'destination', 'date', 'size', 'sha256')
+        read_only_fields = ('size', 'sha256')
     
     #overrides user attribute with current logged in user
     def restore_object(self, attrs, instance=None):
@@ -132,4 +168,35 @@ class BackupSerializer(serializers.HyperlinkedModelSerializer):
         if backup.file:
             backup.file.name = backup.name
         return backup
-    
\ No newline at end of file
+
+class UploadSessionSerializer(serializers.HyperlinkedModelSerializer):
+    destination = serializers.SlugRelatedField(slug_field='name')
+    received = serializers.SerializerMethodField('get_received')
+    backup = serializers.HyperlinkedRelatedField(view_name='backup-detail', read_only=True)
+    
+    class Meta:
+        model = UploadSession
+        fields = ('id', 'url', 'name', 'destination', 'date', 'size', 'received', 'backup')
+    
+    def get_received(self, obj):
+        return obj.received()
+    
+    def validate_destination(self, attrs, source):
+        destination = attrs[source]
+        if not destination.destination_impl.offset_writes:
+            raise serializers.ValidationError(u'%s does not take chunked uploads' % destination.type)
+        return attrs
+    
+    #overrides user attribute with current logged in user
+    def restore_object(self, attrs, instance=None):
+        attrs[u'user'] = self.context.get('request').user
+        return UploadSession(**attrs)
+
+class TransferJobSerializer(serializers.HyperlinkedModelSerializer):
+    backup = serializers.HyperlinkedRelatedField(view_name='backup-detail', read_only=True)
+    
+    class Meta:
+        model = TransferJob
+        fields = ('id', 'url', 'backup', 'status', 'attempts', 'error'
+                 , 'date_created', 'started', 'finished', 'not_before'
+                 )
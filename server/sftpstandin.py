@@ -0,0 +1,274 @@
+#-*- coding: utf-8 -*-
+
+import os
+import time
+import Queue
+import socket
+import logging
+import threading
+from collections import Counter
+
+import paramiko
+from paramiko import SFTPServer, SFTPServerInterface, SFTPHandle, SFTPAttributes, ServerInterface
+from paramiko.sftp import SFTP_OK
+
+from .models.destination.streams import RateLimiter
+
+_host_key = []
+_host_key_lock = threading.Lock()
+
+def host_key():
+    '''RSA host key generated once per process'''
+    with _host_key_lock:
+        if not _host_key:
+            _host_key.append(paramiko.RSAKey.generate(1024))
+        return _host_key[0]
+
+def _errno(e):
+    return SFTPServer.convert_errno(e.errno)
+
+class StandInHandle(SFTPHandle):
+
+    def __init__(self, standin, flags=0):
+        super(StandInHandle, self).__init__(flags)
+        self.standin = standin
+
+    def read(self, offset, length):
+        data = super(StandInHandle, self).read(offset, length)
+        if isinstance(data, str):
+            self.standin.count(reads=1, bytes_read=len(data))
+        return data
+
+    def write(self, offset, data):
+        self.standin.count(writes=1, bytes_written=len(data))
+        return super(StandInHandle, self).write(offset, data)
+
+    def stat(self):
+        try:
+            return SFTPAttributes.from_stat(os.fstat(self.readfile.fileno()))
+        except OSError, e:
+            return _errno(e)
+
+class StandInSFTP(SFTPServerInterface):
+    '''Serves the files under the stand-in's root, as if it were the login directory'''
+
+    def __init__(self, server, standin, *args, **kwargs):
+        super(StandInSFTP, self).__init__(server, *args, **kwargs)
+        self.standin = standin
+
+    def session_started(self):
+        self.standin.count(sessions=1)
+
+    def _path(self, path):
+        return os.path.join(self.standin.root, self.canonicalize(path).lstrip('/'))
+
+    def open(self, path, flags, attr):
+        path = self._path(path)
+        try:
+            fd = os.open(path, flags, getattr(attr, 'st_mode', None) or 0666)
+        except OSError, e:
+            return _errno(e)
+        if flags & os.O_WRONLY:
+            mode = 'ab' if flags & os.O_APPEND else 'wb'
+        elif flags & os.O_RDWR:
+            mode = 'a+b' if flags & os.O_APPEND else 'r+b'
+        else:
+            mode = 'rb'
+        handle = StandInHandle(self.standin, flags)
+        handle.filename = path
+        handle.readfile = handle.writefile = os.fdopen(fd, mode)
+        return handle
+
+    def list_folder(self, path):
+        path = self._path(path)
+        try:
+            return [SFTPAttributes.from_stat(os.stat(os.path.join(path, name)), name)
+                    for name in os.listdir(path)]
+        except OSError, e:
+            return _errno(e)
+
+    def stat(self, path):
+        try:
+            return SFTPAttributes.from_stat(os.stat(self._path(path)))
+        except OSError, e:
+            return _errno(e)
+
+    def lstat(self, path):
+        try:
+            return SFTPAttributes.from_stat(os.lstat(self._path(path)))
+        except OSError, e:
+            return _errno(e)
+
+    def _call(self, function, *args):
+        try:
+            function(*args)
+        except OSError, e:
+            return _errno(e)
+        return SFTP_OK
+
+    def remove(self, path):
+        return self._call(os.remove, self._path(path))
+
+    def rename(self, oldpath, newpath):
+        return self._call(os.rename, self._path(oldpath), self._path(newpath))
+
+    def mkdir(self, path, attr):
+        return self._call(os.mkdir, self._path(path))
+
+    def rmdir(self, path):
+        return self._call(os.rmdir, self._path(path))
+
+    def chattr(self, path, attr):
+        return self._call(SFTPServer.set_file_attr, self._path(path), attr)
+
+class StandInAuth(ServerInterface):
+    '''Lets anyone in, with a password or any key'''
+
+    def get_allowed_auths(self, username):
+        return 'password,publickey'
+
+    def check_auth_password(self, username, password):
+        return paramiko.AUTH_SUCCESSFUL
+
+    def check_auth_publickey(self, username, key):
+        return paramiko.AUTH_SUCCESSFUL
+
+    def check_channel_request(self, kind, chanid):
+        if kind == 'session':
+            return paramiko.OPEN_SUCCEEDED
+        return paramiko.OPEN_FAILED_ADMINISTRATIVELY_PROHIBITED
+
+class Link(object):
+    '''
+        Relays a connection through a socket pair, delaying every chunk by
+        latency seconds and capping each direction at bandwidth bytes per
+        second, like a network path would. Chunks in flight overlap, so
+        pipelined requests pay the latency once.
+    '''
+
+    def __init__(self, sock, latency=0, bandwidth=None, chunk_size=16 * 1024):
+        self.outer = sock
+        self.inner, server_end = socket.socketpair()
+        self.server_end = server_end
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.chunk_size = chunk_size
+        for src, dst in ((self.outer, self.inner), (self.inner, self.outer)):
+            queue = Queue.Queue()
+            limiter = RateLimiter(bandwidth) if bandwidth else None
+            for target, args in ((self._receive, (src, queue)), (self._deliver, (dst, queue, limiter))):
+                thread = threading.Thread(target=target, args=args)
+                thread.daemon = True
+                thread.start()
+
+    def _receive(self, src, queue):
+        try:
+            for data in iter(lambda: src.recv(self.chunk_size), ''):
+                queue.put((time.time() + self.latency, data))
+        except socket.error:
+            pass
+        queue.put(None)
+
+    def _deliver(self, dst, queue, limiter):
+        try:
+            for due, data in iter(queue.get, None):
+                wait = due - time.time()
+                if wait > 0:
+                    time.sleep(wait)
+                if limiter is not None:
+                    limiter.consume(len(data))
+                dst.sendall(data)
+            dst.shutdown(socket.SHUT_WR)
+        except socket.error:
+            pass
+
+class SFTPStandIn(object):
+    '''
+        In-process SFTP server on an ephemeral port, serving root, for
+        tests and benchmarks of SFTPDestination. Every connection goes
+        through its own Link when latency (seconds, each way) or bandwidth
+        (bytes per second, each way, per connection) is set. window_size is
+        the channel window offered to clients, which caps the bytes they
+        have in flight: paramiko's default is 64KB, OpenSSH offers 2MB.
+        stats counts connections, sessions, read and write requests and
+        their bytes.
+
+            with SFTPStandIn(root, latency=0.01) as server:
+                SFTPDestination(hostname='127.0.0.1', port=server.port, ...)
+    '''
+
+    def __init__(self, root, latency=0, bandwidth=None, window_size=2 * 1024 * 1024,
+                 key=None, host='127.0.0.1'):
+        self.root = os.path.abspath(root)
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.window_size = window_size
+        self.key = key or host_key()
+        self.stats = Counter()
+        self.lock = threading.Lock()
+        self.transports = []
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.sock.bind((host, 0))
+        self.host, self.port = self.sock.getsockname()
+        self.thread = None
+        self.stopping = threading.Event()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    def count(self, **counts):
+        with self.lock:
+            self.stats.update(counts)
+
+    def start(self):
+        if not os.path.isdir(self.root):
+            os.makedirs(self.root)
+        self.sock.listen(16)
+        self.thread = threading.Thread(target=self._serve)
+        self.thread.daemon = True
+        self.thread.start()
+        return self
+
+    def _serve(self):
+        while not self.stopping.is_set():
+            try:
+                sock, address = self.sock.accept()
+            except socket.error:
+                break
+            try:
+                self._handle(sock)
+            except Exception, e:
+                logging.warning('SFTP stand-in: %s', e)
+                sock.close()
+
+    def _handle(self, sock):
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        if self.latency or self.bandwidth:
+            sock = Link(sock, self.latency, self.bandwidth).server_end
+        transport = paramiko.Transport(sock)
+        transport.window_size = self.window_size
+        transport.add_server_key(self.key)
+        transport.set_subsystem_handler('sftp', SFTPServer, StandInSFTP, self)
+        #with an event the handshake runs in the transport's thread
+        transport.start_server(threading.Event(), server=StandInAuth())
+        with self.lock:
+            self.transports.append(transport)
+        self.count(connections=1)
+
+    def stop(self):
+        self.stopping.set()
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except socket.error:
+            pass
+        self.sock.close()
+        with self.lock:
+            transports, self.transports = self.transports, []
+        for transport in transports:
+            transport.close()
+        if self.thread is not None:
+            self.thread.join()
@@ -2,29 +2,69 @@
 from django.utils import timezone
 from django.conf import settings
 from django.test import TestCase
+from django.test.utils import override_settings, CaptureQueriesContext
+from django.db import connection
 from django.core.files import File
+from django.core.management import call_command
+from django.core.exceptions import ValidationError
 from django.contrib.auth.models import User, AnonymousUser
+from django.contrib.auth.hashers import check_password
 
 from rest_framework.test import APITestCase
 from rest_framework import status
 
 import os
+import re
+import sys
+import types
+import random
+import json
+import urlparse
+import threading
+import SocketServer
+import BaseHTTPServer
+import base64
+import hashlib
+from io import BytesIO
 import shutil
-import subprocess
+import tempfile
 import time
 import paramiko
 import mock
-from datetime import datetime
+from datetime import datetime, timedelta
 
 from .models import (
     Origin,
+    RetentionPolicy,
+    Replica,
     BaseDestination,
     LocalDestination,
     SFTPDestination,
     APIDestination,
-    Backup
+    DedupDestination,
+    Backup,
+    TransferJob,
+    ReplicationPolicy,
+    UploadSession,
+    UploadChunk
 )
 
+from .models.destination.sftppool import SFTPConnectionPool, pool as sftppool
+from .sftpstandin import SFTPStandIn
+from .models.destination.httppool import pool as httppool
+from .models.destination.chunking import ContentDefinedChunker
+from .models.destination.compression import CODECS, entropy
+from .models.destination.streams import StripedWriter, striped_read, RateLimiter, TeeWriter, IterFile
+from .models.destination.buffers import BufferPool, copy, chunks
+from .models.destination.checksums import (VerifyingFile, ChecksumMismatch, HashingWriter,
+                                           available_hashes, verifier)
+from .models.destination.delta import signature
+from .authentication import cache as auth_cache, sign_request, BodyDigestMiddleware
+from . import metrics
+from .metrics import Registry, registry as metrics_registry
+from . import tracing
+from .downloads import wsgi_file_wrapper, parse_range, RangeNotSatisfiable
+
 from .views import (
     UserViewSet,
     DestinationViewSet,
@@ -34,14 +74,98 @@ from .views import (
 
 PATH=os.path.join(settings.BASE_DIR, 'examples')
 
-def mock_sftp_connect(self):
-    pkey = paramiko.RSAKey.from_private_key_file('test_rsa.key')
-    transport = paramiko.Transport(('localhost', 3373))
-    transport.connect(username='admin', password='admin', pkey=pkey)
-    return paramiko.SFTPClient.from_transport(transport)
+def sftp_standin(**kwargs):
+    '''Starts an SFTP stand-in server and points the test SFTP destinations to it'''
+    server = SFTPStandIn(os.path.join(PATH, 'sftp'), **kwargs).start()
+    SFTPDestination.objects.update(hostname='127.0.0.1', port=str(server.port))
+    return server
+
+class ObjectStoreHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    '''Stand-in for the HTTP object store APIDestination talks to'''
+    protocol_version = 'HTTP/1.1'
+    
+    def log_message(self, *args):
+        pass
+    
+    def setup(self):
+        BaseHTTPServer.BaseHTTPRequestHandler.setup(self)
+        self.server.connections += 1
+    
+    def body(self):
+        if self.headers.get('Transfer-Encoding') == 'chunked':
+            self.server.chunked += 1
+            data = []
+            for size in iter(lambda: int(self.rfile.readline().strip(), 16), 0):
+                data.append(self.rfile.read(size))
+                self.rfile.readline()
+            self.rfile.readline()
+            return ''.join(data)
+        return self.rfile.read(int(self.headers.get('Content-Length', 0)))
+    
+    def reply(self, status, data='', headers=()):
+        self.send_response(status)
+        self.send_header('Content-Length', str(len(data)))
+        for header in headers:
+            self.send_header(*header)
+        self.end_headers()
+        if self.command != 'HEAD':
+            self.wfile.write(data)
+    
+    def route(self):
+        uri = urlparse.urlparse(self.path)
+        query = dict(urlparse.parse_qsl(uri.query, keep_blank_values=True))
+        body = self.body() if self.command in ('PUT', 'POST') else ''
+        self.server.requests.append((self.command, self.path))
+        if self.server.failures:
+            self.server.failures -= 1
+            return self.reply(503)
+        if self.headers.get('Authorization') != 'Bearer secret':
+            return self.reply(403)
+        objects, uploads = self.server.objects, self.server.uploads
+        
+        if self.command == 'POST' and 'uploads' in query:
+            upload_id = str(len(uploads) + 1)
+            uploads[upload_id] = {}
+            return self.reply(200, json.dumps({'upload_id': upload_id}))
+        if self.command == 'POST' and 'complete' in query:
+            parts = uploads.pop(query['upload_id'])
+            objects[uri.path] = ''.join(parts[str(n)] for n in range(1, json.loads(body)['parts'] + 1))
+            return self.reply(200)
+        if self.command == 'PUT':
+            if 'upload_id' in query:
+                uploads[query['upload_id']][query['part']] = body
+            else:
+                objects[uri.path] = body
+            return self.reply(200)
+        if self.command == 'DELETE':
+            if 'upload_id' in query:
+                uploads.pop(query['upload_id'], None)
+                return self.reply(204)
+            return self.reply(204 if objects.pop(uri.path, None) is not None else 404)
+        
+        if uri.path not in objects:
+            return self.reply(404)
+        data = objects[uri.path]
+        headers = [('Last-Modified', 'Sun, 18 Oct 2026 12:00:00 GMT')]
+        match = re.match(r'bytes=(\d+)-$', self.headers.get('Range', ''))
+        if match:
+            start = int(match.group(1))
+            headers.append(('Content-Range', 'bytes %d-%d/%d' % (start, len(data) - 1, len(data))))
+            return self.reply(206, data[start:], headers)
+        return self.reply(200, data, headers)
+    
+    do_GET = do_HEAD = do_PUT = do_POST = do_DELETE = route
 
-def create_sftp_server():
-    return subprocess.Popen(['sftpserver', '-k', 'test_rsa.key', '-l', 'WARNING'])
+class ObjectStoreServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+    
+    def __init__(self):
+        BaseHTTPServer.HTTPServer.__init__(self, ('127.0.0.1', 0), ObjectStoreHandler)
+        self.objects, self.uploads, self.requests = {}, {}, []
+        self.connections = self.chunked = self.failures = 0
+        thread = threading.Thread(target=self.serve_forever)
+        thread.daemon = True
+        thread.start()
 
 def rm_dir_files(dirname):
     for fname in os.listdir(dirname):
@@ -165,6 +289,7 @@ class DestinationCase(TestCase):
         
         self.assertIsNotNone(data)
         self.assertEquals(''.join(data), open(self.fn, 'rb').read())
+        data.close()
         
         #if not data is None:
         #    print 'success'
@@ -172,13 +297,12 @@ class DestinationCase(TestCase):
         #else:
         #    print 'fail'
     
-    #@mock.patch.object(SFTPDestination, 'connect', side_effect='mock_sftp_connect')    
+    def tearDown(self):
+        sftppool.clear()
+    
     def test_sftpbackup(self):
-        proc = create_sftp_server()
-        
-        time.sleep(0.3)
-        b = None
-        with mock.patch.object(SFTPDestination, 'connect', return_value=mock_sftp_connect(None)) as mocked_func:
+        server = sftp_standin()
+        try:
             #b = Backup.objects.get(origin__pk=1,
             #                       destination__name='TestSFTPDestination')
             b = Backup.objects.get(user__pk=self.user.id,
@@ -186,10 +310,12 @@ class DestinationCase(TestCase):
             
             contents = File(open(self.fn, 'rb'))
             b.backup(contents)
-        
-        proc.kill()
+        finally:
+            server.stop()
         
         self.assertTrue(b.success)
+        self.assertEquals(open(os.path.join(server.root, 'Guadalupe', b.name), 'rb').read(),
+                          open(self.fn, 'rb').read())
         self.assertFalse(b.before_restore)
         self.assertFalse(b.after_restore)
         self.assertIsNone(b.restore_dt)
@@ -197,23 +323,863 @@ class DestinationCase(TestCase):
         
         
     def test_sftprestore(self):
-        proc = create_sftp_server()
-        time.sleep(0.3)
-        
-        data = None
-        with mock.patch.object(SFTPDestination, 'connect', return_value=mock_sftp_connect(None)) as mocked_func:
+        server = sftp_standin()
+        try:
             #b = Backup.objects.get(origin__pk=1,
             #                   destination__name='TestSFTPDestination')
             b = Backup.objects.get(user__pk=self.user.id,
                                destination__name='TestSFTPDestination')
             data = b.restore()
+            self.assertIsNotNone(data)
+            #restore is lazy, so it is read while the server is up
+            contents = ''.join(data)
+            data.close()
+        finally:
+            server.stop()
         
-        proc.kill()
+        self.assertEquals(contents, open(self.fn, 'rb').read())
+
+
+    @override_settings(SFTP_STRIPE_SIZE=16 * 1024)
+    def test_sftp_parallel_transfer(self):
+        server = sftp_standin()
+        destination = SFTPDestination.objects.get(name='TestSFTPDestination')
+        destination.streams = 3
+        try:
+            self.assertTrue(destination.backup(File(open(self.fn, 'rb')), 'Guadalupe', 'parallel.zip'))
+            contents, success = destination.restore('Guadalupe', 'parallel.zip', offset=1000)
+            self.assertTrue(success)
+            restored = contents.read()
+            contents.close()
+            #writes at offsets never truncate the file, even when it appears meanwhile
+            rexists = SFTPDestination._rexists
+            with mock.patch.object(SFTPDestination, '_rexists', autospec=True,
+                                   side_effect=lambda self, sftp, path:
+                                       not path.endswith('.zip') and rexists(self, sftp, path)):
+                with destination.writer('Guadalupe', 'parallel.zip', offset=10) as f:
+                    f.write('0123456789')
+            #as a delta base: one session's file, read where it is seeked
+            contents, success = destination.restore('Guadalupe', 'parallel.zip', seekable=True)
+            self.assertTrue(contents.seekable())
+            contents.seek(5000)
+            seeked = contents.read(100)
+            contents.close()
+        finally:
+            server.stop()
         
-        self.assertIsNotNone(data)
-        self.assertEquals(''.join(data), open(self.fn, 'rb').read())
+        self.assertEquals(restored, open(self.fn, 'rb').read()[1000:])
+        self.assertEquals(seeked, open(self.fn, 'rb').read()[5000:5100])
+        data = open(self.fn, 'rb').read()
+        self.assertEquals(open(os.path.join(server.root, 'Guadalupe', 'parallel.zip'), 'rb').read(),
+                          data[:10] + '0123456789' + data[20:])
+        #sessions are pooled, the restore took the backup's three
+        self.assertEquals((server.stats['connections'], server.stats['sessions']), (3, 3))
+    
+    @override_settings(SFTP_STRIPE_SIZE=16 * 1024)
+    def test_sftp_concurrent_transfers_share_small_pool(self):
+        server = sftp_standin()
+        contents = open(self.fn, 'rb').read()
+        arrived, both = [], threading.Event()
+        connect = SFTPDestination.connect
+        
+        def first_sessions(destination):
+            #both transfers hold their first session before taking more
+            sftp = connect(destination)
+            arrived.append(sftp)
+            if len(arrived) == 2:
+                both.set()
+            both.wait(5)
+            return sftp
+        
+        results, errors = {}, []
+        def transfer(destination, name):
+            try:
+                destination.backup(BytesIO(contents), 'Guadalupe', name)
+                f, success = destination.restore('Guadalupe', name)
+                results[name] = f.read()
+                f.close()
+            except Exception, e:
+                errors.append(e)
+        
+        #two transfers of two streams each, over a pool of two sessions
+        with mock.patch.object(sftppool, 'max_size', 2), \
+             mock.patch.object(sftppool, 'timeout', 2.0), \
+             mock.patch.object(SFTPDestination, 'connect', first_sessions):
+            threads = []
+            for name in ('a.zip', 'b.zip'):
+                destination = SFTPDestination.objects.get(name='TestSFTPDestination')
+                destination.streams = 2
+                threads.append(threading.Thread(target=transfer, args=(destination, name)))
+            try:
+                for thread in threads:
+                    thread.start()
+                for thread in threads:
+                    thread.join(30)
+            finally:
+                server.stop()
+        
+        self.assertEquals(errors, [])
+        self.assertEquals(results, {'a.zip': contents, 'b.zip': contents})
+        self.assertTrue(server.stats['connections'] <= 2)
+
+
+class StripedStreamsCase(TestCase):
+    
+    def setUp(self):
+        self.fn = os.path.join(PATH, 'striped.bin')
+        self.data = ''.join(chr(i * 7 % 251) for i in range(300000))
+        open(self.fn, 'wb').close()
+    
+    def tearDown(self):
+        os.remove(self.fn)
+    
+    def test_striped_write_and_read(self):
+        closed = []
+        with StripedWriter([open(self.fn, 'r+b') for i in range(3)], 64 * 1024,
+                           lambda: closed.append(True)) as f:
+            for start in range(0, len(self.data), 10000):
+                f.write(self.data[start:start + 10000])
+        self.assertEquals(closed, [True])
+        self.assertEquals(open(self.fn, 'rb').read(), self.data)
+        
+        def reader(start, length):
+            with open(self.fn, 'rb') as f:
+                f.seek(start)
+                return f.read(length)
+        stripes = list(striped_read([reader] * 3, 1000, len(self.data), 64 * 1024))
+        self.assertEquals(''.join(stripes), self.data[1000:])
+        self.assertEquals(len(stripes), 5)
+    
+    def test_striped_read_error(self):
+        def reader(start, length):
+            if start:
+                raise IOError('read failed')
+            return 'x' * length
+        stripes = striped_read([reader] * 2, 0, 100, 10)
+        self.assertEquals(next(stripes), 'x' * 10)
+        self.assertRaises(IOError, next, stripes)
+    
+    def tee(self, *writers):
+        tee = TeeWriter(list(writers), 2)
+        for start in range(0, len(self.data), 10000):
+            tee.write(self.data[start:start + 10000])
+        return tee
+    
+    def test_tee_slow_replica(self):
+        primary, slow, other = TeeTarget(), TeeTarget(delay=0.002), TeeTarget()
+        tee = self.tee(primary, slow, other)
+        #held back to two chunks ahead of the slow replica, not more
+        self.assertTrue(len(primary.getvalue()) <= len(slow.getvalue()) + 4 * 10000)
+        tee.close()
+        
+        self.assertEquals(tee.errors, [None, None, None])
+        for writer in (primary, slow, other):
+            self.assertEquals((writer.data, writer.closed), (self.data, True))
+    
+    def test_tee_replica_failing(self):
+        primary, failing, other = TeeTarget(), TeeTarget(fail_after=3), TeeTarget()
+        tee = self.tee(primary, failing, other)
+        #a replica's error is kept, not raised
+        tee.close()
+        
+        self.assertEquals((primary.data, other.data), (self.data, self.data))
+        self.assertEquals(len(failing.data), 3 * 10000)
+        self.assertIsNone(tee.errors[0])
+        self.assertIsInstance(tee.errors[1], IOError)
+        self.assertIsNone(tee.errors[2])
+        self.assertTrue(failing.closed)
+        
+        #the primary's is raised, after the replicas are written
+        primary, other = TeeTarget(fail_after=1), TeeTarget()
+        tee = self.tee(primary, other)
+        self.assertRaises(IOError, tee.close)
+        self.assertEquals(other.data, self.data)
+
+class TeeTarget(BytesIO):
+    '''Writer of a TeeWriter test, slow or failing after some writes'''
+    
+    def __init__(self, delay=0, fail_after=None):
+        BytesIO.__init__(self)
+        self.delay = delay
+        self.fail_after = fail_after
+        self.data = None
+    
+    def write(self, data):
+        if self.fail_after is not None and len(self.getvalue()) >= self.fail_after * 10000:
+            raise IOError('replica lost')
+        time.sleep(self.delay)
+        return BytesIO.write(self, data)
+    
+    def close(self):
+        self.data = self.getvalue()
+        BytesIO.close(self)
 
+
+class BufferPoolCase(TestCase):
+    
+    def setUp(self):
+        self.data = ''.join(chr(i * 7 % 251) for i in range(300000))
+    
+    def test_copy_reuses_buffers(self):
+        pool = BufferPool()
+        with mock.patch('server.models.destination.buffers.pool', pool):
+            for i in range(3):
+                out = BytesIO()
+                self.assertEquals(copy(BytesIO(self.data), out, 64 * 1024), len(self.data))
+                self.assertEquals(out.getvalue(), self.data)
+            #files without readinto are read as usual
+            out = BytesIO()
+            copy(IterFile(iter([self.data])), out, 64 * 1024)
+            self.assertEquals(out.getvalue(), self.data)
+        self.assertEquals(pool.stats(), {'allocated': 1, 'allocated_bytes': 64 * 1024, 'reused': 3,
+                                         'in_use': 0, 'idle': 1, 'copied_bytes': 4 * len(self.data)})
+    
+    def test_writers_keeping_data_copy_it(self):
+        fns = [os.path.join(PATH, 'tee%d.bin' % i) for i in range(2)]
+        tee = TeeWriter([open(fn, 'wb') for fn in fns], 2)
+        copy(BytesIO(self.data), tee, 1000)
+        tee.close()
+        for fn in fns:
+            self.assertEquals(open(fn, 'rb').read(), self.data)
+            os.remove(fn)
+    
+    def test_verified_readinto(self):
+        digest = hashlib.sha256(self.data).hexdigest()
+        f = VerifyingFile(BytesIO(self.data), len(self.data), 'sha256', digest)
+        self.assertEquals(''.join(str(data) for data in chunks(f, 4096)), self.data)
+        f = VerifyingFile(BytesIO(self.data[:-1] + 'x'), len(self.data), 'sha256', digest)
+        self.assertRaises(ChecksumMismatch, lambda: list(chunks(f, 4096)))
+    
+    def test_hashes_without_blake2b(self):
+        #neither hashlib (before Python 3.6) nor pyblake2 have it
+        old_hashlib = types.ModuleType('hashlib')
+        old_hashlib.sha256 = hashlib.sha256
+        with mock.patch.dict(sys.modules, {'hashlib': old_hashlib, 'pyblake2': None}):
+            hashes = available_hashes()
+        self.assertEquals(hashes, [('sha256', hashlib.sha256)])
+        #pyblake2 stands in for it
+        pyblake2 = types.ModuleType('pyblake2')
+        pyblake2.blake2b = mock.Mock()
+        with mock.patch.dict(sys.modules, {'hashlib': old_hashlib, 'pyblake2': pyblake2}):
+            self.assertEquals(available_hashes(), [('sha256', hashlib.sha256), ('blake2b', pyblake2.blake2b)])
+        
+        with mock.patch('server.models.destination.checksums.HASHES', hashes):
+            writer = HashingWriter(BytesIO())
+            writer.write(self.data)
+            self.assertEquals(writer.digests, {'sha256': hashlib.sha256(self.data).hexdigest()})
+            #backups hashed where blake2b was there are verified with sha256
+            b = Backup(sha256=writer.digests['sha256'], blake2b='0' * 128)
+            self.assertEquals(verifier(b), ('sha256', writer.digests['sha256']))
+            f = VerifyingFile(BytesIO(self.data), len(self.data), *verifier(b))
+            self.assertEquals(f.read(), self.data)
+    
+    @override_settings(IO_BLOCK_SIZE=4096, IO_BLOCK_SIZES={'sftpdestination': 8192})
+    def test_block_size_per_kind(self):
+        local = LocalDestination.objects.create(name='HD1', directory=PATH)
+        self.assertEquals(local.block_size, 4096)
+        self.assertEquals(BaseDestination.objects.get(id=local.id).block_size, 4096)
+        self.assertEquals(SFTPDestination(name='Remote').block_size, 8192)
+
+class DedupDestinationCase(TestCase):
+    
+    def setUp(self):
+        self.destination = DedupDestination.objects.create(
+            name = 'Dedup',
+            directory = os.path.join(PATH, 'dedup'),
+            avg_chunk_size = 4096
+        )
+        self.fn = os.path.join(PATH, 'reactive_course source code_reactive-week1.zip')
+        self.data = open(self.fn, 'rb').read()
+    
+    @classmethod
+    def tearDownClass(cls):
+        rm_dir_files(PATH)
+    
+    def chunks(self, data):
+        chunker = ContentDefinedChunker(4096)
+        return chunker.feed(data) + [chunker.flush()]
+    
+    def count_chunks(self):
+        return sum(len(files) for d, dirs, files in os.walk(os.path.join(PATH, 'dedup', '.chunks')))
+    
+    def test_chunk_boundaries_resync(self):
+        chunks = self.chunks(self.data)
+        shifted = self.chunks('inserted bytes' + self.data)
+        
+        self.assertEquals(''.join(chunks), self.data)
+        self.assertTrue(len(set(chunks) & set(shifted)) >= len(chunks) - 2)
+    
+    def test_dedup_backup_restore(self):
+        self.assertTrue(self.destination.backup(File(open(self.fn, 'rb')), 'Guadalupe', 'first.zip'))
+        stored = self.count_chunks()
+        self.assertTrue(self.destination.backup(File(open(self.fn, 'rb')), 'Guadalupe', 'second.zip'))
+        
+        #the second copy only adds its manifest
+        self.assertEquals(self.count_chunks(), stored)
+        data, success = self.destination.restore('Guadalupe', 'second.zip')
+        self.assertTrue(success)
+        self.assertEquals(''.join(data), self.data)
+        self.assertEquals(self.destination.stat('Guadalupe', 'second.zip')[0], len(self.data))
+        
+        data, success = self.destination.restore('Guadalupe', 'second.zip', offset=10000)
+        self.assertEquals(data.read(), self.data[10000:])
+    
+    def test_dedup_collects_unreferenced_chunks(self):
+        shutil.rmtree(os.path.join(PATH, 'dedup'), ignore_errors=True)
+        other = ''.join(chr(i * 13 % 251) for i in range(50000))
+        self.assertTrue(self.destination.backup(BytesIO(self.data), 'Guadalupe', 'first.zip'))
+        self.assertTrue(self.destination.backup(BytesIO(other), 'Guadalupe', 'other.zip'))
+        #chunks of aborted writes: no manifest lists them
+        old, recent = hashlib.sha256('old').hexdigest(), hashlib.sha256('recent').hexdigest()
+        self.destination.store_chunk(old, 'old')
+        tmp = os.path.join(PATH, 'dedup', 'Guadalupe', '.tmpaborted')
+        open(tmp, 'wb').write('partial manifest')
+        #everything so far is older than the grace period
+        two_hours_ago = (time.time() - 7200,) * 2
+        os.utime(tmp, two_hours_ago)
+        for d, dirs, files in os.walk(os.path.join(PATH, 'dedup', '.chunks')):
+            for fn in files:
+                os.utime(os.path.join(d, fn), two_hours_ago)
+        self.destination.store_chunk(recent, 'recent')
+        
+        stored = self.count_chunks()
+        self.assertEquals(self.destination.remove('Guadalupe', ['first.zip']), [])
+        #removing only drops the manifest, chunks are collected by their own command
+        self.assertEquals(self.count_chunks(), stored)
+        out = BytesIO()
+        call_command('collectchunks', stdout=out)
+        self.assertIn('Dedup: ', out.getvalue())
+        
+        #only the chunks of other.zip and the recent one, still in its grace period, stay
+        kept = set(digest for digest, length in self.destination.read_manifest('Guadalupe', 'other.zip'))
+        self.assertEquals(self.count_chunks(), len(kept) + 1)
+        self.assertTrue(os.path.exists(self.destination.chunk_path(recent)))
+        self.assertFalse(os.path.exists(self.destination.chunk_path(old)))
+        self.assertFalse(os.path.exists(tmp))
+        data, success = self.destination.restore('Guadalupe', 'other.zip')
+        self.assertEquals(data.read(), other)
+        
+        #a chunk stored again is touched, so it is not collected before its manifest is written
+        digest = sorted(kept)[0]
+        os.utime(self.destination.chunk_path(digest), two_hours_ago)
+        self.assertFalse(self.destination.store_chunk(digest, 'unused'))
+        self.destination.remove('Guadalupe', ['other.zip'])
+        call_command('collectchunks', destination=['Dedup'], stdout=BytesIO())
+        self.assertEquals(self.count_chunks(), 2)
+        self.assertEquals(self.destination.collect_garbage(grace=0)[0], 2)
+    
+class CompressionCase(TestCase):
+    
+    def setUp(self):
+        self.user = User.objects.create(username='Guadalupe', email='g@g.com')
+        self.destination = LocalDestination.objects.create(
+            name = 'HD1',
+            directory = os.path.join(PATH, 'destination1')
+        )
+        self.dump = ''.join('INSERT INTO backup VALUES (%d, "nightly_%d");\n' % (i, i % 7)
+                            for i in range(20000))
+    
+    @classmethod
+    def tearDownClass(cls):
+        rm_dir_files(PATH)
+    
+    def backup(self, name, data):
+        b = Backup.objects.create(user=self.user, name=name,
+                                  destination=self.destination, date=timezone.now())
+        self.assertTrue(b.backup(BytesIO(data)))
+        return Backup.objects.get(id=b.id)
+    
+    def test_codecs_roundtrip(self):
+        for codec in CODECS:
+            self.destination.compression = codec
+            self.destination.save()
+            b = self.backup('dump_%s.sql' % codec, self.dump)
+            
+            self.assertEquals((b.codec, b.size), (codec, len(self.dump)))
+            stored = os.path.join(PATH, 'destination1', 'Guadalupe', b.name)
+            self.assertTrue(os.path.getsize(stored) < len(self.dump) / 4)
+            self.assertEquals(b.restore().read(), self.dump)
+            self.assertEquals(b.restore(offset=100000).read(), self.dump[100000:])
+            self.assertEquals(b.stat()[0], len(self.dump))
+            self.assertIsNone(b.local_path())
+            #checksums are of the uncompressed contents
+            self.assertEquals(b.sha256, hashlib.sha256(self.dump).hexdigest())
+            self.assertIsInstance(b.open(), VerifyingFile)
+    
+    def test_compressed_input_is_stored_as_sent(self):
+        self.destination.compression = 'gzip'
+        self.destination.save()
+        data = open(os.path.join(PATH, 'reactive_course source code_reactive-week1.zip'), 'rb').read()
+        b = self.backup('already.zip', data)
+        
+        self.assertEquals(b.codec, '')
+        self.assertTrue(entropy(data[:64 * 1024]) > 7.5)
+        self.assertEquals(open(b.local_path(), 'rb').read(), data)
+    
+    def test_compression_level_validated(self):
+        self.destination.compression = 'zlib'
+        for level in (0, 9):
+            self.destination.compression_level = level
+            self.destination.full_clean()
+        self.destination.compression_level = 10
+        self.assertRaises(ValidationError, self.destination.full_clean)
+    
+class ScrubCase(TestCase):
+    
+    def setUp(self):
+        self.user = User.objects.create(username='Guadalupe', email='g@g.com')
+        self.destination = LocalDestination.objects.create(
+            name = 'HD1',
+            directory = os.path.join(PATH, 'destination1')
+        )
+        self.backups = []
+        for name in ('good.zip', 'rotten.zip'):
+            b = Backup.objects.create(user=self.user, name=name,
+                                      destination=self.destination, date=timezone.now())
+            b.backup(open(os.path.join(PATH, 'reactive_course source code_reactive-week1.zip'), 'rb'))
+            self.backups.append(b)
+    
+    @classmethod
+    def tearDownClass(cls):
+        rm_dir_files(PATH)
+    
+    def test_verify_and_queue_order(self):
+        good, rotten = self.backups
+        with open(os.path.join(PATH, 'destination1', 'Guadalupe', 'rotten.zip'), 'r+b') as f:
+            f.seek(20000)
+            f.write('bit rot')
+        
+        future = timezone.now() + timedelta(seconds=1)
+        self.assertEquals(Backup.scrub_queue(self.destination, future), [good.id, rotten.id])
+        self.assertIsNone(good.verify())
+        for i in range(2):
+            self.assertIsNotNone(rotten.verify())
+        
+        good, rotten = [Backup.objects.get(id=b.id) for b in self.backups]
+        self.assertEquals((good.verify_failures, good.verify_error), (0, None))
+        self.assertEquals(rotten.verify_failures, 2)
+        self.assertIn('checksum', rotten.verify_error)
+        self.assertIsNone(rotten.restore_dt)
+        
+        #least recently verified first, none due before the interval
+        future = timezone.now() + timedelta(seconds=1)
+        self.assertEquals(Backup.scrub_queue(self.destination, future), [good.id, rotten.id])
+        self.assertEquals(Backup.scrub_queue(self.destination, good.verified_at), [])
+    
+    def test_failed_replicas_retried_then_dropped(self):
+        good, rotten = self.backups
+        hd2 = LocalDestination.objects.create(name='HD2', directory=os.path.join(PATH, 'destination2'))
+        retried = Replica.objects.create(backup=good, destination=hd2, success=False, obs='down')
+        old = Replica.objects.create(backup=rotten, destination=hd2, success=False, obs='down')
+        Replica.objects.filter(id=old.id).update(date_created=timezone.now() - timedelta(days=8))
+        
+        with override_settings(REPLICA_RETRY_MAX_AGE=7 * 24 * 3600):
+            self.assertEquals(Replica.retry_failed(), (1, 1, 1))
+        replica = Replica.objects.get()
+        self.assertEquals((replica.id, replica.success, replica.obs), (retried.id, True, None))
+        self.assertEquals(open(hd2.path('Guadalupe', 'good.zip'), 'rb').read(),
+                          open(os.path.join(PATH, 'reactive_course source code_reactive-week1.zip'), 'rb').read())
+        #nothing left to retry
+        self.assertEquals(Replica.retry_failed(), (0, 0, 0))
+    
+    def test_rate_limiter(self):
+        with mock.patch('server.models.destination.streams.time') as clock:
+            clock.time.return_value = 100.0
+            limiter = RateLimiter(1000)
+            limiter.consume(1000)
+            self.assertFalse(clock.sleep.called)
+            limiter.consume(500)
+            clock.sleep.assert_called_with(0.5)
+            clock.time.return_value = 102.0
+            limiter.consume(1000)
+            self.assertEquals(clock.sleep.call_count, 1)
+    
+class RetentionCase(TestCase):
+    
+    def setUp(self):
+        self.user = User.objects.create(username='Guadalupe', email='g@g.com')
+        self.hd1 = LocalDestination.objects.create(name='HD1', directory=os.path.join(PATH, 'destination1'))
+        self.hd2 = LocalDestination.objects.create(name='HD2', directory=os.path.join(PATH, 'destination2'))
+        RetentionPolicy.objects.create(name='gfs', keep_daily=3, keep_weekly=2, keep_monthly=2)
+        
+        #two backups a day, from 2026-02-20 to 2026-03-31
+        last = datetime(2026, 3, 31, tzinfo=timezone.utc)
+        self.backups = {}
+        for day in range(40):
+            for hour in (12, 15):
+                date = last - timedelta(days=day) + timedelta(hours=hour)
+                name = 'b_%s.tar' % date.strftime('%m%d_%H')
+                self.backups[name] = self.store(self.hd1, name, date)
+    
+    @classmethod
+    def tearDownClass(cls):
+        rm_dir_files(PATH)
+    
+    def put(self, destination, name):
+        fn = destination.path('Guadalupe', name)
+        if not os.path.isdir(os.path.dirname(fn)):
+            os.makedirs(os.path.dirname(fn))
+        open(fn, 'wb').write(name)
+    
+    def store(self, destination, name, date, **kwargs):
+        self.put(destination, name)
+        return Backup.objects.create(user=self.user, name=name, destination=destination,
+                                     date=date, success=True, **kwargs)
+    
+    def test_prune_gfs(self):
+        #a kept backup sharing the file of an expired one
+        Backup.objects.filter(id=self.backups['b_0220_12.tar'].id).update(name='b_0331_15.tar')
+        os.remove(self.hd1.path('Guadalupe', 'b_0220_12.tar'))
+        #an expired backup replicated to HD2, another one a restore refers to
+        replicated = self.backups['b_0301_12.tar']
+        self.put(self.hd2, replicated.name)
+        Replica.objects.create(backup=replicated, destination=self.hd2, success=True)
+        referenced = self.backups['b_0302_12.tar']
+        Backup.objects.create(user=self.user, name='emergency.tar', destination=self.hd1,
+                              date=referenced.date, related_to=referenced)
+        
+        self.assertEquals(len(RetentionPolicy.prune(self.user, dry_run=True)), 75)
+        self.assertEquals(Backup.objects.count(), 81)
+        
+        pruned = RetentionPolicy.prune(self.user, batch_size=10)
+        self.assertEquals(len(pruned), 75)
+        kept = set(Backup.objects.filter(success=True).values_list('name', flat=True))
+        self.assertEquals(kept, set(['b_0331_15.tar', 'b_0330_15.tar', 'b_0329_15.tar',
+                                     'b_0228_15.tar', 'b_0302_12.tar']))
+        remaining = set(os.listdir(os.path.join(PATH, 'destination1', 'Guadalupe')))
+        self.assertEquals(remaining, kept)
+        self.assertFalse(os.listdir(os.path.join(PATH, 'destination2', 'Guadalupe')))
+        self.assertEquals(RetentionPolicy.prune(self.user), [])
+    
+    def test_prune_keeps_rows_of_unremovable_files(self):
+        with mock.patch.object(LocalDestination, 'remove', side_effect=lambda subdir, names: names[:1]):
+            pruned = RetentionPolicy.prune(self.user)
+        self.assertEquals(len(pruned), 75)
+        self.assertEquals(Backup.objects.count(), 5)
+        
+        #a policy naming the destination wins over the global one
+        RetentionPolicy.objects.create(name='hd1', destination=self.hd1,
+                                       keep_daily=1, keep_weekly=0, keep_monthly=0)
+        self.assertEquals(len(RetentionPolicy.prune(self.user)), 4)
+    
+@override_settings(DELTA_BLOCK_SIZE=1024, DELTA_SIGNATURE_CACHE=os.path.join(PATH, 'signatures'))
+class DeltaCase(TestCase):
+    
+    def setUp(self):
+        self.user = User.objects.create(username='Guadalupe', email='g@g.com')
+        self.destination = LocalDestination.objects.create(
+            name = 'HD1',
+            directory = os.path.join(PATH, 'destination1'),
+            delta_chain = 2
+        )
+        rand = random.Random(7)
+        self.versions = [''.join(chr(rand.randint(0, 255)) for i in range(200 * 1024))]
+        for i in range(3):
+            data = self.versions[-1]
+            #bytes inserted, so nothing after them is block aligned, and a new tail
+            self.versions.append(data[:5000] + 'inserted %d' % i + data[5000:-3000] + os.urandom(2000))
+    
+    def tearDown(self):
+        shutil.rmtree(settings.DELTA_SIGNATURE_CACHE, ignore_errors=True)
+    
+    @classmethod
+    def tearDownClass(cls):
+        rm_dir_files(PATH)
+    
+    def backup(self, data, day):
+        b = Backup.objects.create(user=self.user, name='disk.img', destination=self.destination,
+                                  date=datetime(2026, 3, day, tzinfo=timezone.utc))
+        self.assertTrue(b.backup(BytesIO(data)))
+        return Backup.objects.get(id=b.id)
+    
+    def stored_size(self, b):
+        return os.path.getsize(self.destination.path('Guadalupe', b.stored_name))
+    
+    def test_delta_chain(self):
+        backups = [self.backup(data, i + 1) for i, data in enumerate(self.versions)]
+        self.assertEquals([(b.parent_id, b.chain) for b in backups],
+                          [(None, 0), (backups[0].id, 1), (backups[1].id, 2), (None, 0)])
+        self.assertEquals(len(set(b.stored_name for b in backups)), 4)
+        self.assertEquals(self.stored_size(backups[0]), 200 * 1024)
+        self.assertTrue(self.stored_size(backups[1]) < 4 * 1024)
+        
+        for b, data in zip(backups, self.versions):
+            self.assertEquals(b.restore().read(), data)
+            self.assertEquals(b.restore(offset=7000).read(), data[7000:])
+            self.assertEquals(b.stat()[0], len(data))
+            self.assertEquals(b.sha256, hashlib.sha256(data).hexdigest())
+        self.assertIsNone(backups[2].local_path())
+        self.assertIsNotNone(backups[3].local_path())
+    
+    def test_delta_signature_cached(self):
+        first = self.backup(self.versions[0], 1)
+        second = self.backup(self.versions[1], 2)
+        self.assertEquals(second.parent_id, first.id)
+        second.delete()
+        
+        #the base's signature is not computed again
+        with mock.patch('server.models.destination.delta.signature',
+                        wraps=signature) as signed:
+            again = self.backup(self.versions[1], 3)
+        self.assertEquals(signed.call_count, 0)
+        self.assertEquals(again.parent_id, first.id)
+        self.assertEquals(again.restore().read(), self.versions[1])
     
+    def test_delta_base_seeked(self):
+        first = self.backup(self.versions[0], 1)
+        second = self.backup(self.versions[1], 2)
+        third = self.backup(self.versions[2], 3)
+        spool = mock.patch('server.models.destination.delta.tempfile.TemporaryFile',
+                           side_effect=tempfile.TemporaryFile)
+        
+        #whole files of a local destination are read in place
+        with spool as spooled:
+            self.assertEquals(second.restore().read(), self.versions[1])
+        self.assertEquals(spooled.call_count, 0)
+        #the base of the third is itself a delta, it is spooled
+        with spool as spooled:
+            self.assertEquals(third.restore(offset=1000).read(), self.versions[2][1000:])
+        self.assertEquals(spooled.call_count, 1)
+    
+    def test_compressed_deltas(self):
+        self.destination.compression = 'zlib'
+        self.destination.save()
+        text = ''.join('INSERT INTO t VALUES (%d);\n' % i for i in range(20000))
+        first = self.backup(text, 1)
+        second = self.backup(text.replace('(1234)', '(4321)'), 2)
+        self.assertEquals((second.parent_id, second.codec), (first.id, 'zlib'))
+        self.assertEquals(second.restore().read(), text.replace('(1234)', '(4321)'))
+    
+    def test_corrupted_base(self):
+        first = self.backup(self.versions[0], 1)
+        second = self.backup(self.versions[1], 2)
+        with open(self.destination.path('Guadalupe', first.stored_name), 'r+b') as f:
+            f.write('rotten')
+        #the base is read where the delta points, the patched file fails its checksum
+        f = second.restore()
+        self.assertRaises(ChecksumMismatch, f.read)
+        f.close()
+        self.assertIsNotNone(second.verify())
+        #deltas are only written against bases that verify
+        third = self.backup(self.versions[2], 3)
+        self.assertEquals((third.parent_id, third.restore().read()), (None, self.versions[2]))
+    
+    def test_prune_keeps_bases(self):
+        RetentionPolicy.objects.create(name='last', keep_daily=1, keep_weekly=0, keep_monthly=0)
+        backups = [self.backup(data, i + 1) for i, data in enumerate(self.versions[:3])]
+        self.assertEquals(RetentionPolicy.prune(self.user), [])
+        
+        #a full copy, the whole chain before it goes
+        last = self.backup(self.versions[3], 4)
+        self.assertEquals(sorted(RetentionPolicy.prune(self.user)), [b.id for b in backups])
+        stored = os.listdir(os.path.join(PATH, 'destination1', 'Guadalupe'))
+        self.assertIn(last.stored_name, stored)
+        self.assertFalse(set(b.stored_name for b in backups) & set(stored))
+        self.assertEquals(last.restore().read(), self.versions[3])
+    
+@override_settings(API_RETRY_BACKOFF=0)
+class APIDestinationCase(TestCase):
+    
+    def setUp(self):
+        self.server = ObjectStoreServer()
+        self.destination = APIDestination.objects.create(
+            name = 'Store',
+            pubkey = 'secret',
+            base_uri = 'http://127.0.0.1:%d/store/' % self.server.server_port,
+            set_uri = '/objects/',
+            get_uri = '/objects/',
+            parallel_parts = 1
+        )
+        self.user = User.objects.create(username='Guadalupe', email='g@g.com')
+        self.data = open(os.path.join(PATH, 'reactive_course source code_reactive-week1.zip'), 'rb').read()
+    
+    def tearDown(self):
+        httppool.clear()
+        self.server.shutdown()
+        self.server.server_close()
+    
+    def test_chunked_backup_restore(self):
+        b = Backup.objects.create(user=self.user, name='chunked.zip',
+                                  destination=self.destination, date=timezone.now())
+        self.assertTrue(b.backup(BytesIO(self.data)))
+        
+        self.assertEquals(self.server.objects['/store/objects/Guadalupe/chunked.zip'], self.data)
+        self.assertEquals(self.server.chunked, 1)
+        self.assertEquals(b.stat(), (len(self.data), 1792324800))
+        contents = b.restore()
+        self.assertEquals(contents.read(), self.data)
+        contents.close()
+        contents = b.open(offset=1000)
+        self.assertEquals(contents.read(), self.data[1000:])
+        contents.close()
+        #every request went through one keep-alive connection
+        self.assertEquals(self.server.connections, 1)
+        
+        self.assertEquals(self.destination.remove('Guadalupe', ['chunked.zip', 'missing.zip']), [])
+        self.assertEquals(self.server.objects, {})
+        self.assertEquals(self.destination.restore('Guadalupe', 'chunked.zip'), (None, False))
+    
+    @override_settings(API_PART_SIZE=8 * 1024)
+    def test_multipart_upload(self):
+        self.destination.parallel_parts = 3
+        self.assertTrue(self.destination.backup(BytesIO(self.data), 'Guadalupe', 'parts.zip'))
+        
+        self.assertEquals(self.server.objects['/store/objects/Guadalupe/parts.zip'], self.data)
+        parts = [path for method, path in self.server.requests if 'part=' in path]
+        self.assertEquals(len(parts), len(self.data) / (8 * 1024) + 1)
+        self.assertEquals(self.server.uploads, {})
+        
+        #objects smaller than a part take a single request
+        self.assertTrue(self.destination.backup(BytesIO('small'), 'Guadalupe', 'small.txt'))
+        self.assertEquals(self.server.requests[-1], ('PUT', '/store/objects/Guadalupe/small.txt'))
+    
+    def test_retries(self):
+        self.destination.parallel_parts = 2
+        self.server.failures = 2
+        self.assertTrue(self.destination.backup(BytesIO('retried'), 'Guadalupe', 'retried.txt'))
+        self.assertEquals(len(self.server.requests), 3)
+        
+        self.server.failures = 10
+        self.assertIsNone(self.destination.stat('Guadalupe', 'retried.txt'))
+        self.assertEquals(len(self.server.requests), 3 + 4)
+        
+        self.server.failures = 0
+        self.destination.pubkey = 'wrong'
+        self.assertIsNone(self.destination.stat('Guadalupe', 'retried.txt'))
+        self.assertEquals(len(self.server.requests), 3 + 4 + 1)
+    
+class SFTPConnectionPoolCase(TestCase):
+    
+    def factory(self):
+        client = mock.Mock()
+        client.get_transport.return_value.is_active.return_value = True
+        client.open_sftp.side_effect = lambda: mock.Mock()
+        self.clients.append(client)
+        return client
+    
+    def setUp(self):
+        self.clients = []
+        self.pool = SFTPConnectionPool(max_size=2, max_idle=60, keepalive=0, timeout=0.1)
+    
+    def test_reuses_idle_session(self):
+        sftp = self.pool.acquire('a', self.factory)
+        self.pool.release(sftp)
+        
+        self.assertIs(self.pool.acquire('a', self.factory), sftp)
+        self.assertEquals(len(self.clients), 1)
+        sftp.chdir.assert_called_with(None)
+    
+    def test_discards_dead_transport(self):
+        sftp = self.pool.acquire('a', self.factory)
+        self.pool.release(sftp)
+        self.clients[0].get_transport.return_value.is_active.return_value = False
+        
+        self.assertIsNot(self.pool.acquire('a', self.factory), sftp)
+        self.assertTrue(self.clients[0].close.called)
+    
+    def test_probes_outside_lock(self):
+        self.pool.keepalive = 1
+        sftp = self.pool.acquire('a', self.factory)
+        self.pool.release(sftp)
+        self.pool.idle['a'][0] = self.pool.idle['a'][0][:2] + (time.time() - 10,)
+        
+        free = []
+        def probe(path):
+            #other threads can take the pool's lock meanwhile
+            free.append(self.pool.cond.acquire(False))
+            if free[-1]:
+                self.pool.cond.release()
+            raise IOError('gone')
+        sftp.normalize.side_effect = probe
+        
+        self.assertIsNot(self.pool.acquire('a', self.factory), sftp)
+        self.assertEquals(free, [True])
+        self.assertEquals(self.pool.size, 1)
+    
+    def test_evicts_expired_sessions(self):
+        self.pool.max_idle = -1
+        sftp = self.pool.acquire('a', self.factory)
+        self.pool.release(sftp)
+        
+        self.assertIsNot(self.pool.acquire('a', self.factory), sftp)
+        self.assertEquals(self.pool.size, 1)
+    
+    def test_bounded_size(self):
+        a = self.pool.acquire('a', self.factory)
+        b = self.pool.acquire('b', self.factory)
+        
+        self.assertRaises(IOError, self.pool.acquire, 'c', self.factory)
+        
+        #an idle session of another key is evicted to make room
+        self.pool.release(a)
+        self.pool.acquire('c', self.factory)
+        self.assertTrue(self.clients[0].close.called)
+        self.assertEquals(self.pool.size, 2)
+    
+class SFTPStandInCase(TestCase):
+    
+    def setUp(self):
+        self.root = os.path.join(PATH, 'standin')
+        self.destination = SFTPDestination(name='StandIn', hostname='127.0.0.1',
+                                           username='admin', key_filename='test_rsa.key')
+        self.data = os.urandom(512 * 1024)
+    
+    def tearDown(self):
+        sftppool.clear()
+        shutil.rmtree(self.root, ignore_errors=True)
+    
+    def serve(self, **kwargs):
+        server = SFTPStandIn(self.root, **kwargs).start()
+        self.addCleanup(server.stop)
+        self.destination.port = str(server.port)
+        return server
+    
+    def test_pooled_session(self):
+        server = self.serve()
+        for name in ('a', 'b'):
+            self.assertTrue(self.destination.backup(BytesIO(self.data), 'pool', name))
+        
+        self.assertEquals((server.stats['connections'], server.stats['sessions']), (1, 1))
+        self.assertEquals(server.stats['bytes_written'], 2 * len(self.data))
+        self.assertEquals(open(os.path.join(self.root, 'pool', 'b'), 'rb').read(), self.data)
+    
+    def test_pipelined_writes_overlap_latency(self):
+        server = self.serve(latency=0.05)
+        #the handshake is out of the way
+        self.assertIsNone(self.destination.stat('pipe', 'missing'))
+        
+        start = time.time()
+        self.assertTrue(self.destination.backup(BytesIO(self.data), 'pipe', 'f'))
+        elapsed = time.time() - start
+        
+        writes = len(self.data) / self.destination.chunk_size
+        self.assertEquals(server.stats['writes'], writes)
+        #a round trip per write would take writes * 0.1s
+        self.assertLess(elapsed, writes * 0.1 / 2)
+        self.assertGreater(elapsed, 0.1)
+    
+    def test_bandwidth(self):
+        #a second's worth of burst, then the rest at the limit
+        self.serve(bandwidth=256 * 1024)
+        start = time.time()
+        self.assertTrue(self.destination.backup(BytesIO(self.data), 'slow', 'f'))
+        
+        self.assertGreater(time.time() - start, 0.9)
+    
+    def test_parallel_sessions(self):
+        server = self.serve(latency=0.01)
+        self.destination.streams = 3
+        with override_settings(SFTP_STRIPE_SIZE=64 * 1024):
+            self.assertTrue(self.destination.backup(BytesIO(self.data), 'parallel', 'f'))
+            contents, success = self.destination.restore('parallel', 'f')
+            restored = contents.read()
+            contents.close()
+        
+        self.assertTrue(success)
+        self.assertEquals(restored, self.data)
+        self.assertEquals(server.stats['sessions'], 3)
+    
+
 class APILoginTestCase(APITestCase):
     def setUp(self):
         users = [
@@ -241,7 +1207,110 @@ class APILoginTestCase(APITestCase):
         self.assertEquals(response.status_code, status.HTTP_200_OK)
         self.assertNotIn('error', response.data)
     
+    def test_api_authenticate_token_cached(self):
+        auth_cache.clear()
+        user = User.objects.get(username='admin')
+        self.client.credentials(HTTP_AUTHORIZATION='Token ' + user.auth_token.key)
+        self.client.get('/users/', format='json')
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get('/users/', format='json')
+        self.assertEquals(response.status_code, status.HTTP_200_OK)
+        self.assertFalse([q for q in queries.captured_queries if '"authtoken_token"."key" =' in q['sql']])
+        
+        #a revoked token is refused at once
+        user.auth_token.delete()
+        response = self.client.get('/users/', format='json')
+        self.assertEquals(response.status_code, status.HTTP_401_UNAUTHORIZED)
+    
+    def test_api_authenticate_basic_cached(self):
+        auth_cache.clear()
+        user = User.objects.get(username='default')
+        self.client.credentials(HTTP_AUTHORIZATION='Basic ' + 'default:default'.encode('base64').strip())
+        with mock.patch('django.contrib.auth.models.check_password',
+                        wraps=check_password) as checked:
+            for i in range(3):
+                response = self.client.get('/users/', format='json')
+                self.assertEquals(response.status_code, status.HTTP_200_OK)
+        self.assertEquals(checked.call_count, 1)
+        
+        user.set_password('changed')
+        user.save()
+        response = self.client.get('/users/', format='json')
+        self.assertEquals(response.status_code, status.HTTP_401_UNAUTHORIZED)
+    
+    def test_api_authenticate_origin_hmac(self):
+        auth_cache.clear()
+        user = User.objects.get(username='default')
+        origin = Origin.objects.create(name='agent', plan='', user=user)
+        
+        def sign(path, timestamp=None, apikey=origin.apikey, method='GET', body=''):
+            timestamp = timestamp or int(time.time())
+            signature = sign_request(apikey, method, path, timestamp,
+                                     hashlib.sha256(body).hexdigest())
+            return 'HMAC %d:%d:%s' % (origin.id, timestamp, signature)
+        
+        response = self.client.get('/users/', HTTP_AUTHORIZATION=sign('/users/'))
+        self.assertEquals(response.status_code, status.HTTP_200_OK)
+        self.assertEquals([u['username'] for u in response.data], ['default'])
+        
+        for header in (sign('/backups/'),
+                       sign('/users/', apikey='wrong'),
+                       sign('/users/', timestamp=int(time.time()) - 3600),
+                       sign('/users/', body='not sent')):
+            response = self.client.get('/users/', HTTP_AUTHORIZATION=header)
+            self.assertEquals(response.status_code, status.HTTP_401_UNAUTHORIZED)
+        
+        #the body is signed: one that was changed on the way is refused
+        body = json.dumps({'username': 'other', 'email': 'o@o.com'})
+        header = sign('/users/', method='POST', body=body)
+        response = self.client.generic('POST', '/users/', body.replace('other', 'evil'),
+                                       'application/json', HTTP_AUTHORIZATION=header)
+        self.assertEquals(response.status_code, status.HTTP_401_UNAUTHORIZED)
+        self.assertFalse(User.objects.filter(username='evil').exists())
+        response = self.client.generic('POST', '/users/', body,
+                                       'application/json', HTTP_AUTHORIZATION=header)
+        self.assertNotEquals(response.status_code, status.HTTP_401_UNAUTHORIZED)
     
+    def test_api_authenticate_origin_hmac_replay(self):
+        auth_cache.clear()
+        user = User.objects.get(username='default')
+        origin = Origin.objects.create(name='agent', plan='', user=user)
+        timestamp = int(time.time())
+        header = 'HMAC %d:%d:%s' % (origin.id, timestamp,
+                                    sign_request(origin.apikey, 'GET', '/users/', timestamp))
+        
+        response = self.client.get('/users/', HTTP_AUTHORIZATION=header)
+        self.assertEquals(response.status_code, status.HTTP_200_OK)
+        #the same signed request again, within the skew window
+        response = self.client.get('/users/', HTTP_AUTHORIZATION=header)
+        self.assertEquals(response.status_code, status.HTTP_401_UNAUTHORIZED)
+        self.assertIn('already used', response.data['detail'])
+        
+        #a new signature of the same request is accepted
+        header = 'HMAC %d:%d:%s' % (origin.id, timestamp + 1,
+                                    sign_request(origin.apikey, 'GET', '/users/', timestamp + 1))
+        response = self.client.get('/users/', HTTP_AUTHORIZATION=header)
+        self.assertEquals(response.status_code, status.HTTP_200_OK)
+    
+    @override_settings(AUTH_HMAC_MAX_BODY=1024)
+    def test_api_authenticate_origin_hmac_max_body(self):
+        auth_cache.clear()
+        user = User.objects.get(username='default')
+        origin = Origin.objects.create(name='agent', plan='', user=user)
+        body = 'x' * 2048
+        timestamp = int(time.time())
+        header = 'HMAC %d:%d:%s' % (origin.id, timestamp,
+                                    sign_request(origin.apikey, 'POST', '/users/', timestamp,
+                                                 hashlib.sha256(body).hexdigest()))
+        response = self.client.generic('POST', '/users/', body, 'application/json',
+                                       HTTP_AUTHORIZATION=header)
+        self.assertEquals(response.status_code, 413)
+    
+    def test_hmac_replay_cache_locmem_warning(self):
+        with mock.patch('server.authentication.logging.warning') as warning:
+            BodyDigestMiddleware()
+        self.assertEquals(warning.call_count, 1)
+        self.assertIn('AUTH_HMAC_REPLAY_CACHE', warning.call_args[0][0])
     
 class APIAdminTestCase(APITestCase):
     
@@ -266,9 +1335,781 @@ class APIAdminTestCase(APITestCase):
         self.assertEquals(response.status_code, status.HTTP_200_OK)
         self.assertNotIn('error', response.data)
     
+    def test_api_list_destinations_constant_queries(self):
+        def count_queries():
+            with CaptureQueriesContext(connection) as queries:
+                response = self.client.get('/destinations/', format='json')
+            self.assertEquals(response.status_code, status.HTTP_200_OK)
+            return len(queries)
+        
+        #staff see the type and the nested concrete destination
+        User.objects.filter(username='admin').update(is_staff=True)
+        LocalDestination.objects.create(name='HD1', directory=os.path.join(PATH, 'destination1'))
+        SFTPDestination.objects.create(name='SFTP1', hostname='localhost', port='3373',
+                                       username='admin', key_filename='test_rsa.key')
+        #the first request also caches the token
+        count_queries()
+        queries = count_queries()
+        LocalDestination.objects.create(name='HD2', directory=os.path.join(PATH, 'destination2'))
+        DedupDestination.objects.create(name='Dedup', directory=os.path.join(PATH, 'dedup'))
+        
+        self.assertEquals(count_queries(), queries)
+        self.assertEquals([d.type for d in BaseDestination.objects.order_by('id')],
+                          ['LocalDestination', 'SFTPDestination', 'LocalDestination', 'DedupDestination'])
+    
     def test_api_get_user_auth_admin(self, ):
         response = self.client.get('/users/2/', format='json')
         
         self.assertEquals(response.status_code, status.HTTP_200_OK)
         self.assertNotIn('error', response.data)
-        
\ No newline at end of file
+            
+class APIBackupTestCase(APITestCase):
+    
+    def setUp(self):
+        self.user = User.objects.create(username='Guadalupe', email='g@g.com')
+        self.destination = LocalDestination.objects.create(
+            name = 'HD3',
+            directory = os.path.join(PATH, 'destination3')
+        )
+        self.fn = os.path.join(PATH, 'reactive_course source code_reactive-week1.zip')
+        self.client.credentials(HTTP_AUTHORIZATION='Token ' + self.user.auth_token.key)
+    
+    def tearDown(self):
+        self.client.logout()
+    
+    @classmethod
+    def tearDownClass(cls):
+        rm_dir_files(PATH)
+    
+    def upload(self, name='stream.zip'):
+        with open(self.fn, 'rb') as f:
+            self.client.post('/backups/?upload=stream&name=%s&destination=HD3' % name,
+                             {'file': f}, format='multipart')
+        return Backup.objects.get(name=name)
+    
+    def test_api_streaming_upload(self):
+        with open(self.fn, 'rb') as f:
+            response = self.client.post('/backups/?upload=stream&name=stream.zip&destination=HD3',
+                                        {'file': f}, format='multipart')
+        
+        self.assertEquals(response.status_code, status.HTTP_201_CREATED)
+        self.assertEquals(Backup.objects.count(), 1)
+        b = Backup.objects.get()
+        self.assertTrue(b.success)
+        self.assertFalse(b.file)
+        stored = os.path.join(PATH, 'destination3', 'Guadalupe', 'stream.zip')
+        data = open(self.fn, 'rb').read()
+        self.assertEquals(open(stored, 'rb').read(), data)
+        self.assertEquals((b.size, b.sha256), (len(data), hashlib.sha256(data).hexdigest()))
+    
+    def test_api_streaming_upload_parsed_before(self):
+        initial = BackupViewSet.initial
+        
+        def parse_first(self, request, *args, **kwargs):
+            request._request.POST
+            return initial(self, request, *args, **kwargs)
+        
+        with mock.patch.object(BackupViewSet, 'initial', autospec=True, side_effect=parse_first):
+            b = self.upload()
+        
+        #the file parsed before the view is still copied to the destination
+        self.assertTrue(b.success)
+        stored = os.path.join(PATH, 'destination3', 'Guadalupe', 'stream.zip')
+        data = open(self.fn, 'rb').read()
+        self.assertEquals(open(stored, 'rb').read(), data)
+        self.assertEquals(b.sha256, hashlib.sha256(data).hexdigest())
+    
+    def test_api_raw_download_corrupted(self):
+        b = self.upload()
+        stored = os.path.join(PATH, 'destination3', 'Guadalupe', b.name)
+        with open(stored, 'r+b') as f:
+            f.seek(1000)
+            f.write('x')
+        
+        response = self.client.get('/backups/%d/?fileformat=raw' % b.id)
+        self.assertEquals(response['Digest'], 'SHA-256=' + base64.b64encode(b.sha256.decode('hex')))
+        self.assertRaises(ChecksumMismatch, ''.join, response.streaming_content)
+        response.close()
+        
+        #ranges are not verified
+        response = self.client.get('/backups/%d/?fileformat=raw' % b.id, HTTP_RANGE='bytes=900-1100')
+        self.assertEquals(''.join(response.streaming_content)[100], 'x')
+        response.close()
+    
+    def test_api_raw_download(self):
+        b = self.upload()
+        
+        response = self.client.get('/backups/%d/?fileformat=raw' % b.id)
+        
+        self.assertEquals(response.status_code, status.HTTP_200_OK)
+        self.assertEquals(''.join(response.streaming_content), open(self.fn, 'rb').read())
+        response.close()
+    
+    @override_settings(DOWNLOAD_SENDFILE='x-sendfile')
+    def test_api_xsendfile_download(self):
+        b = self.upload()
+        
+        response = self.client.get('/backups/%d/?fileformat=raw' % b.id)
+        
+        self.assertEquals(response.status_code, status.HTTP_200_OK)
+        self.assertEquals(response['X-Sendfile'],
+                          os.path.join(PATH, 'destination3', 'Guadalupe', 'stream.zip'))
+        self.assertEquals(response.content, '')
+        self.assertIsNotNone(Backup.objects.get(id=b.id).restore_dt)
+    
+    @override_settings(DOWNLOAD_SENDFILE='x-accel-redirect', DOWNLOAD_ACCEL_PREFIX='/protected/')
+    def test_api_xaccel_download_checks_owner(self):
+        b = self.upload()
+        other = User.objects.create(username='other', email='o@o.com')
+        self.client.credentials(HTTP_AUTHORIZATION='Token ' + other.auth_token.key)
+        
+        response = self.client.get('/backups/%d/?fileformat=raw' % b.id)
+        
+        self.assertEquals(response.status_code, status.HTTP_404_NOT_FOUND)
+        self.assertNotIn('X-Accel-Redirect', response)
+    
+    @override_settings(DOWNLOAD_SENDFILE='wsgi')
+    def test_api_wsgi_file_wrapper_download(self):
+        b = self.upload()
+        response = self.client.get('/backups/%d/?fileformat=raw' % b.id)
+        application = wsgi_file_wrapper(lambda environ, start_response: response)
+        
+        result = application({'wsgi.file_wrapper': lambda f, size: f}, None)
+        
+        self.assertEquals(result.read(), open(self.fn, 'rb').read())
+        self.assertEquals(response['Content-Length'], str(os.path.getsize(self.fn)))
+        result.close()
+        self.assertTrue(response.file_to_stream.closed)
+    
+    def test_api_ranged_download(self):
+        b = self.upload()
+        data = open(self.fn, 'rb').read()
+        response = self.client.get('/backups/%d/?fileformat=raw' % b.id)
+        etag = response['ETag']
+        response.close()
+        
+        response = self.client.get('/backups/%d/?fileformat=raw' % b.id,
+                                   HTTP_RANGE='bytes=100-1123', HTTP_IF_RANGE=etag)
+        
+        self.assertEquals(response.status_code, status.HTTP_206_PARTIAL_CONTENT)
+        self.assertEquals(response['Content-Range'], 'bytes 100-1123/%d' % len(data))
+        self.assertEquals(''.join(response.streaming_content), data[100:1124])
+        response.close()
+        
+        response = self.client.get('/backups/%d/?fileformat=raw' % b.id,
+                                   HTTP_RANGE='bytes=-10')
+        self.assertEquals(''.join(response.streaming_content), data[-10:])
+        response.close()
+    
+    def test_api_ranged_download_stale_if_range(self):
+        b = self.upload()
+        
+        response = self.client.get('/backups/%d/?fileformat=raw' % b.id,
+                                   HTTP_RANGE='bytes=100-', HTTP_IF_RANGE='"stale"')
+        
+        self.assertEquals(response.status_code, status.HTTP_200_OK)
+        self.assertEquals(''.join(response.streaming_content), open(self.fn, 'rb').read())
+        response.close()
+    
+    def test_api_ranged_download_not_satisfiable(self):
+        b = self.upload()
+        size = os.path.getsize(self.fn)
+        
+        response = self.client.get('/backups/%d/?fileformat=raw' % b.id,
+                                   HTTP_RANGE='bytes=%d-' % size)
+        
+        self.assertEquals(response.status_code, status.HTTP_416_REQUESTED_RANGE_NOT_SATISFIABLE)
+        self.assertEquals(response['Content-Range'], 'bytes */%d' % size)
+    
+    def test_parse_range(self):
+        self.assertEquals(parse_range('bytes=0-99', 1000), (0, 99))
+        self.assertEquals(parse_range('bytes=900-', 1000), (900, 999))
+        self.assertEquals(parse_range('bytes=-100', 1000), (900, 999))
+        self.assertEquals(parse_range('bytes=990-2000', 1000), (990, 999))
+        self.assertIsNone(parse_range('bytes=0-1,5-6', 1000))
+        self.assertIsNone(parse_range('items=0-1', 1000))
+        self.assertIsNone(parse_range('bytes=a-b', 1000))
+        self.assertRaises(RangeNotSatisfiable, parse_range, 'bytes=1000-', 1000)
+    
+    def start_upload(self, name, size, destination='HD3'):
+        response = self.client.post('/uploads/', {'name': name,
+                                                  'destination': destination,
+                                                  'date': timezone.now(),
+                                                  'size': size}, format='json')
+        self.assertEquals(response.status_code, status.HTTP_201_CREATED)
+        return '/uploads/%d/' % response.data['id']
+    
+    def put_chunk(self, url, number, offset, data):
+        return self.client.put(url + 'chunk/?number=%d&offset=%d' % (number, offset), data,
+                               content_type='application/octet-stream')
+    
+    def test_api_chunked_upload(self):
+        data = open(self.fn, 'rb').read()
+        half = len(data) / 2
+        #a backup of the same name, which the upload must not touch
+        self.upload('chunked.zip')
+        url = self.start_upload('chunked.zip', len(data) + 1)
+        
+        #chunks out of order, as parallel or resumed clients send them
+        response = self.put_chunk(url, 1, half, data[half:] + 'x')
+        self.assertEquals(response.data['received'], [[half, len(data) + 1]])
+        response = self.client.post(url + 'finalize/')
+        self.assertEquals(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEquals(response.data['missing'], [[0, half]])
+        
+        self.put_chunk(url, 0, 0, data[:half])
+        response = self.client.post(url + 'finalize/')
+        
+        self.assertEquals(response.status_code, status.HTTP_201_CREATED)
+        b = Backup.objects.get(id=response.data['id'])
+        self.assertTrue(b.success)
+        self.assertEquals((b.size, b.sha256), (len(data) + 1, hashlib.sha256(data + 'x').hexdigest()))
+        self.assertEquals(b.restore().read(), data + 'x')
+        stored = os.path.join(PATH, 'destination3', 'Guadalupe', 'chunked.zip')
+        self.assertEquals(open(stored, 'rb').read(), data)
+        self.assertEquals(self.client.post(url + 'finalize/').status_code, status.HTTP_400_BAD_REQUEST)
+    
+    def test_api_chunked_upload_resumed(self):
+        data = ''.join(chr(i * 7 % 251) for i in range(30000))
+        url = self.start_upload('resumed.bin', len(data))
+        self.put_chunk(url, 0, 0, data[:10000])
+        #the connection dropped in the middle of chunk 1
+        self.put_chunk(url, 1, 10000, data[10000:15000])
+        
+        #the client resumes from what the server has
+        received = self.client.get(url).data['received']
+        self.assertEquals(received, [[0, 15000]])
+        self.put_chunk(url, 1, 10000, data[10000:20000])
+        self.put_chunk(url, 2, 20000, data[20000:])
+        response = self.client.post(url + 'finalize/')
+        
+        self.assertEquals(response.status_code, status.HTTP_201_CREATED)
+        b = Backup.objects.get(id=response.data['id'])
+        self.assertEquals(b.sha256, hashlib.sha256(data).hexdigest())
+        self.assertEquals(b.restore().read(), data)
+        
+        #chunks past the announced size are not a complete upload
+        url = self.start_upload('overflow.bin', 100)
+        self.put_chunk(url, 0, 0, data[:150])
+        response = self.client.post(url + 'finalize/')
+        self.assertEquals(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertIn('150 bytes', response.data['error'])
+        self.assertFalse(Backup.objects.filter(name='overflow.bin').exists())
+    
+    def test_chunked_upload_parallel_writes(self):
+        data = ''.join(chr(i * 7 % 251) for i in range(400000))
+        url = self.start_upload('parallel.bin', len(data))
+        session = UploadSession.objects.select_related('user').get(name='parallel.bin')
+        #resolved here, the threads have no database
+        session.destination.destination_impl
+        size = 50000
+        
+        #chunks written into the file by concurrent requests
+        def write(offset):
+            with session.writer(offset) as f:
+                for i in range(offset, offset + size, 1000):
+                    f.write(data[i:i + 1000])
+                    time.sleep(0)
+        threads = [threading.Thread(target=write, args=(offset,))
+                   for offset in range(0, len(data), size)]
+        random.shuffle(threads)
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        for number, offset in enumerate(range(0, len(data), size)):
+            UploadChunk.objects.create(session=session, number=number, offset=offset, length=size)
+        response = self.client.post(url + 'finalize/')
+        
+        self.assertEquals(response.status_code, status.HTTP_201_CREATED)
+        self.assertEquals(Backup.objects.get(id=response.data['id']).restore().read(), data)
+    
+    def test_chunked_upload_first_chunks_race(self):
+        url = self.start_upload('race.bin', 20)
+        session = UploadSession.objects.get(name='race.bin')
+        with session.writer(10) as f:
+            f.write('b' * 10)
+        #the other first chunk checked for the file before this one created it
+        with mock.patch('os.path.exists', return_value=False):
+            session.write_chunk(0, 0, BytesIO('a' * 10))
+        #a retry of chunk 0 recorded it between the delete and the insert
+        with mock.patch('django.db.models.query.QuerySet.delete'):
+            chunk = session.write_chunk(0, 0, BytesIO('a' * 10))
+        UploadChunk.objects.create(session=session, number=1, offset=10, length=10)
+        
+        self.assertEquals((chunk.offset, chunk.length, session.chunks.count()), (0, 10, 2))
+        response = self.client.post(url + 'finalize/')
+        self.assertEquals(response.status_code, status.HTTP_201_CREATED)
+        self.assertEquals(Backup.objects.get(id=response.data['id']).restore().read(), 'a' * 10 + 'b' * 10)
+    
+    def test_api_chunked_upload_pipeline(self):
+        self.destination.compression = 'zlib'
+        self.destination.save()
+        policy = ReplicationPolicy.objects.create(name='copies', destination=self.destination)
+        policy.replicas.add(LocalDestination.objects.create(
+            name = 'HD4',
+            directory = os.path.join(PATH, 'destination4')
+        ))
+        data = ''.join('INSERT INTO backup VALUES (%d);\n' % i for i in range(5000))
+        url = self.start_upload('dump.sql', len(data))
+        self.put_chunk(url, 1, 40000, data[40000:])
+        self.put_chunk(url, 0, 0, data[:40000])
+        response = self.client.post(url + 'finalize/')
+        
+        self.assertEquals(response.status_code, status.HTTP_201_CREATED)
+        b = Backup.objects.get(id=response.data['id'])
+        self.assertEquals((b.codec, b.size, b.sha256), ('zlib', len(data), hashlib.sha256(data).hexdigest()))
+        self.assertEquals(b.restore().read(), data)
+        self.assertEquals([r.success for r in b.replicas.all()], [True])
+        #the chunks' file is rewritten compressed, then removed
+        self.assertEquals(b.stored_name, 'dump.sql')
+        session = UploadSession.objects.get(name='dump.sql')
+        self.assertFalse(os.path.exists(os.path.join(PATH, 'destination3', 'Guadalupe', session.filename)))
+    
+    def test_api_chunked_upload_needs_offset_writes(self):
+        DedupDestination.objects.create(name='Dedup', directory=os.path.join(PATH, 'dedup'))
+        response = self.client.post('/uploads/', {'name': 'chunked.zip',
+                                                  'destination': 'Dedup',
+                                                  'date': timezone.now(),
+                                                  'size': 10}, format='json')
+        
+        self.assertEquals(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertIn('destination', response.data)
+        self.assertFalse(UploadSession.objects.exists())
+    
+    def test_api_async_upload(self):
+        with open(self.fn, 'rb') as f:
+            response = self.client.post('/backups/?async=1', {'name': 'async.zip',
+                                                              'destination': 'HD3',
+                                                              'date': timezone.now(),
+                                                              'file': f}, format='multipart')
+        
+        self.assertEquals(response.status_code, status.HTTP_202_ACCEPTED)
+        self.assertEquals(response.data['job']['status'], TransferJob.PENDING)
+        stored = os.path.join(PATH, 'destination3', 'Guadalupe', 'async.zip')
+        self.assertFalse(os.path.exists(stored))
+        
+        job = TransferJob.claim()
+        self.assertEquals(job.id, response.data['job']['id'])
+        self.assertIsNone(TransferJob.claim())
+        self.assertTrue(job.run())
+        
+        self.assertEquals(TransferJob.objects.get().status, TransferJob.DONE)
+        b = Backup.objects.get(name='async.zip')
+        self.assertTrue(b.success)
+        self.assertFalse(b.file)
+        self.assertEquals(open(stored, 'rb').read(), open(self.fn, 'rb').read())
+        
+        response = self.client.get('/jobs/%d/' % job.id)
+        self.assertEquals(response.data['status'], TransferJob.DONE)
+    
+    def test_async_upload_retried(self):
+        with open(self.fn, 'rb') as f:
+            self.client.post('/backups/?async=1', {'name': 'retried.zip',
+                                                   'destination': 'HD3',
+                                                   'date': timezone.now(),
+                                                   'file': f}, format='multipart')
+        writer = LocalDestination.writer
+        calls = []
+        def failing_once(destination, *args, **kwargs):
+            calls.append(1)
+            if len(calls) == 1:
+                raise IOError('destination unavailable')
+            return writer(destination, *args, **kwargs)
+        
+        with mock.patch.object(LocalDestination, 'writer', failing_once):
+            self.assertFalse(TransferJob.claim().run())
+            job = TransferJob.objects.get()
+            self.assertEquals((job.status, job.attempts), (TransferJob.PENDING, 1))
+            #the destination's error, not a generic one
+            self.assertEquals(job.error, 'destination unavailable')
+            self.assertTrue(os.path.isfile(Backup.objects.get(name='retried.zip').file.path))
+            #not retried before its backoff is over
+            self.assertTrue(job.not_before > timezone.now())
+            self.assertIsNone(TransferJob.claim())
+            TransferJob.objects.update(not_before=timezone.now())
+            self.assertTrue(TransferJob.claim().run())
+        
+        job = TransferJob.objects.get()
+        self.assertEquals((job.status, job.attempts), (TransferJob.DONE, 2))
+        b = Backup.objects.get(name='retried.zip')
+        self.assertTrue(b.success)
+        self.assertFalse(b.file)
+        stored = os.path.join(PATH, 'destination3', 'Guadalupe', 'retried.zip')
+        self.assertEquals(open(stored, 'rb').read(), open(self.fn, 'rb').read())
+    
+    def test_async_upload_failed_discards_staged(self):
+        with open(self.fn, 'rb') as f:
+            self.client.post('/backups/?async=1', {'name': 'failed.zip',
+                                                   'destination': 'HD3',
+                                                   'date': timezone.now(),
+                                                   'file': f}, format='multipart')
+        staged = Backup.objects.get(name='failed.zip').file.path
+        with mock.patch.object(LocalDestination, 'writer', side_effect=IOError('down')):
+            with override_settings(TRANSFER_MAX_ATTEMPTS=2, TRANSFER_RETRY_BACKOFF=0):
+                for i in range(2):
+                    self.assertFalse(TransferJob.claim().run())
+        
+        self.assertEquals(TransferJob.objects.get().status, TransferJob.FAILED)
+        b = Backup.objects.get(name='failed.zip')
+        self.assertFalse(b.success)
+        self.assertEquals(b.obs, 'down')
+        self.assertFalse(b.file)
+        self.assertFalse(os.path.exists(staged))
+    
+    @override_settings(TRANSFER_MAX_ATTEMPTS=2)
+    def test_stale_jobs_requeued_until_max_attempts(self):
+        with open(self.fn, 'rb') as f:
+            for name in ('stale1.zip', 'stale2.zip'):
+                self.client.post('/backups/?async=1', {'name': name,
+                                                       'destination': 'HD3',
+                                                       'date': timezone.now(),
+                                                       'file': f}, format='multipart')
+                f.seek(0)
+        #both workers died, the second on its last attempt
+        TransferJob.objects.update(status=TransferJob.RUNNING, attempts=1,
+                                   started=timezone.now() - timedelta(hours=1))
+        TransferJob.objects.filter(backup__name='stale2.zip').update(attempts=2)
+        
+        self.assertEquals(TransferJob.requeue_stale(timeout=60), 1)
+        job = TransferJob.objects.get(backup__name='stale1.zip')
+        self.assertEquals((job.status, job.worker), (TransferJob.PENDING, ''))
+        job = TransferJob.objects.get(backup__name='stale2.zip')
+        self.assertEquals(job.status, TransferJob.FAILED)
+        b = Backup.objects.get(name='stale2.zip')
+        self.assertFalse(b.success)
+        self.assertFalse(b.file)
+        Backup.objects.get(name='stale1.zip').discard_staged()
+    
+    def test_transfer_retry_delay(self):
+        with override_settings(TRANSFER_RETRY_BACKOFF=10, TRANSFER_RETRY_MAX_BACKOFF=60):
+            self.assertEquals([TransferJob.retry_delay(n) for n in range(1, 6)],
+                              [10, 20, 40, 60, 60])
+    
+    def test_api_streaming_upload_replicated(self):
+        policy = ReplicationPolicy.objects.create(name='copies', destination=self.destination)
+        policy.replicas.add(LocalDestination.objects.create(
+            name = 'HD4',
+            directory = os.path.join(PATH, 'destination4')
+        ))
+        #directory below an existing file, so the replica can't be written
+        policy.replicas.add(LocalDestination.objects.create(
+            name = 'Broken',
+            directory = self.fn
+        ))
+        
+        b = self.upload()
+        
+        self.assertTrue(b.success)
+        data = open(self.fn, 'rb').read()
+        for directory in ('destination3', 'destination4'):
+            stored = os.path.join(PATH, directory, 'Guadalupe', 'stream.zip')
+            self.assertEquals(open(stored, 'rb').read(), data)
+        replicas = dict((r.destination.name, r.success) for r in b.replicas.all())
+        self.assertEquals(replicas, {'HD4': True, 'Broken': False})
+    
+    def test_api_list_keyset_pagination(self):
+        dt = timezone.now()
+        for i in range(5):
+            Backup.objects.create(user=self.user, name='nightly_%d' % i,
+                                  destination=self.destination, date=dt)
+        Backup.objects.create(user=self.user, name='weekly', success=True,
+                              destination=self.destination, date=dt)
+        
+        names, url = [], '/backups/?page_size=2&name_prefix=nightly'
+        while url:
+            response = self.client.get(url, format='json')
+            self.assertEquals(response.status_code, status.HTTP_200_OK)
+            self.assertTrue(len(response.data['results']) <= 2)
+            names += [b['name'] for b in response.data['results']]
+            url = response.data['next']
+        
+        #same date, so newest id first
+        self.assertEquals(names, ['nightly_%d' % i for i in reversed(range(5))])
+        response = self.client.get('/backups/?cursor=invalid', format='json')
+        self.assertEquals(response.status_code, status.HTTP_400_BAD_REQUEST)
+        
+        #without cursor or page_size, the whole bare list as before
+        response = self.client.get('/backups/?name=ightly', format='json')
+        self.assertEquals(sorted(b['name'] for b in response.data),
+                          ['nightly_%d' % i for i in range(5)])
+    
+    def test_api_list_export(self):
+        dt = timezone.now()
+        for i in range(3):
+            Backup.objects.create(user=self.user, name='nightly_%d' % i,
+                                  destination=self.destination, date=dt)
+        
+        response = self.client.get('/backups/?page_size=10', format='json')
+        expected = json.loads(response.content)['results']
+        
+        response = self.client.get('/backups/?export=ndjson')
+        self.assertEquals(response['Content-Type'], 'application/x-ndjson')
+        rows = [json.loads(line) for line in ''.join(response.streaming_content).splitlines()]
+        self.assertEquals(rows, expected)
+        
+        response = self.client.get('/backups/?export=json&name_prefix=nightly_1')
+        self.assertEquals(json.loads(''.join(response.streaming_content)),
+                          [row for row in expected if row['name'] == 'nightly_1'])
+    
+    def test_api_streaming_upload_requires_destination(self):
+        with open(self.fn, 'rb') as f:
+            response = self.client.post('/backups/?upload=stream&name=stream.zip',
+                                        {'file': f}, format='multipart')
+        
+        self.assertEquals(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEquals(Backup.objects.count(), 0)
+
+class MetricsCase(APITestCase):
+    
+    def setUp(self):
+        metrics_registry.clear()
+        self.user = User.objects.create(username='Guadalupe', email='g@g.com')
+        self.destination = LocalDestination.objects.create(
+            name = 'HD1',
+            directory = os.path.join(PATH, 'destination1')
+        )
+        self.data = os.urandom(100 * 1024)
+        self.client.credentials(HTTP_AUTHORIZATION='Token ' + self.user.auth_token.key)
+    
+    @classmethod
+    def tearDownClass(cls):
+        rm_dir_files(PATH)
+    
+    def labels(self, operation, **labels):
+        return dict(labels, operation=operation, destination='HD1', type='LocalDestination')
+    
+    def test_render(self):
+        registry = Registry()
+        c = registry.counter('c_total', 'A counter', ('name',))
+        h = registry.histogram('h_seconds', 'A histogram', buckets=(0.1, 1))
+        c.inc(name='a"b\n')
+        c.inc(2, name='a"b\n')
+        for value in (0.05, 0.5, 5):
+            h.observe(value)
+        registry.collector(lambda: [('g', 'gauge', 'A gauge', [({}, 3)])])
+        
+        self.assertEquals(registry.render().splitlines(), [
+            '# HELP c_total A counter',
+            '# TYPE c_total counter',
+            'c_total{name="a\\"b\\n"} 3',
+            '# HELP h_seconds A histogram',
+            '# TYPE h_seconds histogram',
+            'h_seconds_bucket{le="0.1"} 1',
+            'h_seconds_bucket{le="1"} 2',
+            'h_seconds_bucket{le="+Inf"} 3',
+            'h_seconds_sum 5.55',
+            'h_seconds_count 3',
+            '# HELP g A gauge',
+            '# TYPE g gauge',
+            'g 3',
+        ])
+        self.assertRaises(ValueError, c.inc)
+    
+    def test_backup_and_restore(self):
+        b = Backup.objects.create(user=self.user, name='m.zip',
+                                  destination=self.destination, date=timezone.now())
+        self.assertTrue(b.backup(BytesIO(self.data)))
+        f = b.restore()
+        self.assertEquals(metrics.transfers_in_flight.get(**self.labels('restore')), 1)
+        self.assertEquals(''.join(str(data) for data in chunks(f, 4096)), self.data)
+        f.close()
+        
+        for operation in ('backup', 'restore'):
+            self.assertEquals(metrics.transfers.get(**self.labels(operation, outcome='success')), 1)
+            self.assertEquals(metrics.transfer_bytes.get(**self.labels(operation)), (1, len(self.data)))
+            self.assertEquals(metrics.transfer_seconds.get(**self.labels(operation))[0], 1)
+            self.assertEquals(metrics.transfers_in_flight.get(**self.labels(operation)), 0)
+        
+        #a corrupted file fails as it is read
+        with open(os.path.join(PATH, 'destination1', 'Guadalupe', 'm.zip'), 'r+b') as f:
+            f.write('bit rot')
+        f = b.restore()
+        self.assertRaises(ChecksumMismatch, f.read)
+        f.close()
+        self.assertEquals(metrics.transfers.get(**self.labels('restore', outcome='failure')), 1)
+        
+        self.destination.directory = '/dev/null/nowhere'
+        self.assertFalse(Backup(user=self.user, name='n.zip', destination=self.destination).write(BytesIO('x')))
+        self.assertEquals(metrics.transfers.get(**self.labels('backup', outcome='failure')), 1)
+    
+    def test_streaming_upload(self):
+        f = BytesIO(self.data)
+        f.name = 'stream.zip'
+        response = self.client.post('/backups/?upload=stream&name=stream.zip&destination=HD1',
+                                    {'file': f}, format='multipart')
+        self.assertEquals(response.status_code, status.HTTP_201_CREATED)
+        
+        self.assertEquals(metrics.transfer_bytes.get(**self.labels('backup')), (1, len(self.data)))
+        self.assertEquals(metrics.transfers_in_flight.get(**self.labels('backup')), 0)
+    
+    def test_sftp_connect(self):
+        destination = SFTPDestination(name='StandIn', hostname='127.0.0.1',
+                                      username='admin', key_filename='test_rsa.key')
+        with SFTPStandIn(os.path.join(PATH, 'standin')) as server:
+            destination.port = str(server.port)
+            self.assertIsNone(destination.stat('none', 'none'))
+        sftppool.clear()
+        destination.port = str(server.port)
+        self.assertIsNone(destination.stat('none', 'none'))
+        
+        self.assertEquals(metrics.sftp_connect_seconds.get(destination='StandIn')[0], 1)
+        self.assertEquals(metrics.sftp_connect_failures.get(destination='StandIn'), 1)
+    
+    def test_endpoint(self):
+        self.client.get('/backups/')
+        self.client.get('/backups/')
+        #counted without the debug cursor, which would keep the SQL
+        self.assertEquals(connection.queries, [])
+        self.assertTrue(metrics.request_queries.get(endpoint='backup-list', method='GET')[1] > 0)
+        with override_settings(METRICS_ALLOWED_IPS=('10.0.0.7',)):
+            response = self.client.get('/metrics/', REMOTE_ADDR='10.0.0.7')
+        
+        self.assertEquals(response.status_code, status.HTTP_200_OK)
+        self.assertTrue(response['Content-Type'].startswith('text/plain; version=0.0.4'))
+        lines = response.content.splitlines()
+        self.assertIn('tbackup_http_requests_total{endpoint="backup-list",method="GET",status="200"} 2', lines)
+        self.assertIn('tbackup_http_db_queries_count{endpoint="backup-list",method="GET"} 2', lines)
+        self.assertIn('# TYPE tbackup_sftp_sessions gauge', lines)
+        
+        #not for users, nor for anyone behind a proxy on the same host
+        self.assertEquals(self.client.get('/metrics/').status_code, status.HTTP_403_FORBIDDEN)
+        self.client.credentials()
+        response = self.client.get('/metrics/', REMOTE_ADDR='127.0.0.1',
+                                   HTTP_X_FORWARDED_FOR='203.0.113.9')
+        self.assertEquals(response.status_code, status.HTTP_403_FORBIDDEN)
+        #staff API tokens
+        self.user.is_staff = True
+        self.user.save()
+        self.client.credentials(HTTP_AUTHORIZATION='Token ' + self.user.auth_token.key)
+        self.assertEquals(self.client.get('/metrics/').status_code, status.HTTP_200_OK)
+    
+
+class TracingCase(APITestCase):
+    
+    def setUp(self):
+        self.user = User.objects.create(username='Guadalupe', email='g@g.com')
+        self.destination = LocalDestination.objects.create(
+            name = 'HD1',
+            directory = os.path.join(PATH, 'destination1')
+        )
+        self.client.credentials(HTTP_AUTHORIZATION='Token ' + self.user.auth_token.key)
+        self.fn = os.path.join(PATH, 'reactive_course source code_reactive-week1.zip')
+        patcher = mock.patch.object(tracing.logger, 'warning')
+        self.log = patcher.start()
+        self.addCleanup(patcher.stop)
+    
+    @classmethod
+    def tearDownClass(cls):
+        rm_dir_files(PATH)
+    
+    def logged(self):
+        '''Span names of the trees logged so far'''
+        return [[line.split()[2] for line in call[0][3].splitlines()[1:]]
+                for call in self.log.call_args_list]
+    
+    def test_spans(self):
+        with tracing.span('outside') as s:
+            self.assertIsNone(s)
+        
+        trace = tracing.start('request', max_spans=3)
+        with tracing.span('a'):
+            with tracing.span('b', size=1):
+                pass
+            with tracing.span('dropped'):
+                pass
+        try:
+            with tracing.span('failing'):
+                raise IOError()
+        except IOError:
+            pass
+        self.assertIs(tracing.stop(), trace)
+        
+        lines = trace.format().splitlines()
+        self.assertEquals([line.split()[2:] for line in lines[1:-1]],
+                          [['request'], ['a'], ['b', 'size=1']])
+        self.assertEquals(lines[-1], '(2 more spans not kept)')
+        self.assertIsNone(tracing.current())
+    
+    def test_forced_upload(self):
+        with open(self.fn, 'rb') as f:
+            response = self.client.post('/backups/', {'name': 'traced.zip',
+                                                      'destination': 'HD1',
+                                                      'date': timezone.now(),
+                                                      'file': f},
+                                        format='multipart', HTTP_X_TRACE='1')
+        
+        self.assertEquals(response.status_code, status.HTTP_201_CREATED)
+        self.assertEquals(len(response['X-Trace-Id']), 16)
+        self.assertEquals([phase.split(';')[0] for phase in response['Server-Timing'].split(', ')],
+                          ['parse', 'backup.save'])
+        names = self.logged()[0]
+        self.assertEquals(names[:3], ['POST', 'parse', 'backup.save'])
+        for name in ('stage', 'backup.transfer', 'backup.write', 'destination.writer', 'copy'):
+            self.assertIn(name, names)
+        #the backup row is saved once more by backup() and by transfer()
+        self.assertEquals(names.count('backup.save'), 3)
+    
+    def test_forced_download_traces_send(self):
+        b = Backup.objects.create(user=self.user, name='traced.zip',
+                                  destination=self.destination, date=timezone.now())
+        self.assertTrue(b.backup(open(self.fn, 'rb')))
+        
+        response = self.client.get('/backups/%d/?fileformat=raw' % b.id, HTTP_X_TRACE='1')
+        self.assertFalse(self.log.called)
+        contents = ''.join(response.streaming_content)
+        
+        self.assertEquals(contents, open(self.fn, 'rb').read())
+        names = self.logged()[0]
+        for name in ('lookup', 'stat', 'backup.open', 'destination.restore', 'send'):
+            self.assertIn(name, names)
+    
+    def test_slow_requests(self):
+        with override_settings(TRACING=True, TRACE_SLOW_REQUEST=0):
+            self.client.get('/backups/')
+            self.assertEquals(self.log.call_args[0][1], 'slow')
+            with override_settings(TRACING=False):
+                self.client.get('/backups/')
+                response = self.client.get('/backups/')
+        
+        self.assertEquals(self.log.call_count, 1)
+        self.assertNotIn('X-Trace-Id', response)
+    
+
+class BenchmarkCase(TestCase):
+    
+    def test_benchmark_results(self):
+        fn = os.path.join(PATH, 'benchmark.jsonl')
+        out = BytesIO()
+        call_command('benchmark', sizes='1K,100K', repeat=3, output=fn, stdout=out)
+        results = [json.loads(line) for line in open(fn)]
+        os.remove(fn)
+        
+        self.assertEquals([(r['target'].split(':')[0], r['op'], r['size']) for r in results],
+                          [('LocalDestination', 'backup', 1024), ('LocalDestination', 'restore', 1024),
+                           ('LocalDestination', 'backup', 102400), ('LocalDestination', 'restore', 102400),
+                           ('http', 'upload', 1024), ('http', 'download', 1024),
+                           ('http', 'upload', 102400), ('http', 'download', 102400)])
+        for r in results:
+            self.assertTrue(r['mb_s'] > 0 and 0 < r['p50_ms'] <= r['max_ms'])
+            #3 runs are too few for a p99
+            self.assertEquals(r['p99_ms'], None)
+        self.assertEquals(len(out.getvalue().splitlines()), 8)
+        #everything the run created is gone
+        self.assertEquals((Backup.objects.count(), BaseDestination.objects.count(),
+                           User.objects.count()), (0, 0, 0))
+        
+        out = BytesIO()
+        open(fn, 'w').write(''.join(json.dumps(dict(r, mb_s=r['mb_s'] / 2)) + '\n' for r in results))
+        call_command('benchmark', sizes='1K', repeat=1, http=False, baseline=fn, stdout=out)
+        os.remove(fn)
+        self.assertIn('%', out.getvalue().splitlines()[-1])
+    
+    def test_benchmark_sftp_standin(self):
+        out = BytesIO()
+        call_command('benchmark', sizes='1K', repeat=2, local=False, http=False,
+                     sftp_standin=True, latency=1, sftp_streams=2, output='-', stdout=out)
+        results = [json.loads(line) for line in out.getvalue().splitlines()]
+        
+        self.assertEquals([(r['target'], r['op']) for r in results],
+                          [('SFTPStandIn:1ms,-,x2', 'backup'), ('SFTPStandIn:1ms,-,x2', 'restore')])
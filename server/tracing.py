@@ -0,0 +1,145 @@
+#-*- coding: utf-8 -*-
+
+import time
+import uuid
+import logging
+import threading
+from functools import wraps
+from contextlib import contextmanager
+
+logger = logging.getLogger('server.tracing')
+
+_local = threading.local()
+
+class Span(object):
+    '''A timed phase of a trace, with its tags and the phases nested in it'''
+
+    __slots__ = ('name', 'tags', 'start', 'end', 'children')
+
+    def __init__(self, name, tags):
+        self.name = name
+        self.tags = tags
+        self.start = time.time()
+        self.end = None
+        self.children = []
+
+    @property
+    def duration(self):
+        return (self.end or time.time()) - self.start
+
+    def lines(self, depth=0):
+        tags = ' '.join('%s=%s' % item for item in sorted(self.tags.items()))
+        yield '%10.1f ms  %s%s%s%s' % (self.duration * 1000, '  ' * depth, self.name,
+                                       ' ' if tags else '', tags)
+        for child in self.children:
+            for line in child.lines(depth + 1):
+                yield line
+
+class Trace(object):
+    '''
+        Span tree of one request, built by the thread serving it. At most
+        max_spans spans are kept, later ones are only counted, so a loop
+        that opens a span per iteration can not grow it without bound.
+    '''
+
+    def __init__(self, name, forced=False, max_spans=1000, **tags):
+        self.id = uuid.uuid4().hex[:16]
+        self.forced = forced
+        self.max_spans = max_spans
+        self.spans = 1
+        self.dropped = 0
+        self.root = Span(name, tags)
+        self.stack = [self.root]
+
+    def push(self, name, tags):
+        if self.spans >= self.max_spans:
+            self.dropped += 1
+            return None
+        self.spans += 1
+        span = Span(name, tags)
+        self.stack[-1].children.append(span)
+        self.stack.append(span)
+        return span
+
+    def pop(self, span):
+        span.end = time.time()
+        if span not in self.stack:
+            #the trace was finished meanwhile
+            return
+        #spans closed out of order (e.g. a generator abandoned midway)
+        #close the ones opened after them
+        while self.stack[-1] is not span:
+            self.stack.pop().end = span.end
+        self.stack.pop()
+
+    def finish(self):
+        now = time.time()
+        for span in self.stack:
+            span.end = span.end or now
+        self.stack = []
+
+    def format(self):
+        lines = ['trace %s' % self.id] + list(self.root.lines())
+        if self.dropped:
+            lines.append('(%d more spans not kept)' % self.dropped)
+        return '\n'.join(lines)
+
+    def server_timing(self):
+        '''Server-Timing header value with the top level phases finished so far'''
+        return ', '.join('%s;dur=%.1f' % (span.name, span.duration * 1000)
+                         for span in self.root.children if span.end is not None)
+
+def start(name, forced=False, max_spans=1000, **tags):
+    '''Starts tracing the calling thread, replacing any trace left behind'''
+    _local.trace = trace = Trace(name, forced, max_spans, **tags)
+    return trace
+
+def current():
+    return getattr(_local, 'trace', None)
+
+def stop():
+    '''Stops tracing the calling thread; returns the finished trace, or None'''
+    trace = current()
+    _local.trace = None
+    if trace is not None:
+        trace.finish()
+    return trace
+
+@contextmanager
+def span(name, **tags):
+    '''
+        Times the enclosed block as a span of the thread's trace, if it is
+        being traced; yields the span (None otherwise), whose tags may be
+        added to. Exceptions are tagged and go on.
+    '''
+    trace = current()
+    s = trace.push(name, tags) if trace is not None else None
+    if s is None:
+        yield None
+        return
+    try:
+        yield s
+    except Exception, e:
+        s.tags['error'] = e.__class__.__name__
+        raise
+    finally:
+        trace.pop(s)
+
+def traced(name):
+    '''Decorator: every call is a span named name'''
+    def decorator(function):
+        @wraps(function)
+        def wrapper(*args, **kwargs):
+            with span(name):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorator
+
+def log(trace, slow):
+    '''Logs the span tree of trace if it was forced or took slow seconds or more'''
+    duration = trace.root.duration
+    if trace.forced or (slow is not None and duration >= slow):
+        logger.warning('%s request (%.1f ms):\n%s', 'traced' if trace.forced else 'slow',
+                       duration * 1000, trace.format())
+        return True
+    return False
@@ -0,0 +1,104 @@
+#-*- coding: utf-8 -*-
+
+import logging
+
+from django.core.files.uploadedfile import UploadedFile
+from django.core.files.uploadhandler import FileUploadHandler, StopFutureHandlers
+
+from .metrics import Transfer
+
+class DestinationUploadHandler(FileUploadHandler):
+    '''
+        Streams the uploaded file straight into the backup's destination
+        while the multipart body is being parsed, without a staging file
+    '''
+
+    def __init__(self, backup, field_name='file', request=None):
+        super(DestinationUploadHandler, self).__init__(request)
+        self.backup = backup
+        self.upload_field = field_name
+        self.activated = False
+        self.success = False
+        self.error = None
+        self.size = 0
+        self.f = None
+        self.transfer = None
+
+    def new_file(self, field_name, *args, **kwargs):
+        super(DestinationUploadHandler, self).new_file(field_name, *args, **kwargs)
+        #only the backup file is handled here, other files go to the default handlers
+        if field_name != self.upload_field or self.activated:
+            return
+        self.activated = True
+        self.transfer = Transfer('backup', self.backup.destination)
+        try:
+            self.f = self.backup.writer()
+        except Exception, e:
+            self.fail(e)
+        raise StopFutureHandlers()
+
+    def receive_data_chunk(self, raw_data, start):
+        if self.field_name != self.upload_field:
+            return raw_data
+        #keeps consuming the body after a failure so the request is fully read
+        if self.f is not None:
+            try:
+                self.f.write(raw_data)
+            except Exception, e:
+                self.fail(e)
+        return None
+
+    def file_complete(self, file_size):
+        if self.field_name != self.upload_field:
+            return None
+        self.size = file_size
+        if self.f is not None:
+            try:
+                self.f.close()
+                self.success = True
+            except Exception, e:
+                self.fail(e)
+            self.f = None
+        self.finish()
+        #placeholder, the contents already are on the destination
+        return UploadedFile(name=self.file_name,
+                            content_type=self.content_type,
+                            size=file_size,
+                            charset=self.charset)
+
+    def handle_uploaded_file(self, uploaded_file):
+        '''Feeds an already parsed upload through the handler'''
+        if uploaded_file is None:
+            return
+        try:
+            self.new_file(self.upload_field, uploaded_file.name,
+                          uploaded_file.content_type, uploaded_file.size,
+                          uploaded_file.charset)
+        except StopFutureHandlers:
+            pass
+        start = 0
+        for chunk in uploaded_file.chunks(self.chunk_size):
+            self.receive_data_chunk(chunk, start)
+            start += len(chunk)
+        self.file_complete(start)
+
+    def fail(self, e):
+        logging.error(e)
+        self.error = e
+        self.abort()
+        self.finish()
+
+    def abort(self):
+        '''Closes the destination file if the upload did not complete'''
+        f, self.f = self.f, None
+        if f is not None:
+            try:
+                f.close()
+            except Exception, e:
+                logging.error(e)
+            self.finish()
+
+    def finish(self):
+        '''Records the outcome of the transfer, once'''
+        if self.transfer is not None:
+            self.transfer.done(self.size, self.success)
@@ -1,17 +1,44 @@
 #-*- coding: utf-8 -*-
 
 from django.contrib.auth.models import User, AnonymousUser
+from django.conf import settings
 from django.core.exceptions import FieldError
 from django.core.servers.basehttp import FileWrapper
-from django.http import StreamingHttpResponse
+from django.http import HttpResponse, HttpResponseForbidden, StreamingHttpResponse
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
 
 from rest_framework import viewsets, status, permissions, parsers, mixins
+from rest_framework.reverse import reverse
+from rest_framework.decorators import detail_route
 from rest_framework.response import Response
+from rest_framework.utils.encoders import JSONEncoder
+from rest_framework.exceptions import AuthenticationFailed
 
-from .models import Backup
+import json
+import base64
+from io import BytesIO
+
+from .models import Backup, UploadSession, UploadError, TransferJob
 from .models.destination.BaseDestination import BaseDestination
+from .models.destination.streams import LimitedFile
 
-from .serializers import UserSerializer, DestinationSerializer, BackupSerializer
+from .serializers import ( UserSerializer
+                         , DestinationSerializer
+                         , BackupSerializer
+                         , UploadSessionSerializer
+                         , TransferJobSerializer
+                         )
+from .uploadhandlers import DestinationUploadHandler
+from .pagination import paginate_keyset, InvalidCursor
+from .metrics import registry
+from .authentication import CachedTokenAuthentication
+from .tracing import span
+from .downloads import ( sendfile_response
+                       , sendfile_handles_ranges
+                       , parse_range
+                       , RangeNotSatisfiable
+                       )
 
 # ViewSets define the view behavior.
 class UserViewSet(viewsets.ModelViewSet):
@@ -92,7 +119,8 @@ class PrivateModelMixin(object):
                 return qs
     
 class DestinationViewSet(PrivateModelMixin, viewsets.ReadOnlyModelViewSet):
-    queryset = BaseDestination.objects.all()
+    #concrete destinations come in the same query
+    queryset = BaseDestination.objects.select_related(*BaseDestination.IMPLEMENTATIONS)
     serializer_class = DestinationSerializer
 
 class IsOwnerOrSuperuser(permissions.BasePermission):
@@ -114,9 +142,111 @@ class BackupViewSet(PrivateModelMixin,
     queryset = Backup.objects.all()
     serializer_class = BackupSerializer
     permission_classes = (IsOwnerOrSuperuser,)
+    page_size = getattr(settings, 'BACKUP_PAGE_SIZE', 100)
+    max_page_size = getattr(settings, 'BACKUP_MAX_PAGE_SIZE', 1000)
+    
+    def initialize_request(self, request, *args, **kwargs):
+        request = super(BackupViewSet, self).initialize_request(request, *args, **kwargs)
+        if request._request.method == 'POST' and self.is_streaming_upload(request):
+            #form overloading would parse the body before the upload handler is installed
+            request._METHOD_PARAM = request._CONTENT_PARAM = None
+        return request
+    
+    def is_streaming_upload(self, request):
+        return request.QUERY_PARAMS.get('upload', None) == 'stream'
+    
+    def is_async(self, request):
+        value = request.QUERY_PARAMS.get('async', None)
+        if value is None:
+            return getattr(settings, 'BACKUP_TRANSFER_ASYNC', False)
+        return value.lower() in ('1', 'true', 'yes')
+    
+    def create(self, request, *args, **kwargs):
+        if self.is_streaming_upload(request):
+            return self.create_streaming(request)
+        self.job = None
+        with span('parse'):
+            request.DATA, request.FILES
+        response = super(BackupViewSet, self).create(request, *args, **kwargs)
+        if self.job is not None:
+            #the transfer runs later in a runtransfers worker
+            response.status_code = status.HTTP_202_ACCEPTED
+            response.data['job'] = TransferJobSerializer(
+                self.job, context=self.get_serializer_context()).data
+        return response
+    
+    def pre_save(self, obj):
+        obj.defer_transfer = self.is_async(self.request)
+        super(BackupViewSet, self).pre_save(obj)
+    
+    def post_save(self, obj, created=False):
+        if created and obj.file and obj.defer_transfer:
+            self.job = TransferJob.objects.create(backup=obj)
+        super(BackupViewSet, self).post_save(obj, created)
+    
+    def create_streaming(self, request):
+        '''
+            Single pass upload: the multipart body is written straight into
+            the destination and the backup row is saved once at the end.
+            name, destination and date are given in the query string, since
+            they must be known before the body is parsed.
+        '''
+        q = request.QUERY_PARAMS
+        name = q.get('name', None)
+        destination_name = q.get('destination', None)
+        if not name or not destination_name:
+            return Response({'error': 'name and destination are required'},
+                            status=status.HTTP_400_BAD_REQUEST)
+        try:
+            destination = BaseDestination.objects.get(name=destination_name)
+        except BaseDestination.DoesNotExist:
+            return Response({'error': 'Destination %s does not exist' % destination_name},
+                            status=status.HTTP_400_BAD_REQUEST)
+        date = parse_datetime(q['date']) if q.get('date', None) else timezone.now()
+        if date is None:
+            return Response({'error': 'Invalid date'},
+                            status=status.HTTP_400_BAD_REQUEST)
+        
+        self.object = Backup(user=request.user,
+                             name=name,
+                             destination=destination,
+                             date=date)
+        handler = DestinationUploadHandler(self.object, request=request)
+        http_request = request._request
+        try:
+            if hasattr(http_request, '_files') or http_request._read_started:
+                #body was already read (e.g. request.POST by the session CSRF
+                #check), so the parsed file is copied to the destination instead
+                handler.handle_uploaded_file(request.FILES.get(handler.upload_field, None))
+            else:
+                #the file is written to the destination as it is parsed
+                request.upload_handlers.insert(0, handler)
+                with span('parse'):
+                    request.FILES
+        finally:
+            handler.abort()
+        
+        if not handler.activated:
+            return Response({'error': 'No file uploaded'},
+                            status=status.HTTP_400_BAD_REQUEST)
+        
+        self.object.success = handler.success
+        if handler.error is not None:
+            self.object.obs = unicode(handler.error)
+        self.object.save(force_insert=True)
+        
+        if not self.object.success:
+            return Response({'error': self.object.obs},
+                            status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+        
+        serializer = self.get_serializer(self.object)
+        headers = self.get_success_headers(serializer.data)
+        return Response(serializer.data, status=status.HTTP_201_CREATED,
+                        headers=headers)
     
     def retrieve(self, request, *args, **kwargs):
-        self.object = self.get_object()
+        with span('lookup'):
+            self.object = self.get_object()
         response = self.file_as_download(request)
         if response:
             return response
@@ -125,34 +255,156 @@ class BackupViewSet(PrivateModelMixin,
     
     def list(self, request, *args, **kwargs):
         self.object_list = self.filter_queryset(self.get_queryset())
-        if self.object_list.count() == 1:
-            self.object = self.object_list[0]
-            response = self.file_as_download(request)
-            if response:
-                return response
-        return super(BackupViewSet, self).list(request, *args, **kwargs)
+        if request.GET.get('fileformat', None) == 'raw':
+            #a single match is downloaded, two rows are enough to tell
+            rows = list(self.object_list[:2])
+            if len(rows) == 1:
+                self.object = rows[0]
+                response = self.file_as_download(request)
+                if response:
+                    return response
+        
+        export = request.QUERY_PARAMS.get('export', None)
+        if export in self.export_formats:
+            return self.export(request, export)
+        
+        if 'cursor' not in request.QUERY_PARAMS and 'page_size' not in request.QUERY_PARAMS:
+            #unpaged requests keep the original bare list
+            serializer = self.get_serializer(self.object_list, many=True)
+            return Response(serializer.data)
+        
+        try:
+            page_size = min(int(request.QUERY_PARAMS.get('page_size', self.page_size)),
+                            self.max_page_size)
+            if page_size < 1:
+                raise ValueError(page_size)
+            page, cursor = paginate_keyset(self.object_list,
+                                           request.QUERY_PARAMS.get('cursor', None),
+                                           page_size)
+        except (ValueError, InvalidCursor):
+            return Response({'error': 'Invalid cursor or page_size'},
+                            status=status.HTTP_400_BAD_REQUEST)
+        
+        next_url = None
+        if cursor:
+            query = request.GET.copy()
+            query['cursor'] = cursor
+            next_url = request.build_absolute_uri('?' + query.urlencode())
+        serializer = self.get_serializer(page, many=True)
+        return Response({'next': next_url, 'results': serializer.data})
+    
+    export_formats = {
+        'ndjson': 'application/x-ndjson',
+        'json':   'application/json',
+    }
+    
+    def export(self, request, export):
+        '''
+            Streams the whole filtered listing, as NDJSON or as a JSON array
+            written while it is built. Rows come from values_list().iterator(),
+            so no model instances or serializers are built per row and the
+            rows are not cached however many backups match. The encoder is
+            the renderer's, so values look the same as in the paged listing.
+        '''
+        rows = (self.object_list
+                .order_by('-date', '-id')
+                .values_list('id', 'name', 'file', 'destination__name', 'date', 'size', 'sha256')
+                .iterator())
+        #detail routes are the list route plus '<pk>/'
+        detail_url = reverse('backup-list', request=request) + '%d/'
+        
+        def lines():
+            for pk, name, filename, destination, date, size, sha256 in rows:
+                yield json.dumps({'id': pk,
+                                  'url': detail_url % pk,
+                                  'name': name,
+                                  'file': filename,
+                                  'destination': destination,
+                                  'date': date,
+                                  'size': size,
+                                  'sha256': sha256},
+                                 cls=JSONEncoder)
+        
+        def ndjson():
+            for line in lines():
+                yield line + '\n'
+        
+        def array():
+            yield '['
+            separator = ''
+            for line in lines():
+                yield separator + line
+                separator = ',\n'
+            yield ']\n'
+        
+        return StreamingHttpResponse(ndjson() if export == 'ndjson' else array(),
+                                     content_type=self.export_formats[export])
     
     def file_as_download(self, request):
         fileformat = request.GET.get('fileformat', None)
         if fileformat == 'raw':
+            with span('stat'):
+                stat = self.object.stat()
+            etag = '"%x-%x"' % stat if stat else None
+            byte_range = None
+            if stat and request.META.get('HTTP_RANGE', None):
+                #If-Range only keeps the range if the file did not change
+                if request.META.get('HTTP_IF_RANGE', etag) == etag:
+                    try:
+                        byte_range = parse_range(request.META['HTTP_RANGE'], stat[0])
+                    except RangeNotSatisfiable:
+                        file_response = HttpResponse(status=status.HTTP_416_REQUESTED_RANGE_NOT_SATISFIABLE)
+                        file_response['Content-Range'] = 'bytes */%d' % stat[0]
+                        return file_response
+            offset = byte_range[0] if byte_range else 0
+            
             #if offline file is available
             if self.object.file:
                 f = self.object.file
+                f.seek(offset)
             #else try to restore from destination
             else:
+                #local files can be sent by the web server itself
+                path = self.object.local_path()
+                if path and (byte_range is None or sendfile_handles_ranges()):
+                    file_response = sendfile_response(path)
+                    if file_response:
+                        self.object.restored()
+                        return self.download_headers(file_response, etag)
                 try:
-                    f = self.object.restore()
+                    f = self.object.restore(offset)
                 except Exception, e:
                     raise
             if f:
-                file_response = StreamingHttpResponse(FileWrapper(f), content_type='application/zip')
-                file_response['Content-Disposition'] = 'attachment; filename="%s"' % self.object.name
-                return file_response
+                if byte_range:
+                    start, end = byte_range
+                    f = LimitedFile(f, end - start + 1)
+                #chunks are pulled lazily and f is closed when the response ends
+                file_response = StreamingHttpResponse(FileWrapper(f, 64 * 1024), content_type='application/zip')
+                if byte_range:
+                    file_response.status_code = status.HTTP_206_PARTIAL_CONTENT
+                    file_response['Content-Range'] = 'bytes %d-%d/%d' % (start, end, stat[0])
+                    file_response['Content-Length'] = str(end - start + 1)
+                elif stat:
+                    file_response['Content-Length'] = str(stat[0])
+                return self.download_headers(file_response, etag)
         return None
     
+    def download_headers(self, file_response, etag):
+        file_response['Content-Disposition'] = 'attachment; filename="%s"' % self.object.name
+        if etag:
+            file_response['ETag'] = etag
+            file_response['Accept-Ranges'] = 'bytes'
+        #RFC 3230 instance digest, so clients can check what they got
+        if self.object.sha256:
+            file_response['Digest'] = 'SHA-256=' + base64.b64encode(self.object.sha256.decode('hex'))
+        return file_response
+    
     def get_queryset(self):
+        #name_prefix, unlike the name substring match, uses the (user, name) index
         fields = (
             ('name', 'name__contains'),
+            ('name_prefix', 'name__startswith'),
             ('destination','destination__name__contains'),
             ('date', 'date'),
             ('min_date', 'date__gte'),
@@ -167,4 +419,95 @@ class BackupViewSet(PrivateModelMixin,
         if not self.request.user.is_superuser:
             query.update({'user': self.request.user})
             
-        return Backup.objects.filter(**query)
+        return Backup.objects.select_related('user', 'destination').filter(**query)
+
+class UploadViewSet(PrivateModelMixin,
+                    mixins.CreateModelMixin,
+                    mixins.RetrieveModelMixin,
+                    viewsets.GenericViewSet):
+    '''
+        Resumable chunked uploads:
+            POST /uploads/ (name, destination, date, size) creates a session,
+                 on destinations that take writes at offsets
+            PUT  /uploads/<id>/chunk/?number=N&offset=O with the raw bytes
+                 as body writes a chunk (chunks may be sent in parallel)
+            GET  /uploads/<id>/ lists the received byte ranges, to resume
+            POST /uploads/<id>/finalize/ creates the backup
+    '''
+    queryset = UploadSession.objects.all()
+    serializer_class = UploadSessionSerializer
+    permission_classes = (IsOwnerOrSuperuser,)
+    
+    @detail_route(methods=['put'])
+    def chunk(self, request, pk=None):
+        session = self.get_object()
+        if session.finished:
+            return Response({'error': 'Upload already finalized'},
+                            status=status.HTTP_400_BAD_REQUEST)
+        try:
+            number = int(request.QUERY_PARAMS['number'])
+            offset = int(request.QUERY_PARAMS['offset'])
+            if number < 0 or offset < 0:
+                raise ValueError(offset)
+        except (KeyError, ValueError):
+            return Response({'error': 'number and offset must be non negative integers'},
+                            status=status.HTTP_400_BAD_REQUEST)
+        
+        chunk = session.write_chunk(number, offset, request.stream or BytesIO())
+        return Response({'number': chunk.number,
+                         'offset': chunk.offset,
+                         'length': chunk.length,
+                         'received': session.received()})
+    
+    @detail_route(methods=['post'])
+    def finalize(self, request, pk=None):
+        session = self.get_object()
+        if session.finished:
+            return Response({'error': 'Upload already finalized'},
+                            status=status.HTTP_400_BAD_REQUEST)
+        missing = session.missing()
+        if missing:
+            return Response({'error': 'Upload is incomplete', 'missing': missing},
+                            status=status.HTTP_400_BAD_REQUEST)
+        
+        try:
+            backup = session.finalize()
+        except UploadError, e:
+            return Response({'error': unicode(e)},
+                            status=status.HTTP_400_BAD_REQUEST)
+        if not backup.success:
+            return Response({'error': backup.obs},
+                            status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+        serializer = BackupSerializer(backup, context=self.get_serializer_context())
+        return Response(serializer.data, status=status.HTTP_201_CREATED,
+                        headers=self.get_success_headers(serializer.data))
+
+class TransferJobViewSet(viewsets.ReadOnlyModelViewSet):
+    queryset = TransferJob.objects.all()
+    serializer_class = TransferJobSerializer
+    permission_classes = (IsOwnerOrSuperuser,)
+    
+    def get_queryset(self):
+        qs = TransferJob.objects.select_related('backup')
+        if self.request.user.is_superuser:
+            return qs
+        return qs.filter(backup__user=self.request.user)
+
+def metrics(request):
+    '''
+        This process's metrics in the Prometheus text format, for staff
+        (by session or API token) and the addresses in METRICS_ALLOWED_IPS,
+        none by default: behind a proxy on the same host every request
+        comes from 127.0.0.1. Every worker process keeps its own, scrape
+        them one by one.
+    '''
+    allowed = getattr(settings, 'METRICS_ALLOWED_IPS', ())
+    user = getattr(request, 'user', None)
+    if not (user and user.is_staff):
+        try:
+            user = (CachedTokenAuthentication().authenticate(request) or (None,))[0]
+        except AuthenticationFailed:
+            user = None
+    if request.META.get('REMOTE_ADDR') not in allowed and not (user and user.is_staff):
+        return HttpResponseForbidden()
+    return HttpResponse(registry.render(), content_type='text/plain; version=0.0.4; charset=utf-8')
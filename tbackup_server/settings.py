@@ -11,6 +11,7 @@ https://docs.djangoproject.com/en/1.6/ref/settings/
 
 # Build paths inside the project like this: os.path.join(BASE_DIR, ...)
 import os
+import tempfile
 BASE_DIR = os.path.dirname(os.path.dirname(__file__))
 
 import settings_dev
@@ -53,9 +54,10 @@ REST_FRAMEWORK = {
         'rest_framework.permissions.IsAuthenticatedOrReadOnly'
     ],
     'DEFAULT_AUTHENTICATION_CLASSES': (
-        'rest_framework.authentication.BasicAuthentication',
+        'server.authentication.CachedBasicAuthentication',
         'rest_framework.authentication.SessionAuthentication',
-        'rest_framework.authentication.TokenAuthentication'
+        'server.authentication.CachedTokenAuthentication',
+        'server.authentication.OriginAuthentication'
     )
 }
 SWAGGER_SETTINGS = {
@@ -92,6 +94,9 @@ MIDDLEWARE_CLASSES = (
     'django.contrib.auth.middleware.AuthenticationMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
+    'server.middleware.MetricsMiddleware',
+    'server.authentication.BodyDigestMiddleware',
+    'server.middleware.TracingMiddleware',
 )
 
 TEMPLATE_DIRS = (
@@ -134,3 +139,97 @@ STATIC_URL = '/static/'
 #TBackup Project's specific constants
 DT_FORMAT = '%Y%m%d_%H%M'
 DT_FORMAT_VERBOSE = u'%d/%m/%Y - %H:%M'
+
+#SFTP connection pool (per process)
+SFTP_POOL_SIZE = 8          #max open sessions, idle or in use
+SFTP_POOL_MAX_IDLE = 300    #seconds before an idle session is closed
+SFTP_POOL_KEEPALIVE = 30    #seconds between SSH keepalives
+SFTP_POOL_TIMEOUT = 30.0    #seconds to wait for a free session
+#bytes each parallel SFTP session writes or reads ahead at a time
+SFTP_STRIPE_SIZE = 1024 * 1024
+
+#Downloads of LocalDestination backups without copying through Python:
+#None, 'x-sendfile', 'x-accel-redirect' or 'wsgi' (wsgi.file_wrapper)
+DOWNLOAD_SENDFILE = None
+#internal nginx location aliased to / when using 'x-accel-redirect'
+DOWNLOAD_ACCEL_PREFIX = '/protected'
+
+#Deferred transfers (manage.py runtransfers); POST /backups/?async=1
+#overrides BACKUP_TRANSFER_ASYNC per request
+BACKUP_TRANSFER_ASYNC = False
+TRANSFER_WORKERS = 4
+TRANSFER_MAX_ATTEMPTS = 3
+TRANSFER_JOB_TIMEOUT = 6 * 3600   #seconds before a running job is requeued
+TRANSFER_RETRY_BACKOFF = 60       #seconds before the first retry of a failed job, doubled each time
+TRANSFER_RETRY_MAX_BACKOFF = 3600
+
+#chunks buffered per replica when an upload is teed to several destinations
+REPLICATION_BUFFER_CHUNKS = 8
+
+#/backups/ listing pages, when ?page_size=N or ?cursor=... is given (a bare list otherwise)
+BACKUP_PAGE_SIZE = 100
+BACKUP_MAX_PAGE_SIZE = 1000
+
+#Authenticated Basic/Token/HMAC credentials kept in process (server/authentication.py)
+AUTH_CACHE_SIZE = 1024
+AUTH_CACHE_TTL = 60         #seconds; changes made by other processes wait this long
+AUTH_HMAC_MAX_SKEW = 300    #seconds between an HMAC request's timestamp and now
+AUTH_HMAC_SPOOL_SIZE = 1024 * 1024   #bytes of a signed body hashed in memory, then on disk
+AUTH_HMAC_MAX_BODY = 1024 * 1024 * 1024   #bytes; larger signed bodies are refused (413)
+AUTH_HMAC_REPLAY_CACHE = 'default'   #django cache of the signatures already used; must be shared
+                                     #by all processes (memcached, database), not the default locmem
+
+#uploads whose first 64KB have more entropy than this (bits per byte, 8 is
+#random data) are taken as already compressed and stored as sent, even on
+#destinations with compression; None always compresses
+COMPRESSION_SKIP_ENTROPY = 7.5
+
+#manage.py scrub: stored backups re-read and checked against their checksums
+SCRUB_RATE = 10 * 1024 * 1024    #bytes per second per destination
+SCRUB_CONCURRENCY = 1            #backups verified at once per destination
+SCRUB_INTERVAL = 7 * 24 * 3600   #seconds before a backup is verified again
+REPLICA_RETRY_MAX_AGE = 7 * 24 * 3600   #seconds failed replicas are retried by scrub, then deleted
+
+#manage.py prune: backups removed from destinations and deleted per batch
+PRUNE_BATCH_SIZE = 500
+
+#APIDestination HTTP object stores
+API_POOL_SIZE = 8                 #idle keep-alive connections kept per host
+API_POOL_MAX_IDLE = 60            #seconds before an idle connection is closed
+API_TIMEOUT = 30.0                #socket timeout, seconds
+API_RETRIES = 3                   #extra attempts after a network or 5xx error
+API_RETRY_BACKOFF = 0.5           #seconds before the first retry, doubling
+API_PART_SIZE = 8 * 1024 * 1024   #multipart upload part size, bytes
+
+#DedupDestination: chunks and temporary files younger than this (seconds) are
+#not collected, as writes under way have not written their manifest yet
+DEDUP_GC_GRACE = 3600
+
+#incremental destinations: block size of the rsync style deltas, bytes
+DELTA_BLOCK_SIZE = 8 * 1024
+#directory keeping the signatures of delta bases, so they are not reread
+#for every new version (None to turn off), and seconds an unused one is kept
+DELTA_SIGNATURE_CACHE = os.path.join(tempfile.gettempdir(), 'tbackup-signatures')
+DELTA_SIGNATURE_CACHE_AGE = 7 * 24 * 3600
+
+#destination copy loops: bytes per read/write, by destination kind, read
+#into pooled buffers (server/models/destination/buffers.py)
+IO_BLOCK_SIZE = 64 * 1024
+IO_BLOCK_SIZES = {
+    'localdestination': 1024 * 1024,
+    'sftpdestination': 1024 * 1024,   #one stripe per write
+}
+IO_POOL_MAX_FREE = 16             #idle buffers kept per size
+
+#GET /metrics/ (Prometheus text format) is served to staff, by session or
+#API token, and to these addresses. Not 127.0.0.1 behind a reverse proxy on
+#the same host (the X-Accel-Redirect setup), every request comes from there
+METRICS_ALLOWED_IPS = ()
+
+#request tracing (server/tracing.py), opt-in: requests with an X-Trace: 1
+#header are traced and their span trees logged to server.tracing; with
+#TRACING on every request is, and logged when it takes TRACE_SLOW_REQUEST
+#seconds or more
+TRACING = False
+TRACE_SLOW_REQUEST = 10.0
+TRACE_MAX_SPANS = 1000
@@ -11,4 +11,5 @@ import os
 os.environ.setdefault("DJANGO_SETTINGS_MODULE", "tbackup_server.settings")
 
 from django.core.wsgi import get_wsgi_application
-application = get_wsgi_application()
+from server.downloads import wsgi_file_wrapper
+application = wsgi_file_wrapper(get_wsgi_application())